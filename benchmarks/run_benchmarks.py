@@ -0,0 +1,269 @@
+"""Benchmarks of the scanning, gap check and log lookup hot paths and of the full run of the three workflow scripts
+
+Every scale runs in its own process on a synthetic FILM_OPS tree, with benchmarks/fake_tools first on the PATH in place
+of rawcooked and mediaconch. The results are written to benchmarks/results/<date>-<host>.json, two result files are
+compared with --compare.
+
+    python -m benchmarks.run_benchmarks --scales 1000,10000,100000
+    python -m benchmarks.run_benchmarks --compare benchmarks/results/a.json benchmarks/results/b.json
+"""
+
+import argparse
+import datetime
+import importlib
+import json
+import math
+import os
+import platform
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCHMARKS_FOLDER)
+FAKE_TOOLS_FOLDER = os.path.join(BENCHMARKS_FOLDER, 'fake_tools')
+RESULTS_FOLDER = os.path.join(BENCHMARKS_FOLDER, 'results')
+
+# Settings of the scripts during the benchmark, the fake mkvs are tiny so the space checks never defer a cook
+SCRIPT_SETTINGS = {
+    'POLICY_DPX': os.path.join(REPO_ROOT, 'policy', 'rawcooked_dpx_policy.xml'),
+    'POLICY_RAWCOOK': os.path.join(REPO_ROOT, 'policy', 'rawcooked_mkv_policy.xml'),
+    'LOG_CONSOLE': 'false',
+    'COOK_VERIFY': 'true',
+    'COOK_MKV_RATIO': '0.001',
+    'COOK_SPACE_HEADROOM_GB': '0',
+    'BENCH_RAWCOOKED_RATIO': '0.001',
+}
+
+
+def measure(name, scale, function, repeat=1) -> dict:
+    """Function to time a callable
+
+    @return: Result record with the median, minimum and maximum wall time in seconds
+    """
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return {'benchmark': name, 'scale': scale, 'repeat': repeat, 'median': statistics.median(timings),
+            'min': min(timings), 'max': max(timings)}
+
+
+def build_tree(root, scale, options) -> dict:
+    """Function to write the workflow folders and scale frames of deliveries into dpx_to_assess
+
+    Deliveries hold options.frames_per_sequence frames. Every tenth delivery has two reels, the second one needs
+    --output-version 2 and the third one has gaps, the others alternate between the nested and the flat layout.
+    @return: Dictionary with the environment of the scripts and the path of dpx_to_assess
+    """
+
+    from benchmarks import synthetic_dpx
+
+    environment = synthetic_dpx.generate_workflow_tree(root)
+    assess_path = os.path.join(root, environment['DPX_ASSESS'])
+    sequence_options = {'width': options.width, 'height': options.height, 'dense': options.dense}
+    deliveries = max(1, math.ceil(scale / options.frames_per_sequence))
+    remaining = scale
+    for index in range(deliveries):
+        frames = min(options.frames_per_sequence, remaining)
+        remaining -= frames
+        name = f"N_{index:06d}"
+        if index == 1:
+            name += '_v2'
+        if index % 10 == 9 and frames >= 2:
+            for reel, reel_frames in ((1, frames - frames // 2), (2, frames // 2)):
+                synthetic_dpx.generate_sequence(os.path.join(assess_path, name, f"reel{reel}", 'scan'), reel_frames,
+                                                **sequence_options)
+        elif index == 2:
+            synthetic_dpx.generate_delivery(assess_path, name, frames, gaps=3, **sequence_options)
+        else:
+            synthetic_dpx.generate_delivery(assess_path, name, frames, layout='nested' if index % 2 else 'flat',
+                                            **sequence_options)
+    return {'environment': environment, 'assess_path': assess_path}
+
+
+def write_log(path, lines) -> str:
+    """Function to write a success log of lines sequence paths, the way the legacy text logs grow"""
+    with open(path, 'w') as file:
+        for index in range(lines):
+            file.write(f"/mnt/film_ops/media/encoding/dpx_to_assess/N_{index:07d}\n")
+    return f"N_{lines - 1:07d}"
+
+
+def run_scale(scale, work_folder, options) -> list:
+    """Runs every benchmark of one scale, executed in a separate process so that the scripts read a fresh environment
+    """
+
+    root = os.path.join(work_folder, 'film_ops')
+    results = []
+    tree = {}
+    results.append(measure('generate_synthetic_tree', scale, lambda: tree.update(build_tree(root, scale, options))))
+    os.environ.update(tree['environment'])
+    os.environ.update(SCRIPT_SETTINGS)
+    os.environ['FRAME_MANIFEST'] = 'true' if options.manifest else 'false'
+    os.environ['COOK_BATCH_MAX_COUNT'] = str(10 ** 9)
+    # The tree was just written, the warm scan must still find it in the inventory
+    os.environ['SCAN_SETTLE_SECONDS'] = '0'
+
+    from utils import find_utils, gap_check_utils, scan_utils
+
+    assess_path = tree['assess_path']
+    repeat = options.repeat
+    results.append(measure('find_dpx_folder_from_sequence', scale,
+                           lambda: find_utils.find_dpx_folder_from_sequence(assess_path), repeat))
+    results.append(measure('find_dpx_units', scale, lambda: find_utils.find_dpx_units(assess_path), repeat))
+
+    inventory_path = os.path.join(work_folder, 'inventory.db')
+
+    def scan_inventory():
+        inventory = scan_utils.ScanInventory(inventory_path)
+        inventory.work_units(assess_path)
+        inventory.close()
+
+    results.append(measure('scan_inventory_cold', scale, scan_inventory))
+    results.append(measure('scan_inventory_warm', scale, scan_inventory, repeat))
+    os.remove(inventory_path)
+
+    # Every frame of the tree is read as if it was one sequence, so the cost grows with the scale
+    results.append(measure('find_missing', scale, lambda: gap_check_utils.find_missing(assess_path), repeat))
+
+    log_path = os.path.join(work_folder, 'rawcook_dpx_success.log')
+    last_entry = write_log(log_path, scale)
+    results.append(measure('find_in_logs_last_line', scale, lambda: find_utils.find_in_logs(log_path, last_entry),
+                           repeat))
+    results.append(measure('find_in_logs_absent', scale, lambda: find_utils.find_in_logs(log_path, 'absent'),
+                           repeat))
+
+    def execute(module_name, class_name):
+        module = importlib.import_module(module_name)
+        try:
+            getattr(module, class_name)().execute()
+        except SystemExit:
+            pass
+
+    results.append(measure('DpxAssessment.execute', scale,
+                           lambda: execute('scripts.dpx_assessment', 'DpxAssessment')))
+    results.append(measure('DpxRawcook.execute', scale, lambda: execute('scripts.dpx_rawcook', 'DpxRawcook')))
+
+    from scripts import dpx_post_rawcook
+
+    results.append(measure('check_general_errors', scale,
+                           lambda: dpx_post_rawcook.DpxPostRawcook().check_general_errors(), repeat))
+    results.append(measure('DpxPostRawcook.execute', scale,
+                           lambda: execute('scripts.dpx_post_rawcook', 'DpxPostRawcook')))
+    return results
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(options) -> str:
+    """Runs every scale in a child process and stores the results
+
+    @return: The path of the result file
+    """
+
+    environment = os.environ.copy()
+    environment['PATH'] = FAKE_TOOLS_FOLDER + os.pathsep + environment.get('PATH', '')
+    results = []
+    for scale in options.scales:
+        work_folder = tempfile.mkdtemp(prefix=f"rawcook_bench_{scale}_", dir=options.work)
+        output = os.path.join(work_folder, 'results.json')
+        worker_log = os.path.join(work_folder, 'worker.log')
+        try:
+            with open(worker_log, 'w') as log_file:
+                worker = subprocess.run([sys.executable, '-m', 'benchmarks.run_benchmarks', '--worker', '--scale', str(scale),
+                                         '--output', output, '--work', work_folder, '--repeat', str(options.repeat),
+                                         '--frames-per-sequence', str(options.frames_per_sequence),
+                                         '--width', str(options.width), '--height', str(options.height)] +
+                                        (['--dense'] if options.dense else []) +
+                                        (['--manifest'] if options.manifest else []),
+                                        cwd=REPO_ROOT, env=environment, stdout=log_file, stderr=subprocess.STDOUT)
+            if worker.returncode != 0:
+                with open(worker_log, 'r') as log_file:
+                    print(log_file.read()[-5000:])
+                raise RuntimeError(f"benchmarks of scale {scale} failed, see {worker_log}")
+            with open(output, 'r') as file:
+                scale_results = json.load(file)
+            for result in scale_results:
+                print(f"{result['benchmark']:<45} {scale:>9} frames {result['median']:>10.4f} s", flush=True)
+            results.extend(scale_results)
+        finally:
+            if not options.keep:
+                shutil.rmtree(work_folder, ignore_errors=True)
+
+    started = datetime.datetime.now()
+    os.makedirs(RESULTS_FOLDER, exist_ok=True)
+    result_path = os.path.join(RESULTS_FOLDER, f"{started.strftime('%Y%m%d-%H%M%S')}-{socket.gethostname()}.json")
+    with open(result_path, 'w') as file:
+        json.dump({
+            'date': started.isoformat(timespec='seconds'),
+            'host': socket.gethostname(),
+            'cpus': os.cpu_count(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'commit': git_commit(),
+            'settings': {'frames_per_sequence': options.frames_per_sequence, 'width': options.width,
+                         'height': options.height, 'dense': options.dense, 'manifest': options.manifest,
+                         'repeat': options.repeat},
+            'results': results,
+        }, file, indent=2)
+    print(f"Results written to {result_path}")
+    return result_path
+
+
+def compare(old_path, new_path) -> None:
+    """Prints the median times of two result files side by side"""
+    with open(old_path, 'r') as file:
+        old = {(r['benchmark'], r['scale']): r for r in json.load(file)['results']}
+    with open(new_path, 'r') as file:
+        new = {(r['benchmark'], r['scale']): r for r in json.load(file)['results']}
+
+    print(f"{'benchmark':<45} {'frames':>9} {'old s':>10} {'new s':>10} {'new/old':>8}")
+    for key in sorted(old.keys() & new.keys(), key=lambda key: (key[1], key[0])):
+        old_seconds, new_seconds = old[key]['median'], new[key]['median']
+        ratio = new_seconds / old_seconds if old_seconds else float('inf')
+        print(f"{key[0]:<45} {key[1]:>9} {old_seconds:>10.4f} {new_seconds:>10.4f} {ratio:>8.2f}")
+    for key in sorted(old.keys() ^ new.keys()):
+        print(f"{key[0]:<45} {key[1]:>9} only in {'old' if key in old else 'new'} results")
+
+
+def parse_arguments(arguments):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', type=lambda value: [int(scale) for scale in value.split(',')],
+                        default=[1000, 10000], help="comma separated total frame counts, e.g. 1000,10000,1000000")
+    parser.add_argument('--frames-per-sequence', type=int, default=1000)
+    parser.add_argument('--width', type=int, default=2048)
+    parser.add_argument('--height', type=int, default=1556)
+    parser.add_argument('--dense', action='store_true', help="write random image data instead of sparse frames")
+    parser.add_argument('--manifest', action='store_true', help="build the frame manifests during the assessment")
+    parser.add_argument('--repeat', type=int, default=3, help="runs of every micro benchmark, the median is kept")
+    parser.add_argument('--work', default=None, help="folder of the synthetic trees, defaults to the temp folder")
+    parser.add_argument('--keep', action='store_true', help="keep the synthetic trees")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--scale', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--output', help=argparse.SUPPRESS)
+    return parser.parse_args(arguments)
+
+
+if __name__ == '__main__':
+    arguments = parse_arguments(sys.argv[1:])
+    if arguments.compare:
+        compare(*arguments.compare)
+    elif arguments.worker:
+        with open(arguments.output, 'w') as output_file:
+            json.dump(run_scale(arguments.scale, arguments.work, arguments), output_file)
+    else:
+        run(arguments)
@@ -0,0 +1,148 @@
+import os
+import random
+import struct
+
+from utils import dpx_utils
+
+# Transfer and colorimetric characteristic of a film scan, printing density
+PRINTING_DENSITY = 1
+# Packing of 10 bit RGB into 32 bit words, method A
+PACKING_METHOD_A = 1
+
+
+def image_bytes(width, height, bit_depth=10, descriptor=dpx_utils.DESCRIPTOR_RGB) -> int:
+    """Function to return the size of the image data of a frame
+
+    @param width: Width in pixels
+    @param height: Height in pixels
+    @param bit_depth: 10 or 16
+    @param descriptor: dpx_utils.DESCRIPTOR_RGB or dpx_utils.DESCRIPTOR_LUMA
+    @return: Size in bytes, 10 bit samples are packed three per 32 bit word
+    """
+
+    components = 3 if descriptor == dpx_utils.DESCRIPTOR_RGB else 1
+    if bit_depth == 10:
+        return (width * components + 2) // 3 * 4 * height
+    return width * components * bit_depth // 8 * height
+
+
+def dpx_header(width, height, bit_depth=10, descriptor=dpx_utils.DESCRIPTOR_RGB, big_endian=True) -> bytes:
+    """Function to build a DPX header that dpx_utils.read_dpx_header() and the DPX policy accept
+
+    @return: The HEADER_SIZE bytes of the generic and industry headers
+    """
+
+    order = '>' if big_endian else '<'
+    header = bytearray(dpx_utils.HEADER_SIZE)
+    header[0:4] = dpx_utils.MAGIC_BIG_ENDIAN if big_endian else dpx_utils.MAGIC_LITTLE_ENDIAN
+    struct.pack_into(f'{order}I', header, 4, dpx_utils.HEADER_SIZE)
+    header[8:16] = b'V2.0\0\0\0\0'
+    struct.pack_into(f'{order}I', header, 16,
+                     dpx_utils.HEADER_SIZE + image_bytes(width, height, bit_depth, descriptor))
+    struct.pack_into(f'{order}HHII', header, 768, 0, 1, width, height)
+    struct.pack_into(f'{order}BBBBHH', header, 800, descriptor, PRINTING_DENSITY, PRINTING_DENSITY, bit_depth,
+                     PACKING_METHOD_A if bit_depth == 10 else 0, dpx_utils.ENCODING_RAW)
+    # Offset of the image data of the first element
+    struct.pack_into(f'{order}I', header, 808, dpx_utils.HEADER_SIZE)
+    return bytes(header)
+
+
+def write_frame(path, header, file_size, dense=False) -> None:
+    """Function to write one frame, the image data is a hole of the file unless dense is set
+
+    Sparse frames have the real size of a frame without using the disk space, reading them returns zeros
+    """
+
+    with open(path, 'wb') as file:
+        file.write(header)
+        if dense:
+            file.write(os.urandom(file_size - len(header)))
+        else:
+            file.truncate(file_size)
+
+
+def generate_sequence(folder, frames, width=2048, height=1556, bit_depth=10, descriptor=dpx_utils.DESCRIPTOR_RGB,
+                      start=86400, gaps=0, prefix='scan_', dense=False, seed=0) -> list:
+    """Function to write a DPX sequence into a folder
+
+    @param folder: The folder of the frames, created if needed
+    @param frames: Number of frames written
+    @param width: Width in pixels
+    @param height: Height in pixels
+    @param bit_depth: 10 or 16
+    @param descriptor: dpx_utils.DESCRIPTOR_RGB or dpx_utils.DESCRIPTOR_LUMA
+    @param start: Number of the first frame
+    @param gaps: Number of frames left out at random positions inside the sequence, the first and last frame are kept
+    @param prefix: File name prefix, the frame number is written with 7 digits after it
+    @param dense: Write random image data instead of sparse frames
+    @param seed: Seed of the positions of the gaps
+    @return: The sorted frame numbers left out
+    """
+
+    os.makedirs(folder, exist_ok=True)
+    header = dpx_header(width, height, bit_depth, descriptor)
+    file_size = dpx_utils.HEADER_SIZE + image_bytes(width, height, bit_depth, descriptor)
+    missing = set()
+    if gaps and frames > 2:
+        missing = set(random.Random(seed).sample(range(start + 1, start + frames + gaps - 1), gaps))
+    number = start
+    written = 0
+    while written < frames:
+        if number not in missing:
+            write_frame(os.path.join(folder, f"{prefix}{number:07d}.dpx"), header, file_size, dense)
+            written += 1
+        number += 1
+    return sorted(missing)
+
+
+def generate_delivery(root, name, frames, reels=1, layout='nested', **sequence_options) -> list:
+    """Function to write a delivery folder the way the scanning suppliers send them
+
+    @param root: The workflow folder the delivery is written to, e.g. dpx_to_assess
+    @param name: The delivery folder name
+    @param frames: Number of frames of every reel
+    @param reels: Number of reels, a delivery with several reels holds one DPX folder per reel
+    @param layout: flat writes the frames in the delivery folder, nested in <delivery>/<reel>/scan/
+    @param sequence_options: Passed to generate_sequence()
+    @return: The folders holding the frames
+    """
+
+    folders = []
+    for reel in range(1, reels + 1):
+        if layout == 'flat' and reels == 1:
+            folder = os.path.join(root, name)
+        elif layout == 'flat':
+            folder = os.path.join(root, name, f"reel{reel}")
+        else:
+            folder = os.path.join(root, name, f"reel{reel}", 'scan')
+        generate_sequence(folder, frames, **sequence_options)
+        folders.append(folder)
+    return folders
+
+
+def generate_workflow_tree(root) -> dict:
+    """Function to create the workflow folders of scripts/workflow_folders_generator.py under root
+
+    @param root: The FILM_OPS folder of the benchmark
+    @return: The environment variables pointing the scripts at the tree
+    """
+
+    folders = {
+        'DPX_SCRIPT_LOG': 'logs/',
+        'DPX_ASSESS': 'media/encoding/dpx_to_assess/',
+        'DPX_REVIEW': 'media/encoding/dpx_for_review/',
+        'RAWCOOKED_PATH': 'media/encoding/rawcooked/',
+        'DPX_COOK': 'media/encoding/rawcooked/dpx_to_cook/',
+        'DPX_COOK_V2': 'media/encoding/rawcooked/dpx_to_cook_v2/',
+        'MKV_ENCODED': 'media/encoding/rawcooked/encoded/',
+        'DPX_COMPLETE': 'media/encoding/dpx_completed/',
+        'CURRENT_ERRORS': 'media/encoding/current_errors/',
+        'MKV_CHECK': 'media/encoding/mkv_check/',
+    }
+    for relative_path in folders.values():
+        os.makedirs(os.path.join(root, relative_path), exist_ok=True)
+    for sub_folder in ('mkv_cooked', ):
+        os.makedirs(os.path.join(root, folders['MKV_ENCODED'], sub_folder), exist_ok=True)
+    for sub_folder in ('post_rawcook_fails/mkv_files', 'post_rawcook_fails/rawcook_output_logs'):
+        os.makedirs(os.path.join(root, folders['DPX_REVIEW'], sub_folder), exist_ok=True)
+    return {'FILM_OPS': str(root), **folders}
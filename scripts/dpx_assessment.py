@@ -1,12 +1,15 @@
+import concurrent.futures
+import itertools
 import os
-import shutil
-import subprocess
 import sys
+import tempfile
+import time
 from pathlib import Path
 
 from dotenv import load_dotenv
 
-from utils import find_utils, shell_utils, logging_utils, gap_check_utils
+from utils import find_utils, shell_utils, logging_utils, gap_check_utils, ledger_utils, policy_cache, dpx_utils, \
+    manifest_utils, move_utils, job_state, scan_utils, metrics_utils
 
 # Load environment variables from .env file
 load_dotenv()
@@ -26,9 +29,60 @@ DPX_TO_COOK_PATH = r'{}'.format(DPX_TO_COOK_PATH)
 DPX_TO_COOK_V2_PATH = r'{}'.format(DPX_TO_COOK_V2_PATH)
 DPX_FOR_REVIEW_PATH = r'{}'.format(DPX_FOR_REVIEW_PATH)
 
+# Number of sequences assessed at the same time
+ASSESS_WORKERS = int(os.environ.get('ASSESS_WORKERS') or os.cpu_count() or 1)
+
+# Number of leading frames probed for the large reversibility file issue, 0 probes the whole sequence
+V2_PROBE_FRAMES = int(os.environ.get('V2_PROBE_FRAMES') or 0)
+
+# Check the header of every frame in process before running rawcooked and mediaconch
+DPX_HEADER_CHECK = os.environ.get('DPX_HEADER_CHECK', 'true').lower() in ('1', 'true', 'yes')
+# Also fail the frames that break the rules of the description of the DPX policy, and heterogeneous sequences
+DPX_HEADER_STRICT = os.environ.get('DPX_HEADER_STRICT', 'false').lower() in ('1', 'true', 'yes')
+HEADER_WORKERS = int(os.environ.get('HEADER_WORKERS') or 8)
+
+# Build the per frame checksum manifest of every sequence sent to the cook folders. It reads and hashes every source
+# byte and is only used by the round trip check of dpx_post_rawcook.py, so it follows ROUNDTRIP_VERIFY by default
+ROUNDTRIP_VERIFY = os.environ.get('ROUNDTRIP_VERIFY', 'false').lower() in ('1', 'true', 'yes')
+FRAME_MANIFEST = (os.environ.get('FRAME_MANIFEST') or str(ROUNDTRIP_VERIFY)).lower() in ('1', 'true', 'yes')
+MANIFEST_WORKERS = int(os.environ.get('MANIFEST_WORKERS') or 4)
+
+# Frames of each sequence checked against the policy, see find_utils.sample_dpx_files()
+DPX_POLICY_SAMPLE = os.environ.get('DPX_POLICY_SAMPLE') or 'first,last,random:8'
+# Number of frames given to each mediaconch invocation and number of processes running them per sequence
+POLICY_CHUNK_SIZE = int(os.environ.get('POLICY_CHUNK_SIZE') or 50)
+POLICY_WORKERS = int(os.environ.get('POLICY_WORKERS') or os.cpu_count() or 1)
+
+# Persistent cache of the mediaconch results, see utils/policy_cache.py
+POLICY_CACHE_PATH = os.path.join(SCRIPT_LOG, os.environ.get('POLICY_CACHE') or 'policy_cache.db')
+POLICY_CACHE_MAX_AGE_DAYS = float(os.environ.get('POLICY_CACHE_MAX_AGE_DAYS') or 30)
+POLICY_CACHE_MAX_ENTRIES = int(os.environ.get('POLICY_CACHE_MAX_ENTRIES') or 100000)
+
+# Number of files copied in parallel when a move crosses filesystems, and whether each copy is hashed
+MOVE_WORKERS = int(os.environ.get('MOVE_WORKERS') or 4)
+MOVE_VERIFY_HASH = os.environ.get('MOVE_VERIFY_HASH', 'false').lower() in ('1', 'true', 'yes')
+
+# Per sequence state shared by the three scripts, see utils/job_state.py
+JOB_STATE_DB = os.path.join(SCRIPT_LOG, os.environ.get('JOB_STATE_DB') or 'job_state.db')
+# Folder inventory shared by the scripts, see utils/scan_utils.py
+SCAN_INVENTORY_DB = os.path.join(SCRIPT_LOG, os.environ.get('SCAN_INVENTORY_DB') or 'scan_inventory.db')
+# Folder of the <script>.prom files read by the node_exporter textfile collector, see utils/metrics_utils.py
+METRICS_TEXTFILE_DIR = os.path.join(SCRIPT_LOG, os.environ.get('METRICS_TEXTFILE_DIR') or 'metrics')
+# The script label of the metrics
+METRICS_SCRIPT = 'dpx_assessment'
+
+# Outcomes of assess_sequence()
+VERDICT_GAPS = 'gaps'
+VERDICT_V2 = 'v2'
+VERDICT_PASS = 'pass'
+VERDICT_FAIL = 'fail'
+
 
 class DpxAssessment:
-    def __init__(self):
+    def __init__(self, sequences=None):
+        # Restricts the run to these sequence paths, None assesses the whole dpx_to_assess folder
+        self.sequences = None if sequences is None else set(sequences)
+
         # Log files
         self.logfile = os.path.join(SCRIPT_LOG, 'dpx_assessment.log')
         self.success_file = os.path.join(DPX_PATH, 'rawcook_dpx_success.log')
@@ -36,6 +90,13 @@ class DpxAssessment:
         self.review_file = os.path.join(DPX_PATH, 'review_dpx_failures.log')
         self.rawcooked_v2_file = os.path.join(DPX_PATH, 'rawcook_dpx_v2.log')
 
+        # Indexed record of the processed sequences, replaces the lookups in the above logs
+        self.ledger_file = os.path.join(DPX_PATH, 'rawcook_dpx_ledger.db')
+        self.ledger = None
+        self.policy_cache = None
+        self.job_state = None
+        self.inventory = None
+
         # Temporary .txt files
         self.temp_rawcooked_dpx_file = os.path.join(DPX_PATH, 'temp_rawcooked_dpx_list.txt')
         self.temp_rawcooked_v2_dpx_file = os.path.join(DPX_PATH, 'temp_rawcooked_v2_dpx_list.txt')
@@ -48,8 +109,10 @@ class DpxAssessment:
             self.temp_tar_dpx_file, self.temp_review_dpx_file
         ]
 
-        # Dictionary containing the root folder and one file that needs to be assessed through the assessment script
+        # Dictionary containing the root folder and its DPX folders, each one assessed as a separate work unit
         self.dpx_to_assess = {}
+        # <sequence path, WorkUnit> of the sequences whose gaps send a DPX folder to dpx_for_review
+        self.gap_units = {}
 
     def process(self) -> None:
         """Initiates the workflow
@@ -70,6 +133,19 @@ class DpxAssessment:
         shell_utils.create_file(self.rawcooked_v2_file)
 
         logging_utils.log(self.logfile, "\n============= DPX Assessment workflow START =============\n")
+        metrics_utils.start(METRICS_SCRIPT, self.logfile)
+
+        # Load the ledger once per run and bring in anything still written to the legacy text logs
+        self.ledger = ledger_utils.SequenceLedger(self.ledger_file)
+        self.ledger.import_log(self.success_file, ledger_utils.STATE_SUCCESS)
+        self.ledger.import_log(self.failure_file, ledger_utils.STATE_FAILURE)
+        self.ledger.import_log(self.review_file, ledger_utils.STATE_REVIEW)
+        self.ledger.import_log(self.rawcooked_v2_file, ledger_utils.STATE_V2)
+
+        self.job_state = job_state.JobStateStore(JOB_STATE_DB)
+        self.inventory = scan_utils.ScanInventory(SCAN_INVENTORY_DB)
+        self.policy_cache = policy_cache.PolicyCache(POLICY_CACHE_PATH, POLICY_CACHE_MAX_AGE_DAYS,
+                                                     POLICY_CACHE_MAX_ENTRIES)
 
         # Creating temporary files from the temp_files list
         for file_name in self.temp_files:
@@ -78,169 +154,306 @@ class DpxAssessment:
             print(f"Created file: {file_name}")
 
     def find_dpx_to_assess(self):
-        """Randomly retrieves a DPX file in each folder and creates a dictionary with <root_folder, dpx_file> pairs
+        """Finds every DPX folder of each sequence and creates a dictionary with <root_folder, list of WorkUnit> pairs
 
-        Recursively traverse through each sequence folder until the depth at which it finds a .dpx file
-        Stores the root folder path and the path of the randomly chosen .dpx file as key value pairs in dpx_to_check
-        Skips a sequence if the same absolute path is already present in rawcook_dpx_success.log or tar_dpx_failures.log
+        Recursively traverse through each sequence folder and keeps every folder holding .dpx files, so the reels of a
+        multi reel delivery are all assessed, see scan_utils.units_of()
+        Skips a sequence if the same absolute path is already recorded in the ledger
+        The folders come from the scan inventory, only the folders changed since the last scan are listed again
         """
-        for seq in os.listdir(DPX_PATH):
-            seq_path = os.path.join(DPX_PATH, seq)
-            if os.path.isfile(seq_path) and not seq.endswith('.dpx'):
+        for seq_path, units in find_utils.find_dpx_units(DPX_PATH, self.inventory).items():
+            if self.sequences is not None and seq_path not in self.sequences:
                 continue
 
-            # checks in the logs if the sequence has already been processed
-            queued_pass = find_utils.find_in_logs(self.success_file, seq_path)
-            queued_fail = find_utils.find_in_logs(self.failure_file, seq_path)
-            queued_review = find_utils.find_in_logs(self.review_file, seq_path)
-            queued_v2 = find_utils.find_in_logs(self.rawcooked_v2_file, seq_path)
-
-            if queued_pass or queued_fail or queued_review or queued_v2:
+            # checks in the ledger if the sequence has already been processed
+            if self.ledger.state_of(seq_path) is not None:
                 logging_utils.log(self.logfile,
                                   f"SKIPPING DPX folder: {seq_path}, it has already been processed but has not "
                                   f"moved to correct processing path:")
                 continue
 
-            for dir_path, dir_names, file_names in os.walk(seq_path):
-                if len(file_names) == 0:
-                    continue
-                for file_name in file_names:
-                    if file_name.endswith('.dpx'):
-                        self.dpx_to_assess[seq_path] = os.path.join(dir_path, file_name)
-                        break
-
-    def gap_check(self):
-        """Function to check for gaps in the dpx sequences
-
-                    Iterate all folders containing dpx files
-                    Check in each folder if DPX list is shorter than min() max() range list
-                    If yes, report different to log and move folder to dpx_for_review
-                    If identical, move folder to dpx_to_assess/ folder for folder type
-                    old folder formatting or new folder formatting
+            self.dpx_to_assess[seq_path] = units
+            self.job_state.discover(seq_path)
+            if len(units) > 1:
+                logging_utils.log(self.logfile, f"{seq_path} holds {len(units)} DPX folders: "
+                                                f"{', '.join(unit.name for unit in units)}")
+        metrics_utils.set_gauge('rawcook_queue_depth', len(self.dpx_to_assess), script=METRICS_SCRIPT,
+                                queue='to_assess')
+
+    def gap_check(self, unit) -> bool:
+        """Function to check for gaps in a dpx sequence
+
+                    Check the folder containing dpx files for missing frame ranges or duplicated frame numbers
+                    If any, report them to the log and return True so that the folder is routed to dpx_for_review
+                    The folder is listed again rather than read from the scan inventory, a frame missed by the
+                    inventory must not let a sequence through
         """
-        # TODO: Add logging
-        for seq in self.dpx_to_assess.keys():
-            dpath = Path(self.dpx_to_assess.get(seq)).parent
-            has_gaps = gap_check_utils.find_missing(dpath)
-            folder_name = dpath.name
-            if has_gaps:
-                print("GAPS PRESENT IN FOLDERS:")
-                move_path = os.path.join(DPX_FOR_REVIEW_PATH, folder_name)
-                try:
-                    shutil.move(dpath, move_path)
-                except Exception as e:
-                    print(e)
-                self.dpx_to_assess.pop(seq)
-
-    def check_v2(self):
+        seq = unit.path
+        report = gap_check_utils.find_missing(unit.info.path)
+        logging_utils.log(self.logfile, f"Gap check of {seq}: {report.total_frames} frames from "
+                                        f"{report.first_frame} to {report.last_frame}")
+        if report.has_gaps or report.duplicates:
+            logging_utils.log(self.logfile, f"GAPS PRESENT IN {seq}: {report.missing_count} missing frames in "
+                                            f"ranges {report.missing_ranges}, duplicated frames "
+                                            f"{report.duplicates}")
+            return True
+        return False
+
+    def check_v2(self, unit) -> bool:
         """Executes Rawcooked to check if the sequence generates a large reversibility file
 
-        The sequences with large reversibility file is added to a temp_rawcooked_v2_dpx_list.txt file
+        The output is scanned line by line and rawcooked is killed as soon as the large reversibility file error shows
+        If V2_PROBE_FRAMES is set, only that many leading frames of the sequence are probed
+        Returns True if the sequence has to be cooked with --output-version 2
         """
-        if not len(self.dpx_to_assess):
-            print("Nothing to assess. Script Exiting")
-            sys.exit()
-        sequences_to_v2 = []
-        for seq in self.dpx_to_assess.keys():
-            # Rawcooked should take a folder as input which contains only .dpx files and no other metadata file
-            # The value of dpx_to_check dict is the path to a .dpx file which implies that the parent of this path is
-            # The root dpx folder that rawcooked should take as input
-            root_dpx_folder = Path(self.dpx_to_assess.get(seq)).parent
-            command = ['rawcooked', '--check', '--no-encode', root_dpx_folder]
-            logging_utils.log(self.logfile,
-                              f"Checking for large reversibility file issue in {seq}")
-
-            subprocess_logs = []
-            # Note: By observation, output of Rawcooked is captured in stderr not in stdout
-            with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True) as p:
-                for line in p.stderr:
-                    subprocess_logs.append(line)
-                    print(line)
-                for line in p.stdout:
-                    subprocess_logs.append(line)
-                    print(line)
-
-            std_logs = ''.join(subprocess_logs)
-
-            # Checks for sequences with large reversibility file
-            if std_logs.find('Error: the reversibility file is becoming big') != -1:
-                logging_utils.log(self.logfile,
-                                  f"FAIL: {seq} REVERSIBILITY FILE IS TOO BIG. Adding to "
-                                  f"temp_rawcooked_v2_dpx_list.txt")
-
-                with open(self.temp_rawcooked_v2_dpx_file, 'a') as file:
-                    file.write(f"{seq}\n")
-                sequences_to_v2.append(seq)
-
-        # We don't need to run mediaconch over these sequences so remove the entries
-        for seq in sequences_to_v2:
-            self.dpx_to_assess.pop(seq)
-
-    def check_mediaconch_policy(self, dpx_to_check: dict) -> None:
-        """Checks if the dpx files passed as parameters matches mediaconch policies
+        # Rawcooked should take a folder as input which contains only .dpx files and no other metadata file
+        # The folder of the work unit holding the .dpx files is the root dpx folder that rawcooked should take as input
+        seq = unit.path
+        root_dpx_folder = Path(unit.info.path)
+        logging_utils.log(self.logfile,
+                          f"Checking for large reversibility file issue in {seq}")
+
+        if V2_PROBE_FRAMES > 0:
+            with tempfile.TemporaryDirectory(prefix=f"{root_dpx_folder.name}_probe_") as probe_folder:
+                self.link_probe_frames(root_dpx_folder, probe_folder)
+                needs_v2 = self.probe_reversibility(probe_folder)
+        else:
+            needs_v2 = self.probe_reversibility(root_dpx_folder)
+
+        if needs_v2:
+            logging_utils.log(self.logfile, f"FAIL: {seq} REVERSIBILITY FILE IS TOO BIG")
+        return needs_v2
+
+    @staticmethod
+    def link_probe_frames(root_dpx_folder, probe_folder) -> None:
+        """Symlinks the first V2_PROBE_FRAMES frames of a dpx folder into probe_folder
+
+        The frames are taken in name order so that the probe still sees a coherent, gap free sequence
         """
-        if not len(self.dpx_to_assess):
-            print("Nothing to assess. Script Exiting")
-            sys.exit()
-        for seq in dpx_to_check.keys():
-            dpx = dpx_to_check.get(seq)
-            logging_utils.log(self.logfile, f"Metadata file creation has started for: {dpx}")
-            check = shell_utils.check_mediaconch_policy(POLICY_PATH, dpx)
-            check_str = check.stdout.decode()
-            if check_str.startswith("pass!"):
-                with open(self.temp_rawcooked_dpx_file, 'a') as file:
-                    file.write(f"{seq}\n")
-            else:
-                logging_utils.log(self.logfile,
-                                  f"FAIL: {dpx} DOES NOT CONFORM TO MEDIACONCH POLICY. Adding to "
-                                  f"tar_dpx_failures_list.txt")
-                logging_utils.log(self.logfile, check_str)
-                with open(self.temp_tar_dpx_file, 'a') as file:
-                    file.write(f"{seq}\n")
+        with os.scandir(root_dpx_folder) as entries:
+            frames = sorted(entry.name for entry in entries if entry.name.lower().endswith('.dpx'))
+        for name in frames[:V2_PROBE_FRAMES]:
+            os.symlink(os.path.join(root_dpx_folder, name), os.path.join(probe_folder, name))
 
-    def move_v2_sequences(self) -> None:
-        """Moves the failed filed due to large reversibility file into dpx_to_cook_v2 folder
+    @staticmethod
+    def probe_reversibility(dpx_folder) -> bool:
+        """Runs rawcooked --check --no-encode and stops it as soon as the verdict is known
 
-        Collects all the sequences from the temp_rawcook_v2_dpx_list.txt then moves them into dpx_to_cook_v2 folder
+        Returns True if rawcooked reported that the reversibility file is becoming big
         """
+        command = ['rawcooked', '--check', '--no-encode', str(dpx_folder)]
+        result = shell_utils.run_streaming(command, prefix=os.path.basename(str(dpx_folder)),
+                                           stop_patterns=['Error: the reversibility file is becoming big'])
+        return result.stopped_on is not None
 
-        dpx_folders_to_move = []
-        with open(self.temp_rawcooked_v2_dpx_file, 'r') as file:
-            sorted_paths = file.read().splitlines()
-            dpx_folders_to_move.extend(sorted_paths)
+    def check_mediaconch_policy(self, unit) -> bool:
+        """Checks if a sample of the dpx files of the sequence matches mediaconch policies
 
-        for file_path in dpx_folders_to_move:
-            shutil.move(file_path, DPX_TO_COOK_V2_PATH)
+        The frames are picked with the DPX_POLICY_SAMPLE strategy and checked in parallel, stopping at the first failure
+        """
+        seq, dpx_folder = unit.path, unit.info.path
+        frames = find_utils.sample_dpx_files(dpx_folder, DPX_POLICY_SAMPLE)
+        logging_utils.log(self.logfile, f"Metadata file creation has started for: {seq}, checking {len(frames)} "
+                                        f"frames sampled with {DPX_POLICY_SAMPLE}")
+        results = shell_utils.check_mediaconch_policies(POLICY_PATH, frames, chunk_size=POLICY_CHUNK_SIZE,
+                                                        workers=POLICY_WORKERS, cache=self.policy_cache,
+                                                        stop_on_failure=True)
+
+        checked = sorted(os.path.basename(frame) for frame in results.keys())
+        summary = ', '.join(checked[:20]) + (f" and {len(checked) - 20} more" if len(checked) > 20 else '')
+        logging_utils.log(self.logfile, f"Checked {len(checked)} frames of {seq}: {summary}")
+
+        failed = {file: result for file, result in results.items() if not result.passed}
+        if not failed:
+            return True
+        for file, result in failed.items():
+            logging_utils.log(self.logfile, f"FAIL: {file} DOES NOT CONFORM TO MEDIACONCH POLICY")
+            logging_utils.log(self.logfile, f"MEDIACONCH_FAILED_RESULT: {result.outcome} {result.failed_rules}")
+        return False
+
+    def check_dpx_headers(self, unit) -> bool:
+        """Reads the header of every frame of the sequence and checks it in process, without mediaconch
+
+        Fails the sequence if a frame is not a DPX file or cannot be read. With DPX_HEADER_STRICT, also if a frame
+        breaks the rules of the description of the DPX policy or has a header that differs from the rest of the
+        sequence, otherwise the heterogeneous frames are only logged
+        """
+        seq, dpx_folder = unit.path, unit.info.path
+        report = dpx_utils.check_sequence_headers(dpx_folder, HEADER_WORKERS, DPX_HEADER_STRICT)
+        if report.passed:
+            for frame in report.heterogeneous[:20]:
+                logging_utils.log(self.logfile, f"WARNING: HETEROGENEOUS FRAME: {frame} differs from the rest of the "
+                                                f"sequence")
+            reference = report.reference
+            logging_utils.log(self.logfile, f"DPX headers of {seq}: {report.frames} frames, {reference.width}x"
+                                            f"{reference.height}, {reference.bit_depth} bit, descriptor "
+                                            f"{reference.descriptor}, {reference.byte_order} endian")
+            return True
+
+        logging_utils.log(self.logfile, f"FAIL: {seq} DPX HEADERS DO NOT CONFORM")
+        for frame, errors in itertools.islice(report.nonconforming.items(), 20):
+            logging_utils.log(self.logfile, f"NONCONFORMING FRAME: {frame}: {', '.join(errors)}")
+        for frame in report.heterogeneous[:20]:
+            logging_utils.log(self.logfile, f"HETEROGENEOUS FRAME: {frame} differs from the rest of the sequence")
+        for frame, error in itertools.islice(report.unreadable.items(), 20):
+            logging_utils.log(self.logfile, f"UNREADABLE FRAME: {frame}: {error}")
+        return False
+
+    def assess_sequence(self, seq) -> str:
+        """Runs the checks of one sequence, executed by the workers of the assessment pool
+
+        gap_check() -> check_dpx_headers() -> check_v2() -> check_mediaconch_policy(), stopping at the first check
+        that decides the verdict
+        Every DPX folder of a multi reel delivery is checked on its own, the delivery is routed as a whole so it needs
+        --output-version 2 if any of its folders does, and the first folder with gaps or a failure decides its verdict
+        Sequences that need --output-version 2 are not checked against the mediaconch policy
+        The frame manifest of the sequences that are going to be cooked is built before they are routed
+        The time spent on each check is recorded in the rawcook_sequence_seconds metric
+        Returns one of the VERDICT_* values
+        """
+        with logging_utils.correlation(seq), \
+                metrics_utils.timed('rawcook_sequence_seconds', script=METRICS_SCRIPT, step='assess'):
+            verdict = VERDICT_PASS
+            for unit in self.dpx_to_assess[seq]:
+                with metrics_utils.timed('rawcook_sequence_seconds', script=METRICS_SCRIPT, step='gap_check'):
+                    gaps = self.gap_check(unit)
+                if gaps:
+                    self.gap_units[seq] = unit
+                    return VERDICT_GAPS
+                if DPX_HEADER_CHECK:
+                    with metrics_utils.timed('rawcook_sequence_seconds', script=METRICS_SCRIPT, step='header_check'):
+                        headers_ok = self.check_dpx_headers(unit)
+                    if not headers_ok:
+                        return VERDICT_FAIL
+                with metrics_utils.timed('rawcook_sequence_seconds', script=METRICS_SCRIPT, step='v2_check'):
+                    needs_v2 = self.check_v2(unit)
+                if needs_v2:
+                    verdict = VERDICT_V2
+                    continue
+                with metrics_utils.timed('rawcook_sequence_seconds', script=METRICS_SCRIPT, step='policy_check'):
+                    policy_ok = self.check_mediaconch_policy(unit)
+                if not policy_ok:
+                    return VERDICT_FAIL
 
-    def move_passed_sequences(self) -> None:
-        """Moves the processed and passed DPX sequences into the dpx_to_cook folder
+            if FRAME_MANIFEST:
+                with metrics_utils.timed('rawcook_sequence_seconds', script=METRICS_SCRIPT, step='manifest'):
+                    self.build_frame_manifest(seq)
+            return verdict
 
-        Collects all the folder (DPX sequence) names from the temp_rawcooked_dpx_list.txt
-        Then moves them into dpx_to_cook folder
+    def build_frame_manifest(self, seq) -> None:
+        """Writes the per frame MD5 and BLAKE2b manifest of a sequence that is going to be cooked
 
-        Once all the passed files are moved, the remaining are the files that failed mediaconch policies
+        The manifest is stored next to the sequence as <seq>.manifest and travels with it to the cook folders
         """
-
-        dpx_folders_to_move = []
-        with open(self.temp_rawcooked_dpx_file, 'r') as file:
-            sorted_paths = file.read().splitlines()
-            dpx_folders_to_move.extend(sorted_paths)
-
-        for file_path in dpx_folders_to_move:
-            shutil.move(file_path, DPX_TO_COOK_PATH)
+        logging_utils.log(self.logfile, f"Building the frame manifest of {seq}")
+        manifest_path = manifest_utils.build_manifest(seq, MANIFEST_WORKERS)
+        logging_utils.log(self.logfile, f"Frame manifest written to {manifest_path}")
+
+    def route_sequence(self, seq, verdict) -> None:
+        """Moves a sequence to the folder matching its verdict and adds it to the respective temporary file
+
+        - VERDICT_GAPS: the dpx folder with gaps is moved to dpx_for_review, added to temp_review_dpx.txt. A multi reel
+          delivery is moved as a whole, as it is recorded in the ledger and would not be assessed again otherwise
+        - VERDICT_V2: moved to dpx_to_cook_v2, added to temp_rawcooked_v2_dpx_list.txt
+        - VERDICT_PASS: moved to dpx_to_cook, added to temp_rawcooked_dpx_list.txt
+        - VERDICT_FAIL: left in place, added to temp_tar_dpx_list.txt
+        The job state of the sequence becomes assessed for the cooked verdicts and review for the others
+        """
+        if verdict == VERDICT_GAPS:
+            unit = self.gap_units[seq]
+            if unit.path == seq:
+                dpath = Path(unit.info.path)
+                temp_file, move_path = self.temp_review_dpx_file, os.path.join(DPX_FOR_REVIEW_PATH, dpath.name)
+                source = dpath
+            else:
+                logging_utils.log(self.logfile, f"{unit.name} has gaps, the whole delivery {seq} is sent for review")
+                temp_file, move_path, source = self.temp_review_dpx_file, DPX_FOR_REVIEW_PATH, seq
+        elif verdict == VERDICT_V2:
+            temp_file, move_path, source = self.temp_rawcooked_v2_dpx_file, DPX_TO_COOK_V2_PATH, seq
+        elif verdict == VERDICT_PASS:
+            temp_file, move_path, source = self.temp_rawcooked_dpx_file, DPX_TO_COOK_PATH, seq
+        else:
+            temp_file, move_path, source = self.temp_tar_dpx_file, None, seq
+
+        with open(temp_file, 'a') as file:
+            file.write(f"{seq}\n")
+
+        if move_path is None:
+            self.job_state.transition(seq, job_state.STATE_REVIEW, verdict)
+            return
+        try:
+            new_path = move_utils.move_path(source, move_path, MOVE_WORKERS, MOVE_VERIFY_HASH)
+            logging_utils.log(self.logfile, f"MOVED {source} to {move_path}")
+            manifest_path = manifest_utils.manifest_path_for(source)
+            if os.path.exists(manifest_path):
+                move_utils.move_path(manifest_path, move_path, MOVE_WORKERS, MOVE_VERIFY_HASH)
+        except Exception as e:
+            logging_utils.log(self.logfile, f"ERROR moving {source} to {move_path}: {e}")
+            return
+
+        if verdict in (VERDICT_PASS, VERDICT_V2):
+            self.job_state.transition(new_path, job_state.STATE_ASSESSED, verdict)
+        else:
+            self.job_state.transition(seq, job_state.STATE_REVIEW, verdict)
+
+    def assess(self) -> None:
+        """Assesses all the sequences concurrently on a pool of ASSESS_WORKERS threads
+
+        The checks of each sequence are independent, they mostly wait for files and subprocesses so threads are enough
+        Every sequence is routed as soon as its own checks are done, without waiting for the rest of the drop
+        """
+        if not len(self.dpx_to_assess):
+            logging_utils.log(self.logfile, "Nothing to assess")
+            return
+
+        remaining = len(self.dpx_to_assess)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=ASSESS_WORKERS) as executor:
+            started = {}
+
+            def timed_assess(seq):
+                started[seq] = time.monotonic()
+                return self.assess_sequence(seq)
+
+            futures = {executor.submit(timed_assess, seq): seq for seq in self.dpx_to_assess.keys()}
+            for future in concurrent.futures.as_completed(futures):
+                seq = futures[future]
+                remaining -= 1
+                metrics_utils.set_gauge('rawcook_queue_depth', remaining, script=METRICS_SCRIPT, queue='to_assess')
+                with logging_utils.correlation(seq):
+                    try:
+                        verdict = future.result()
+                    except Exception as e:
+                        metrics_utils.inc('rawcook_sequences_total', script=METRICS_SCRIPT, outcome='error')
+                        logging_utils.log(self.logfile, f"ERROR while assessing {seq}: {e}")
+                        continue
+                    metrics_utils.inc('rawcook_sequences_total', script=METRICS_SCRIPT, outcome=verdict)
+                    logging_utils.log(self.logfile, f"{seq} assessed as {verdict} in "
+                                                    f"{time.monotonic() - started[seq]:.1f} s")
+                    with metrics_utils.timed('rawcook_sequence_seconds', script=METRICS_SCRIPT, step='route'):
+                        self.route_sequence(seq, verdict)
 
     def log_success_failure(self) -> None:
-        """Takes the value from the temporary files and stores them into the respective .log files
+        """Takes the value from the temporary files and records them in the ledger with the respective state
         """
-        logging_utils.write_permanent_logs(self.temp_rawcooked_dpx_file, self.success_file)
-        logging_utils.write_permanent_logs(self.temp_tar_dpx_file, self.failure_file)
-        logging_utils.write_permanent_logs(self.temp_review_dpx_file, self.review_file)
-        logging_utils.write_permanent_logs(self.temp_rawcooked_v2_dpx_file, self.rawcooked_v2_file)
+        self.ledger.record_from_file(self.temp_rawcooked_dpx_file, ledger_utils.STATE_SUCCESS)
+        self.ledger.record_from_file(self.temp_tar_dpx_file, ledger_utils.STATE_FAILURE)
+        self.ledger.record_from_file(self.temp_review_dpx_file, ledger_utils.STATE_REVIEW)
+        self.ledger.record_from_file(self.temp_rawcooked_v2_dpx_file, ledger_utils.STATE_V2)
 
     def clean(self) -> None:
         """Concludes the workflow by removing the temporary .txt files
         """
 
+        if self.ledger:
+            self.ledger.close()
+        if self.policy_cache:
+            self.policy_cache.close()
+        if self.job_state:
+            self.job_state.close()
+        if self.inventory:
+            self.inventory.close()
+        metrics_utils.write_textfile(METRICS_TEXTFILE_DIR, METRICS_SCRIPT)
+
         # Clean up temporary files
         for file_name in self.temp_files:
             if os.path.exists(file_name):
@@ -253,26 +466,27 @@ class DpxAssessment:
         """Executes the workflow step by step as:
 
         1. process(): Checks if .dpx files are present in the input folder and creates temporary files
-        2. find_dpx_to_check(): Finds the dpx files at any depth and returns a dict with <root_path, file_path> pairs
-        3. gap_check(): Checks if any dpx sequences have incoherent gaps and if so, moves them to dpx_to_review/gap_check_fails
-        3. check_v2(): It takes the dict and runs rawcooked to check if there is are large reversibility files
-                         Removes the sequence from the dict
-        4. check_mediaconch_policy(): Check a randomly chosen .dpx file from each sequence against mediaconch policies
-        5. move_v2_sequences(): Takes the list of large reversibility file sequences and moves them to dpx_to_cook_v2
-        6. move_passed_sequences(): Takes the list of all the passed sequences and moves them to dpx_to_cook folder
-        7. log_success_failure(): Logs the success or failure status
-        8. clean(): Cleans up the temporary files
+        2. find_dpx_to_check(): Finds the dpx folders at any depth and returns a dict with <root_path, work units> pairs
+        3. assess(): Runs the checks of every sequence concurrently, each sequence goes through
+            - gap_check(): Checks if the dpx sequence has incoherent gaps
+            - check_dpx_headers(): Checks the header of every frame for conformance and heterogeneity
+            - check_v2(): Runs rawcooked to check if there is a large reversibility file
+            - check_mediaconch_policy(): Checks a sample of .dpx files of the sequence against mediaconch policies
+           and is moved to dpx_for_review, dpx_to_cook_v2 or dpx_to_cook as soon as its verdict is known
+        4. log_success_failure(): Records the success or failure status in the ledger
+        5. clean(): Cleans up the temporary files and writes the metrics of the run to METRICS_TEXTFILE_DIR
+
+        The wall time of every step is recorded in the rawcook_stage_seconds metric
         """
 
         # TODO: Implement error handling mechanisms
         self.process()
-        self.find_dpx_to_assess()
-        self.gap_check()
-        self.check_v2()
-        self.check_mediaconch_policy()
-        self.move_v2_sequences()
-        self.move_passed_sequences()
-        self.log_success_failure()
+        with metrics_utils.stage(METRICS_SCRIPT, 'find'):
+            self.find_dpx_to_assess()
+        with metrics_utils.stage(METRICS_SCRIPT, 'assess'):
+            self.assess()
+        with metrics_utils.stage(METRICS_SCRIPT, 'log_success_failure'):
+            self.log_success_failure()
         self.clean()
 
 
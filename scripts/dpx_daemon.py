@@ -0,0 +1,184 @@
+import concurrent.futures
+import os
+import signal
+import time
+
+from dotenv import load_dotenv
+
+from scripts.dpx_assessment import DpxAssessment, DPX_PATH as DPX_ASSESS_PATH
+from scripts.dpx_post_rawcook import DpxPostRawcook, MKV_COOKED_PATH
+from scripts.dpx_rawcook import DpxRawcook, DPX_PATH as DPX_COOK_PATH, DPX_V2_PATH as DPX_COOK_V2_PATH
+from utils import logging_utils, shell_utils, watch_utils, metrics_utils, move_utils
+
+load_dotenv()
+
+SCRIPT_LOG = os.path.join(os.environ.get('FILM_OPS'), os.environ.get('DPX_SCRIPT_LOG'))
+
+# A delivery is handled once nothing in it has changed for this many seconds
+DAEMON_QUIET_SECONDS = float(os.environ.get('DAEMON_QUIET_SECONDS') or 120)
+# Longest wait for filesystem events, also the listing interval of the polling watcher
+DAEMON_POLL_SECONDS = float(os.environ.get('DAEMON_POLL_SECONDS') or 10)
+# auto tries inotify and falls back to polling, inotify or poll force one of them
+DAEMON_WATCHER = os.environ.get('DAEMON_WATCHER') or watch_utils.WATCHER_AUTO
+
+# Folder of the <script>.prom files read by the node_exporter textfile collector, see utils/metrics_utils.py
+METRICS_TEXTFILE_DIR = os.path.join(SCRIPT_LOG, os.environ.get('METRICS_TEXTFILE_DIR') or 'metrics')
+# The script label of the metrics, the subprocesses run by the stages are recorded under it too
+METRICS_SCRIPT = 'dpx_daemon'
+
+STAGE_ASSESS = 'assess'
+STAGE_COOK = 'cook'
+STAGE_POST = 'post'
+
+
+class DpxDaemon:
+    """Runs the three workflow scripts as an event driven pipeline instead of scheduled batches
+
+    Watches dpx_to_assess, dpx_to_cook, dpx_to_cook_v2 and mkv_cooked. Every new or changed entry is tracked until it
+    has been quiet for DAEMON_QUIET_SECONDS and is then handed to the stage of its folder:
+    - assess: DpxAssessment restricted to the ready sequences, which moves them to the cook folders
+    - cook: DpxRawcook restricted to the ready sequences, which writes the mkvs to mkv_cooked. The sequences it left
+      uncooked, e.g. deferred by the batch planner, short of space or claimed by another host, are tracked again and
+      form a later batch once quiet
+    - post: DpxPostRawcook over mkv_cooked, which skips the mkvs already verified
+    The stages run on their own threads so a long cook does not hold back the assessment of new deliveries. A stage
+    runs one batch at a time, the sequences that become ready meanwhile form its next batch. The post stage waits for
+    the cook stage to be idle so it never checks an mkv that is still being written.
+    The daemon serves the metrics of every stage on METRICS_PORT and writes dpx_daemon.prom after each batch.
+    """
+
+    def __init__(self):
+        self.logfile = os.path.join(SCRIPT_LOG, "dpx_daemon.log")
+        self.folders = {
+            DPX_ASSESS_PATH: STAGE_ASSESS,
+            DPX_COOK_PATH: STAGE_COOK,
+            DPX_COOK_V2_PATH: STAGE_COOK,
+            MKV_COOKED_PATH: STAGE_POST,
+        }
+        self.tracker = watch_utils.QuiescenceTracker(DAEMON_QUIET_SECONDS)
+        # <path, stage> of every tracked delivery
+        self.stages = {}
+        self.queues = {STAGE_ASSESS: set(), STAGE_COOK: set(), STAGE_POST: set()}
+        self.running = {}
+        # <stage, monotonic start time> of the running batches
+        self.started = {}
+        self.watcher = None
+        self.stopping = False
+
+    def stop(self, signum=None, frame=None) -> None:
+        """Stops the daemon after the running stages have finished"""
+        logging_utils.log(self.logfile, "Stop requested, waiting for running stages")
+        self.stopping = True
+
+    @staticmethod
+    def accepts(stage, folder, name) -> bool:
+        """Tells if a folder entry is a unit of work of a stage, the logs, lists, manifests and moves still being
+        copied are ignored
+        """
+        if move_utils.is_staging(name):
+            return False
+        path = os.path.join(folder, name)
+        if stage == STAGE_ASSESS:
+            return os.path.isdir(path) or name.endswith('.dpx')
+        if stage == STAGE_COOK:
+            return os.path.isdir(path)
+        return name.endswith('.mkv')
+
+    def track(self, changes) -> None:
+        """Starts or restarts the quiet period of every changed entry that belongs to a stage"""
+        for folder, name in changes:
+            stage = self.folders.get(folder)
+            if stage and self.accepts(stage, folder, name):
+                path = os.path.join(folder, name)
+                self.stages[path] = stage
+                self.tracker.touch(path)
+
+    def enqueue_ready(self) -> None:
+        """Moves the deliveries that have been quiet long enough to the queue of their stage"""
+        for path in self.tracker.check():
+            stage = self.stages.pop(path)
+            logging_utils.log(self.logfile, f"READY for {stage}: {path}", path)
+            self.queues[stage].add(path)
+        # Deliveries removed before they became quiet
+        for path in self.stages.keys() - self.tracker.pending.keys():
+            del self.stages[path]
+
+    def run_stage(self, stage, paths) -> list:
+        """Runs one batch of a stage, executed on the stage thread
+
+        @return: The paths the batch left for a later one
+        """
+        if stage == STAGE_ASSESS:
+            DpxAssessment(sequences=paths).execute()
+        elif stage == STAGE_COOK:
+            dpx_rawcook = DpxRawcook(sequences=paths)
+            dpx_rawcook.execute()
+            return dpx_rawcook.leftovers
+        else:
+            DpxPostRawcook().execute()
+        return []
+
+    def dispatch(self, executor) -> None:
+        """Collects the finished stages and starts a batch on every idle stage with queued work"""
+        for stage, future in list(self.running.items()):
+            if not future.done():
+                continue
+            del self.running[stage]
+            metrics_utils.observe('rawcook_stage_seconds', time.monotonic() - self.started.pop(stage),
+                                  script=METRICS_SCRIPT, stage=stage)
+            try:
+                leftovers = future.result()
+                logging_utils.log(self.logfile, f"FINISHED {stage} batch")
+            except (Exception, SystemExit) as e:
+                leftovers = []
+                logging_utils.log(self.logfile, f"ERROR in {stage} batch: {e!r}")
+            # Not cooked in this batch and no file event will bring them back, they wait for another quiet period
+            for path in leftovers:
+                logging_utils.log(self.logfile, f"REQUEUED for {stage}: {path}", path)
+                self.stages[path] = stage
+                self.tracker.touch(path)
+            metrics_utils.write_textfile(METRICS_TEXTFILE_DIR, METRICS_SCRIPT)
+
+        for stage, queue in self.queues.items():
+            if not queue or stage in self.running:
+                continue
+            if stage == STAGE_POST and STAGE_COOK in self.running:
+                continue
+            paths = sorted(queue)
+            queue.clear()
+            logging_utils.log(self.logfile, f"STARTING {stage} batch of {len(paths)}")
+            self.started[stage] = time.monotonic()
+            self.running[stage] = executor.submit(self.run_stage, stage, paths)
+
+        for stage, queue in self.queues.items():
+            metrics_utils.set_gauge('rawcook_queue_depth', len(queue), script=METRICS_SCRIPT, queue=stage)
+
+    def execute(self) -> None:
+        shell_utils.create_file(self.logfile)
+        logging_utils.log(self.logfile, "============= DPX daemon START =============")
+        metrics_utils.start(METRICS_SCRIPT, self.logfile)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        self.watcher = watch_utils.create_watcher(self.folders.keys(), DAEMON_WATCHER)
+        logging_utils.log(self.logfile, f"Watching {len(self.folders)} folders with "
+                                        f"{type(self.watcher).__name__}")
+
+        # Deliveries made while the daemon was down
+        self.track(watch_utils.scan_folders(self.folders.keys()))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.queues)) as executor:
+            try:
+                while not self.stopping:
+                    self.track(self.watcher.wait(DAEMON_POLL_SECONDS))
+                    self.enqueue_ready()
+                    self.dispatch(executor)
+            finally:
+                self.watcher.close()
+
+        logging_utils.log(self.logfile, "============= DPX daemon END =============")
+
+
+if __name__ == '__main__':
+    dpx_daemon = DpxDaemon()
+    dpx_daemon.execute()
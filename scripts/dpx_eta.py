@@ -0,0 +1,57 @@
+from scripts.dpx_rawcook import DPX_PATH, DPX_V2_PATH, MKV_DEST, COOK_WORKERS, COOK_MKV_RATIO, COOK_THROUGHPUT_MBS, \
+    COOK_HISTORY_DB, JOB_STATE_DB, SCAN_INVENTORY_DB
+from utils import cook_history, find_utils, job_state, plan_utils, scan_utils
+
+
+class DpxEta:
+    """Prints the predicted cook time and mkv size of every sequence waiting in dpx_to_cook and dpx_to_cook_v2
+
+    The predictions come from the cook history recorded by dpx_rawcook.py, see utils/cook_history.py. The totals
+    tell how long the queue takes on COOK_WORKERS workers and whether the predicted mkvs fit on the MKV volume.
+    """
+
+    def __init__(self):
+        self.history = cook_history.CookHistory(COOK_HISTORY_DB)
+        self.job_state = job_state.JobStateStore(JOB_STATE_DB)
+        self.inventory = scan_utils.ScanInventory(SCAN_INVENTORY_DB)
+
+    def pending(self) -> list:
+        """Returns (WorkUnit, v2) of every work unit not cooked yet, one per reel of the multi reel deliveries"""
+        sequences = []
+        for folder, v2 in ((DPX_V2_PATH, True), (DPX_PATH, False)):
+            for units in find_utils.find_dpx_units(folder, self.inventory).values():
+                for unit in units:
+                    self.job_state.alias(unit.path, unit.name)
+                    if self.job_state.state_of(unit.path) not in job_state.COOKED_STATES:
+                        sequences.append((unit, v2))
+        return sequences
+
+    def execute(self) -> None:
+        total_seconds = 0.0
+        total_mkv_bytes = 0
+        print(f"{'sequence':<40} {'version':>7} {'frames':>8} {'source GiB':>10} {'mkv GiB':>8} {'ETA min':>8} "
+              f"{'samples':>7}")
+        for unit, v2 in self.pending():
+            frames, source_bytes = unit.info.frames, unit.info.total_bytes
+            prediction = self.history.predict(cook_history.profile_of(unit.info.path), v2, source_bytes,
+                                              COOK_MKV_RATIO, COOK_THROUGHPUT_MBS * 1024 ** 2)
+            total_seconds += prediction.seconds
+            total_mkv_bytes += prediction.mkv_bytes
+            print(f"{unit.name:<40} {'V2' if v2 else 'V1':>7} {frames:>8} "
+                  f"{source_bytes / 1024 ** 3:>10.1f} {prediction.mkv_bytes / 1024 ** 3:>8.1f} "
+                  f"{prediction.seconds / 60:>8.0f} {prediction.samples:>7}")
+
+        free_bytes = plan_utils.free_space(MKV_DEST)
+        print(f"Queue: {total_seconds / 3600:.1f} hours of cooking, about {total_seconds / COOK_WORKERS / 3600:.1f} "
+              f"hours on {COOK_WORKERS} workers")
+        print(f"Predicted mkv size {total_mkv_bytes / 1024 ** 3:.1f} GiB, {free_bytes / 1024 ** 3:.1f} GiB free on "
+              f"{MKV_DEST}")
+
+        self.history.close()
+        self.job_state.close()
+        self.inventory.close()
+
+
+if __name__ == '__main__':
+    dpx_eta = DpxEta()
+    dpx_eta.execute()
@@ -1,15 +1,20 @@
-import shutil
+import concurrent.futures
 import mmap
 import sys
+import tempfile
 from datetime import datetime
 
+from utils import manifest_utils, job_state, metrics_utils, find_utils, scan_utils
+from utils.framemd5_utils import compare_framemd5
 from utils.logging_utils import log
 
 from dotenv import load_dotenv
 
 import os
 
-from utils.shell_utils import check_mediaconch_policy
+from utils.move_utils import move_path
+from utils.policy_cache import PolicyCache
+from utils.shell_utils import check_mediaconch_policies, run_streaming
 
 load_dotenv()
 
@@ -26,12 +31,52 @@ SCRIPT_LOG = os.path.join(os.environ.get('FILM_OPS'), os.environ.get('DPX_SCRIPT
 REVIEW_FAILS_PATH = os.path.join(os.environ.get('FILM_OPS'), os.environ.get('DPX_REVIEW'), 'post_rawcook_fails/')
 MKV_COOKED_PATH = os.path.join(MKV_DESTINATION, 'mkv_cooked/')
 
+# Number of mkv files given to each mediaconch invocation and number of processes running them
+POLICY_CHUNK_SIZE = int(os.environ.get('POLICY_CHUNK_SIZE') or 50)
+POLICY_WORKERS = int(os.environ.get('POLICY_WORKERS') or os.cpu_count() or 1)
+
+# Number of files copied in parallel when a move crosses filesystems, and whether each copy is hashed
+MOVE_WORKERS = int(os.environ.get('MOVE_WORKERS') or 4)
+MOVE_VERIFY_HASH = os.environ.get('MOVE_VERIFY_HASH', 'false').lower() in ('1', 'true', 'yes')
+
+# Number of mismatching frames reported per mkv before the framemd5 comparison stops
+FRAMEMD5_MAX_MISMATCHES = int(os.environ.get('FRAMEMD5_MAX_MISMATCHES') or 100)
+# Same setting as dpx_rawcook.py, when on every mkv must have the framemd5 of its verification decode
+COOK_VERIFY = os.environ.get('COOK_VERIFY', 'false').lower() in ('1', 'true', 'yes')
+# Printed by rawcooked once it checked the reversibility data of the mkv it has just written
+REVERSIBILITY_PASSED = b"Reversibility was checked, no issue detected."
+
+# Decode every mkv again and compare its frames with the manifest built by dpx_assessment.py
+ROUNDTRIP_VERIFY = os.environ.get('ROUNDTRIP_VERIFY', 'false').lower() in ('1', 'true', 'yes')
+MANIFEST_WORKERS = int(os.environ.get('MANIFEST_WORKERS') or 4)
+DPX_COOK_FOLDERS = [os.path.join(os.environ.get('FILM_OPS'), os.environ.get('DPX_COOK')),
+                    os.path.join(os.environ.get('FILM_OPS'), os.environ.get('DPX_COOK_V2'))]
+
+# Persistent cache of the mediaconch results, see utils/policy_cache.py
+POLICY_CACHE_PATH = os.path.join(SCRIPT_LOG, os.environ.get('POLICY_CACHE') or 'policy_cache.db')
+POLICY_CACHE_MAX_AGE_DAYS = float(os.environ.get('POLICY_CACHE_MAX_AGE_DAYS') or 30)
+POLICY_CACHE_MAX_ENTRIES = int(os.environ.get('POLICY_CACHE_MAX_ENTRIES') or 100000)
+
+# Per sequence state shared by the three scripts, see utils/job_state.py
+JOB_STATE_DB = os.path.join(SCRIPT_LOG, os.environ.get('JOB_STATE_DB') or 'job_state.db')
+# Folder inventory shared by the scripts, see utils/scan_utils.py
+SCAN_INVENTORY_DB = os.path.join(SCRIPT_LOG, os.environ.get('SCAN_INVENTORY_DB') or 'scan_inventory.db')
+
+# Folder of the <script>.prom files read by the node_exporter textfile collector, see utils/metrics_utils.py
+METRICS_TEXTFILE_DIR = os.path.join(SCRIPT_LOG, os.environ.get('METRICS_TEXTFILE_DIR') or 'metrics')
+# The script label of the metrics
+METRICS_SCRIPT = 'dpx_post_rawcook'
+
 
 class DpxPostRawcook:
     def __init__(self):
         self.logfile = os.path.join(SCRIPT_LOG, "dpx_post_rawcook.log")
         self.date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         self.temp_mediaconch_policy_fails_file = os.path.join(MKV_DESTINATION, "temp_mediaconch_policy_fails.txt")
+        self.job_state = None
+        self.inventory = None
+        # .mkv files whose frames could not be compared with their source, they are not marked verified
+        self.unverified = set()
 
     def process(self):
         """Initiates the Post Rawcooked Workflow
@@ -47,6 +92,7 @@ class DpxPostRawcook:
         if any(os.scandir(MKV_DESTINATION + 'mkv_cooked/')):
             log(self.logfile, "===================== Post-RAWcook workflows STARTED =====================")
             log(self.logfile, "Files present in mkv_cooked folder, checking if ready for processing...")
+            metrics_utils.start(METRICS_SCRIPT, self.logfile)
         else:
             print("MKV folder empty, script exiting")
             sys.exit(1)
@@ -54,33 +100,67 @@ class DpxPostRawcook:
         with open(self.temp_mediaconch_policy_fails_file, 'w+'):
             pass
 
+        self.job_state = job_state.JobStateStore(JOB_STATE_DB)
+        self.inventory = scan_utils.ScanInventory(SCAN_INVENTORY_DB)
+
+    def mkv_files_to_check(self):
+        """Returns the .mkv files of mkv_cooked that the job state does not record as verified yet
+
+        The .mkv files still being written, possibly by another cook host, are left for the next run
+        """
+        with os.scandir(MKV_COOKED_PATH) as entries:
+            mkv_file_paths = [entry.path for entry in entries if entry.name.endswith(".mkv")]
+        return [mkv_file_path for mkv_file_path in mkv_file_paths
+                if self.job_state.state_of(mkv_file_path[:-len(".mkv")]) not in (job_state.STATE_COOKING,
+                                                                                  job_state.STATE_VERIFIED,
+                                                                                  job_state.STATE_COMPLETED)]
+
     def check_mediaconch_policies(self):
         """For every .mkv files it checks against a policy using mediaconch
 
         Scans through the mkv_cooked folder for .mkv files and run mediaconch
+        The files are checked in batches of POLICY_CHUNK_SIZE per mediaconch invocation over POLICY_WORKERS processes
+        Files unchanged since they were last checked against the same policy reuse the cached result
         If a file fails the check, the path of that file and the respective .mkv.txt file gets appended into a
         temporary .txt file named temp_mediaconch_policy_fails.txt
         """
-        with os.scandir(MKV_COOKED_PATH) as entries:
-            for entry in entries:
-                file_name = entry.name
-                if file_name.endswith(".mkv"):
-                    file_path = entry.path
-                    mediaconch_output = check_mediaconch_policy(MKV_POLICY, file_path)
-                    standard_output = mediaconch_output.stdout.decode()
-                    if "pass!" in standard_output:  # check_str.startswith('pass!'):
-                        log(self.logfile,
-                            f"PASS: RAWcooked MKV file {file_name} has passed the Mediaconch policy")
-                    else:
-                        log(self.logfile, f"FAIL: RAWcooked MKV {file_name} has failed the mediaconch policy")
-                        log(self.logfile, f"MEDIACONCH_FAILED_RESULT: {mediaconch_output}")
-
-                        # Write both the failed mkv file along with the corresponding txt file
-                        with open(self.temp_mediaconch_policy_fails_file, "a+") as file:
-                            txt_file_name = f"{file_name}.txt"
-                            txt_file_path = os.path.join(MKV_COOKED_PATH, txt_file_name)
-                            file.write(f"{file_path}\n")
-                            file.write(f"{txt_file_path}\n")
+        mkv_file_paths = self.mkv_files_to_check()
+        metrics_utils.set_gauge('rawcook_queue_depth', len(mkv_file_paths), script=METRICS_SCRIPT, queue='to_check')
+
+        cache = PolicyCache(POLICY_CACHE_PATH, POLICY_CACHE_MAX_AGE_DAYS, POLICY_CACHE_MAX_ENTRIES)
+        try:
+            results = check_mediaconch_policies(MKV_POLICY, mkv_file_paths, chunk_size=POLICY_CHUNK_SIZE,
+                                                workers=POLICY_WORKERS, cache=cache)
+        finally:
+            cache.close()
+        for file_path in mkv_file_paths:
+            file_name = os.path.basename(file_path)
+            result = results[file_path]
+            if result.passed:
+                log(self.logfile,
+                    f"PASS: RAWcooked MKV file {file_name} has passed the Mediaconch policy")
+            else:
+                log(self.logfile, f"FAIL: RAWcooked MKV {file_name} has failed the mediaconch policy")
+                log(self.logfile, f"MEDIACONCH_FAILED_RESULT: {result.outcome} {result.failed_rules}")
+
+                # Write both the failed mkv file along with the corresponding txt file
+                with open(self.temp_mediaconch_policy_fails_file, "a+") as file:
+                    txt_file_name = f"{file_name}.txt"
+                    txt_file_path = os.path.join(MKV_COOKED_PATH, txt_file_name)
+                    file.write(f"{file_path}\n")
+                    file.write(f"{txt_file_path}\n")
+
+    def move_for_review(self, file_path):
+        """Moves a .mkv file to dpx_for_review/post_rawcook_fails/mkv_files/ and any of its log files to
+        dpx_for_review/post_rawcook_fails/rawcook_output_logs/
+
+        The sequence of a moved .mkv file is marked review in the job state
+        """
+        if file_path.endswith(".mkv"):
+            self.job_state.transition(file_path[:-len(".mkv")], job_state.STATE_REVIEW, 'post rawcook checks failed')
+            metrics_utils.inc('rawcook_sequences_total', script=METRICS_SCRIPT, outcome='review')
+        folder = 'mkv_files/' if file_path.endswith(".mkv") else 'rawcook_output_logs/'
+        move_path(file_path, os.path.join(REVIEW_FAILS_PATH, folder), MOVE_WORKERS, MOVE_VERIFY_HASH)
 
     def move_failed_files(self):
         """Moves the failed mkv file and its corresponding txt file into dpx_for_review/post_rawcook_fails/
@@ -95,9 +175,9 @@ class DpxPostRawcook:
                 file_path = file_path.strip()
                 if file_path.endswith(".mkv"):
                     print(file_path)
-                    shutil.move(file_path, os.path.join(REVIEW_FAILS_PATH, 'mkv_files/'))
+                    self.move_for_review(file_path)
                 elif file_path.endswith(".txt"):
-                    shutil.move(file_path, os.path.join(REVIEW_FAILS_PATH, 'rawcook_output_logs/'))
+                    self.move_for_review(file_path)
 
     def check_general_errors(self):
         """Checks the mediaconch passed .mkv files for any other RAWCooked errors
@@ -129,23 +209,204 @@ class DpxPostRawcook:
             mkv_file_path = txt_file_path.replace('.txt', '')
             log(self.logfile, f"UNKNOWN ENCODING ERROR: {mkv_file_name} encountered error")
             log(self.logfile, f"Moving {mkv_file_name} and {mkv_file_name}.txt for manual review")
-            shutil.move(mkv_file_path, os.path.join(REVIEW_FAILS_PATH, 'mkv_files/'))
-            shutil.move(txt_file_path, os.path.join(REVIEW_FAILS_PATH, 'rawcook_output_logs/'))
+            self.move_for_review(mkv_file_path)
+            self.move_for_review(txt_file_path)
+
+    @staticmethod
+    def find_source_framemd5(seq_name):
+        """Returns the path of the <sequence>.framemd5 written during the cook, None if missing
+        """
+        for folder in DPX_COOK_FOLDERS:
+            framemd5_path = os.path.join(folder, f"{seq_name}.framemd5")
+            if os.path.exists(framemd5_path):
+                return framemd5_path
+        return None
+
+    def check_framemd5(self):
+        """Compares the framemd5 of every decoded .mkv with the framemd5 of its source sequence
+
+        The <mkv>.mkv.framemd5 is written by the verification stage of dpx_rawcook.py (COOK_VERIFY) and the
+        <sequence>.framemd5 by the cook itself. Both text files are compared line by line, on a pool of threads when
+        there are several mkv files. The exact mismatching frames are logged and the .mkv files with a mismatch
+        are moved to dpx_for_review/post_rawcook_fails/
+        With COOK_VERIFY off there is no decode to compare, an .mkv is then verified on the reversibility check
+        rawcooked runs at the end of every cook and must have reported no issue in its .mkv.txt. With COOK_VERIFY on,
+        an .mkv without both framemd5 files is not marked verified and is checked again by the next run
+        """
+        mkv_file_paths = self.mkv_files_to_check()
+
+        pairs = {}
+        for mkv_file_path in mkv_file_paths:
+            seq_name = os.path.basename(mkv_file_path)[:-len(".mkv")]
+            source_framemd5 = self.find_source_framemd5(seq_name)
+            mkv_framemd5 = f"{mkv_file_path}.framemd5"
+            if source_framemd5 is not None and os.path.exists(mkv_framemd5):
+                pairs[mkv_file_path] = (source_framemd5, mkv_framemd5)
+            elif COOK_VERIFY:
+                log(self.logfile, f"No framemd5 pair found for {seq_name}, frames not verified, it is not marked "
+                                  f"verified")
+                self.unverified.add(mkv_file_path)
+            elif not self.reversibility_passed(mkv_file_path):
+                log(self.logfile, f"No reversibility check reported for {seq_name} by rawcooked, it is not marked "
+                                  f"verified")
+                self.unverified.add(mkv_file_path)
+
+        if not pairs:
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=POLICY_WORKERS) as executor:
+            futures = {executor.submit(compare_framemd5, source, target, FRAMEMD5_MAX_MISMATCHES): mkv_file_path
+                       for mkv_file_path, (source, target) in pairs.items()}
+            for future in concurrent.futures.as_completed(futures):
+                mkv_file_path = futures[future]
+                mkv_file_name = os.path.basename(mkv_file_path)
+                mismatches = future.result()
+                if not mismatches:
+                    log(self.logfile, f"PASS: framemd5 of {mkv_file_name} matches its source sequence")
+                    continue
+
+                log(self.logfile, f"FAIL: framemd5 of {mkv_file_name} does not match its source sequence")
+                for stream, index, reason in mismatches:
+                    log(self.logfile, f"FRAMEMD5 MISMATCH: {mkv_file_name} stream {stream} frame {index}: {reason}")
+                self.move_for_review(mkv_file_path)
+                for log_file_path in (f"{mkv_file_path}.txt", f"{mkv_file_path}.framemd5"):
+                    if os.path.exists(log_file_path):
+                        self.move_for_review(log_file_path)
+
+    @staticmethod
+    def reversibility_passed(mkv_file_path) -> bool:
+        """Tells if the console output of the cook of an .mkv reports a reversibility check without issue"""
+        txt_file_path = f"{mkv_file_path}.txt"
+        if not os.path.exists(txt_file_path) or os.path.getsize(txt_file_path) == 0:
+            return False
+        with open(txt_file_path, 'rb', 0) as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as content:
+                return content.find(REVERSIBILITY_PASSED) != -1
+
+    @staticmethod
+    def find_manifest(seq_name):
+        """Returns the path of the frame manifest of a sequence in dpx_to_cook or dpx_to_cook_v2, None if missing
+        """
+        for folder in DPX_COOK_FOLDERS:
+            manifest_path = manifest_utils.manifest_path_for(os.path.join(folder, seq_name))
+            if os.path.exists(manifest_path):
+                return manifest_path
+        return None
+
+    def verify_round_trip(self):
+        """Decodes the remaining .mkv files and compares the frames with the manifest built during the assessment
+
+        Only runs when ROUNDTRIP_VERIFY is enabled, the <sequence>.manifest is read next to the source sequence in
+        dpx_to_cook or dpx_to_cook_v2, the source itself is not hashed again. An .mkv without manifest, e.g. a reel of
+        a multi reel delivery, is not marked verified
+        The decoded frames are written to a temporary folder that is removed once they are compared
+        Mismatching .mkv files are moved to dpx_for_review/post_rawcook_fails/ like the other errors
+        """
+        if not ROUNDTRIP_VERIFY:
+            return
+
+        mkv_file_paths = self.mkv_files_to_check()
+
+        for mkv_file_path in mkv_file_paths:
+            seq_name = os.path.basename(mkv_file_path)[:-len(".mkv")]
+            manifest_path = self.find_manifest(seq_name)
+            if manifest_path is None:
+                log(self.logfile, f"No frame manifest found for {seq_name}, round trip not verified, it is not marked "
+                                  f"verified")
+                self.unverified.add(mkv_file_path)
+                continue
+
+            with tempfile.TemporaryDirectory(prefix=f"{seq_name}_decode_", dir=MKV_DESTINATION) as decode_folder, \
+                    metrics_utils.timed('rawcook_sequence_seconds', script=METRICS_SCRIPT, step='round_trip'):
+                run_streaming(['rawcooked', '-y', mkv_file_path, '-o', decode_folder])
+                # rawcooked recreates the sequence folder inside the output folder
+                decoded_seq = os.path.join(decode_folder, seq_name)
+                decoded_root = decoded_seq if os.path.isdir(decoded_seq) else decode_folder
+                mismatches = manifest_utils.verify_folder(decoded_root, manifest_path, MANIFEST_WORKERS)
+
+            if not mismatches:
+                log(self.logfile, f"PASS: {seq_name} decodes to the frames of its manifest")
+                continue
+
+            log(self.logfile, f"FAIL: {seq_name} does not decode to the frames of its manifest, "
+                              f"{len(mismatches)} mismatches")
+            for relative_path, reason in mismatches[:20]:
+                log(self.logfile, f"ROUND TRIP MISMATCH: {seq_name}/{relative_path}: {reason}")
+            self.move_for_review(mkv_file_path)
+            txt_file_path = f"{mkv_file_path}.txt"
+            if os.path.exists(txt_file_path):
+                self.move_for_review(txt_file_path)
+
+    def mark_verified(self):
+        """Marks the sequence of every .mkv file left in mkv_cooked as verified in the job state
+
+        The files failing any of the previous checks have been moved for review, the remaining ones passed them all
+        so the next run does not check them again
+        An mkv without a job, e.g. cooked before the job state existed, is registered as cooked first
+        The mkv files whose framemd5 could not be compared stay cooked and are checked again by the next run
+        """
+        for mkv_file_path in self.mkv_files_to_check():
+            if mkv_file_path in self.unverified:
+                continue
+            seq_path = mkv_file_path[:-len(".mkv")]
+            if self.job_state.state_of(seq_path) is None:
+                self.job_state.transition(seq_path, job_state.STATE_COOKED, 'found in mkv_cooked')
+            if self.job_state.transition(seq_path, job_state.STATE_VERIFIED):
+                metrics_utils.inc('rawcook_sequences_total', script=METRICS_SCRIPT, outcome='verified')
+                log(self.logfile, f"VERIFIED: {os.path.basename(mkv_file_path)} passed every post rawcook check")
+            else:
+                log(self.logfile, f"WARNING: {os.path.basename(mkv_file_path)} passed the checks but is "
+                                  f"{self.job_state.state_of(seq_path)}, it is not marked verified")
+        metrics_utils.set_gauge('rawcook_queue_depth', 0, script=METRICS_SCRIPT, queue='to_check')
+
+    def complete_verified(self):
+        """Moves the deliveries of the cook folders whose every DPX folder is verified to dpx_completed
+
+        Their frame manifest and the .framemd5 of their DPX folders go with them and their job state becomes completed
+        A multi reel delivery waits for the mkv of each of its reels
+        """
+        for folder in DPX_COOK_FOLDERS:
+            for seq_path, units in find_utils.find_dpx_units(folder, self.inventory).items():
+                for unit in units:
+                    self.job_state.alias(unit.path, unit.name)
+                if any(self.job_state.state_of(unit.path) != job_state.STATE_VERIFIED for unit in units):
+                    continue
+                try:
+                    new_path = move_path(seq_path, DPX_DEST, MOVE_WORKERS, MOVE_VERIFY_HASH)
+                    for file_path in [manifest_utils.manifest_path_for(seq_path)] + \
+                            [os.path.join(folder, f"{unit.name}.framemd5") for unit in units]:
+                        if os.path.exists(file_path):
+                            move_path(file_path, DPX_DEST, MOVE_WORKERS, MOVE_VERIFY_HASH)
+                except Exception as e:
+                    log(self.logfile, f"ERROR moving {seq_path} to {DPX_DEST}: {e}")
+                    continue
+                for unit in units:
+                    unit_path = os.path.normpath(os.path.join(new_path, os.path.relpath(unit.path, seq_path)))
+                    self.job_state.alias(unit_path, unit.name)
+                    self.job_state.transition(unit_path, job_state.STATE_COMPLETED, 'moved to dpx_completed')
+                metrics_utils.inc('rawcook_sequences_total', script=METRICS_SCRIPT, outcome='completed')
+                log(self.logfile, f"COMPLETED: {seq_path} moved to {DPX_DEST}")
 
     def clean(self):
         """Concludes the workflow
 
-        Deletes all the temporary .txt files created during the workflow
+        Deletes all the temporary .txt files created during the workflow and writes the metrics of the run
         """
         log(self.logfile, f"Concluding workflow by deleting temporary files")
         os.remove(self.temp_mediaconch_policy_fails_file)
+        if self.job_state:
+            self.job_state.close()
+        if self.inventory:
+            self.inventory.close()
+        metrics_utils.write_textfile(METRICS_TEXTFILE_DIR, METRICS_SCRIPT)
         log(self.logfile, f"============= DPX Post-RAWcook workflow ENDED =============")
 
     def execute(self):
         self.process()
-        self.check_mediaconch_policies()
-        self.move_failed_files()
-        self.check_general_errors()
+        for step in (self.check_mediaconch_policies, self.move_failed_files, self.check_general_errors,
+                     self.check_framemd5, self.verify_round_trip, self.mark_verified, self.complete_verified):
+            with metrics_utils.stage(METRICS_SCRIPT, step.__name__):
+                step()
         self.clean()
 
 
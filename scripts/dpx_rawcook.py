@@ -1,12 +1,13 @@
 import concurrent.futures
 import itertools
 import os
-import shutil
-import subprocess
+import time
+from typing import NamedTuple
 
 from dotenv import load_dotenv
 
-from utils import logging_utils, find_utils, shell_utils
+from utils import logging_utils, find_utils, shell_utils, plan_utils, manifest_utils, move_utils, job_state, \
+    cook_history, scan_utils, lease_utils, metrics_utils
 
 load_dotenv()
 
@@ -22,59 +23,197 @@ DPX_PATH = r'{}'.format(DPX_PATH)
 DPX_V2_PATH = r'{}'.format(DPX_V2_PATH)
 MKV_DEST = r'{}'.format(MKV_DEST)
 
+# Number of sequences cooked at the same time, defaults to one per CPU core
+COOK_WORKERS = int(os.environ.get('COOK_WORKERS') or os.cpu_count() or 1)
+# Decode every cooked .mkv once more with rawcooked --check after the cook, dpx_post_rawcook.py then compares the
+# framemd5 of this decode with the one of the cook. Off by default, it reads the whole mkv again and about doubles the
+# time of a cook
+COOK_VERIFY = os.environ.get('COOK_VERIFY', 'false').lower() in ('1', 'true', 'yes')
+
+# A cook printing nothing for this many minutes is killed as stalled, 0 disables the check
+COOK_STALL_MINUTES = float(os.environ.get('COOK_STALL_MINUTES') or 30)
+# A cook running longer than this many hours is killed, 0 disables the limit
+COOK_TIMEOUT_HOURS = float(os.environ.get('COOK_TIMEOUT_HOURS') or 0)
+
+# Number of files copied in parallel when a move crosses filesystems, and whether each copy is hashed
+MOVE_WORKERS = int(os.environ.get('MOVE_WORKERS') or 4)
+MOVE_VERIFY_HASH = os.environ.get('MOVE_VERIFY_HASH', 'false').lower() in ('1', 'true', 'yes')
+
+# Batch planner settings, see utils/plan_utils.py
+COOK_BATCH_ORDER = os.environ.get('COOK_BATCH_ORDER') or plan_utils.ORDER_LARGEST_FIRST
+COOK_BATCH_MAX_COUNT = int(os.environ.get('COOK_BATCH_MAX_COUNT') or 20)
+COOK_BATCH_MAX_GB = float(os.environ.get('COOK_BATCH_MAX_GB') or 0)
+COOK_BATCH_MAX_HOURS = float(os.environ.get('COOK_BATCH_MAX_HOURS') or 0)
+# Cooking speed of a single worker in MiB/s when there is no cook history yet, used to estimate cook durations
+COOK_THROUGHPUT_MBS = float(os.environ.get('COOK_THROUGHPUT_MBS') or 100)
+# Expected mkv size relative to the DPX sequence when there is no cook history yet
+COOK_MKV_RATIO = float(os.environ.get('COOK_MKV_RATIO') or 1.0)
+
+# Admission control, see plan_utils.SpaceAdmission and utils/cook_history.py
+COOK_HISTORY_DB = os.path.join(SCRIPT_LOG, os.environ.get('COOK_HISTORY_DB') or 'cook_history.db')
+# Safety margin applied to the mkv size predicted from the history
+COOK_SPACE_MARGIN = float(os.environ.get('COOK_SPACE_MARGIN') or 1.1)
+# Space always left free on the MKV volume
+COOK_SPACE_HEADROOM_GB = float(os.environ.get('COOK_SPACE_HEADROOM_GB') or 10)
+# Interval between two checks of the free space while cooks wait for it
+COOK_ADMISSION_POLL_SECONDS = float(os.environ.get('COOK_ADMISSION_POLL_SECONDS') or 60)
+# Cooks still waiting for space after this many minutes are left for the next run, 0 waits forever
+COOK_ADMISSION_MAX_WAIT_MINUTES = float(os.environ.get('COOK_ADMISSION_MAX_WAIT_MINUTES') or 60)
+
+# Per sequence state shared by the three scripts, see utils/job_state.py
+JOB_STATE_DB = os.path.join(SCRIPT_LOG, os.environ.get('JOB_STATE_DB') or 'job_state.db')
+# Folder inventory shared by the scripts, see utils/scan_utils.py
+SCAN_INVENTORY_DB = os.path.join(SCRIPT_LOG, os.environ.get('SCAN_INVENTORY_DB') or 'scan_inventory.db')
+
+# Lease based claims letting several hosts cook from the same FILM_OPS tree, see utils/lease_utils.py
+# Each host cooks at most COOK_WORKERS sequences at a time
+COOK_NODE_NAME = os.environ.get('COOK_NODE_NAME') or lease_utils.default_node_name()
+COOK_LEASE_FOLDER = os.path.join(SCRIPT_LOG, os.environ.get('COOK_LEASE_FOLDER') or 'cook_leases')
+# A claim whose host sent no heartbeat for this many seconds is taken over by the other hosts
+COOK_LEASE_SECONDS = float(os.environ.get('COOK_LEASE_SECONDS') or 300)
+
+# Folder of the <script>.prom files read by the node_exporter textfile collector, see utils/metrics_utils.py
+METRICS_TEXTFILE_DIR = os.path.join(SCRIPT_LOG, os.environ.get('METRICS_TEXTFILE_DIR') or 'metrics')
+# The script label of the metrics
+METRICS_SCRIPT = 'dpx_rawcook'
+
+
+class CookOutcome(NamedTuple):
+    """Result of cook_sequence() sent back by the cook worker"""
+    ok: bool
+    # The lease of the sequence was taken over by another host and the cook was stopped
+    lease_lost: bool
+    # Wall time of the rawcooked run alone, without the COOK_VERIFY decode nor the wait for a worker
+    cook_seconds: float
+    # Metrics recorded by the worker, merged by the parent process
+    metrics: dict
+
 
 class DpxRawcook:
 
-    def __init__(self):
+    def __init__(self, sequences=None):
+        # Restricts the run to these sequence paths, None cooks everything in dpx_to_cook and dpx_to_cook_v2
+        self.sequences = None if sequences is None else set(sequences)
+
         self.logfile = os.path.join(SCRIPT_LOG, "dpx_rawcook.log")
         self.rawcooked_v1_success_log = os.path.join(MKV_DEST, 'rawcooked_dpx_v1_success.log')
         self.rawcooked_v2_success_log = os.path.join(MKV_DEST, 'rawcooked_dpx_v2_success.log')
         self.review_dpx_failure_log = os.path.join(MKV_DEST, 'review_dpx_failure.log')
 
-        self.temp_rawcooked_v1_file = os.path.join(MKV_DEST, "temp_rawcooked_v1_list.txt")
-        self.temp_rawcooked_v2_file = os.path.join(MKV_DEST, "temp_rawcooked_v2_list.txt")
-        self.temp_review_file = os.path.join(MKV_DEST, "temp_review_list.txt")
+        # The lists of each run are its own, other hosts and runs sharing MKV_DEST keep theirs under another name
+        run_suffix = f"{COOK_NODE_NAME}.{os.getpid()}"
+        self.temp_rawcooked_v1_file = os.path.join(MKV_DEST, f"temp_rawcooked_v1_list.{run_suffix}.txt")
+        self.temp_rawcooked_v2_file = os.path.join(MKV_DEST, f"temp_rawcooked_v2_list.{run_suffix}.txt")
+        self.temp_review_file = os.path.join(MKV_DEST, f"temp_review_list.{run_suffix}.txt")
 
         self.file_names = [self.temp_rawcooked_v1_file, self.temp_rawcooked_v2_file, self.temp_review_file]
 
         self.mkv_cooked_folder = os.path.join(MKV_DEST, "mkv_cooked/")
 
-    def rawcooked_command_executor(self, start_folder_path: str, mkv_file_name: str, md5_checksum: bool = False,
-                                   v2: bool = False) -> None:
+        # Sequences found by pass_one() and pass_two(), plan() picks the candidates consumed by cook()
+        self.cook_candidates = []
+        self.cook_jobs = []
+        # <sequence path, SequenceProfile> of the candidates, recorded in the history once cooked
+        self.profiles = {}
+        # <sequence path, CookCandidate> of the candidates, the reels of a multi reel delivery are separate candidates
+        self.candidates = {}
+        # <unit path, (delivery path, list of WorkUnit)> of every unit found, a failing reel sends its whole delivery
+        # to review
+        self.deliveries = {}
+        # Deliveries with units still waiting to be cooked once the run is over, see unfinished()
+        self.leftovers = []
+        self.job_state = None
+        self.history = None
+        self.inventory = None
+        self.leases = None
+        # The process holding the leases, checked by the cook workers, and the leases lost to other hosts meanwhile
+        self.lease_owner_pid = None
+        self.lost_leases = set()
+
+    def __getstate__(self):
+        # The cooking pool pickles self for every job, the SQLite connections and the leases stay in the parent process
+        state = self.__dict__.copy()
+        state['job_state'] = None
+        state['history'] = None
+        state['inventory'] = None
+        state['leases'] = None
+        return state
+
+    def name_for(self, seq_path: str) -> str:
+        """Returns the name of the mkv of a sequence, the name of its work unit for the reels of a multi reel delivery"""
+        candidate = self.candidates.get(seq_path)
+        return candidate.mkv_name if candidate else os.path.basename(seq_path)
+
+    def mkv_path_for(self, seq_path: str) -> str:
+        return os.path.join(self.mkv_cooked_folder, f"{self.name_for(seq_path)}.mkv")
+
+    def framemd5_path_for(self, seq_path: str) -> str:
+        """Returns the path of the <sequence>.framemd5 written by the cook, next to the delivery in its cook folder"""
+        candidate = self.candidates.get(seq_path)
+        if candidate is None:
+            return f"{seq_path}.framemd5"
+        return os.path.join(DPX_V2_PATH if candidate.v2 else DPX_PATH, f"{candidate.mkv_name}.framemd5")
+
+    def rawcooked_command_executor(self, start_folder_path: str, mkv_file_name: str, v2: bool = False,
+                                   should_stop=None) -> bool:
         """The method passed to each process that executes rawcooked command
 
         Runs rawcooked command with respective parameters
-        Stores the rawcooked console output to a .txt  file named as <mkv_file_name>.mkv.txt
+        A single run produces the .mkv and the <sequence>.framemd5 file together thanks to the --framemd5 flag
+        The .framemd5 is named after the mkv and written to the cook folder, where dpx_post_rawcook.py looks for it
+        Streams the rawcooked console output to a .txt  file named as <mkv_file_name>.mkv.txt
+        Kills the cook if it prints nothing for COOK_STALL_MINUTES or runs longer than COOK_TIMEOUT_HOURS, or as soon
+        as should_stop returns True, i.e. the lease of the sequence was taken over by another host
         Checks if there are gaps in output v2 sequence, then that sequence is added to temp_review_list.txt
+        Returns True if rawcooked exited without error
         """
 
-        string_command = f"rawcooked --license 004B159A2BDB07331B8F2FDF4B2F -y --all --no-accept-gaps {'--output-version 2' if v2 else ''} -s 5281680 {'--framemd5' if md5_checksum else ''} {start_folder_path} -o {MKV_DEST}mkv_cooked/{mkv_file_name}.mkv"
+        string_command = f"rawcooked --license 004B159A2BDB07331B8F2FDF4B2F -y --all --no-accept-gaps {'--output-version 2' if v2 else ''} -s 5281680 --framemd5 --framemd5-name {self.framemd5_path_for(start_folder_path)} {start_folder_path} -o {MKV_DEST}mkv_cooked/{mkv_file_name}.mkv"
         output_txt_file = f"{MKV_DEST}mkv_cooked/{mkv_file_name}.mkv.txt"
         command = string_command.split(" ")
         command = [c for c in command if len(c) > 0]
         command = list(command)
         print(command)
-        subprocess_logs = []
-        with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True) as p:
-            for line in p.stderr:
-                subprocess_logs.append(line)
-                print(f"{mkv_file_name} : {line}")
-            for line in p.stdout:
-                subprocess_logs.append(line)
-                print(f"{mkv_file_name} : {line}")
-
-        std_logs = ''.join(subprocess_logs)
-        with open(output_txt_file, 'a+') as file:
-            file.write(std_logs)
+        last_step = -1
+
+        def on_progress(progress):
+            # Only log every 10%, rawcooked refreshes its progress line many times per second
+            nonlocal last_step
+            step = int(progress.get('percent', 0)) // 10
+            if step != last_step:
+                last_step = step
+                logging_utils.log(self.logfile, f"PROGRESS: {mkv_file_name} {progress.get('percent', 0)}% done, "
+                                                f"{progress.get('fps', 0)} fps")
+
+        result = shell_utils.run_streaming(command, log_file=output_txt_file, prefix=mkv_file_name,
+                                           watch_patterns=['Warning: incoherent file names'],
+                                           stall_timeout=COOK_STALL_MINUTES * 60 or None,
+                                           timeout=COOK_TIMEOUT_HOURS * 3600 or None,
+                                           on_progress=on_progress, should_stop=should_stop)
+
+        # The host that took the lease over writes the same .mkv and .mkv.txt, they are left to it
+        if result.cancelled:
+            logging_utils.log(self.logfile, f"STOPPED: cook of {start_folder_path}, its lease was taken over by "
+                                            f"another host")
+            return False
+
+        # A killed cook leaves a partial .mkv, the Error: line makes dpx_post_rawcook.py send it for review
+        if result.stalled or result.timed_out:
+            reason = 'stalled' if result.stalled else 'timed out'
+            logging_utils.log(self.logfile, f"FAIL: cook of {start_folder_path} {reason}, rawcooked was killed")
+            with open(output_txt_file, 'a') as file:
+                file.write(f"Error: encoding {reason}, rawcooked was killed\n")
 
         # If Rawcooked is executed using output v2 and a gap is found
-        if v2 and std_logs.find('Warning: incoherent file names') != -1:
+        if v2 and 'Warning: incoherent file names' in result.matched:
             logging_utils.log(self.logfile,
                               f"FAIL: {start_folder_path} CONTAINS INCOHERENT SEQUENCES. Adding to "
                               f"temp_review_dpx_list.txt")
             with open(self.temp_review_file, 'a') as file:
                 file.write(f"{start_folder_path}\n")
 
+        return result.returncode == 0 and not result.killed
+
     def process(self) -> None:
         """Initiates the workflow
 
@@ -91,79 +230,366 @@ class DpxRawcook:
 
         # Write a START note to the logfile if files for encoding, else exit
         logging_utils.log(self.logfile, "============= DPX RAWcook script START =============")
+        metrics_utils.start(METRICS_SCRIPT, self.logfile)
+
+        # Sequences left in cooking by a crashed run are cooked again, unless another host still holds their lease
+        self.leases = lease_utils.LeaseManager(COOK_LEASE_FOLDER, COOK_NODE_NAME, COOK_LEASE_SECONDS)
+        self.lease_owner_pid = self.leases.pid
+        self.leases.start_heartbeat(on_lost=self.lease_lost, on_error=self.lease_error)
+        self.job_state = job_state.JobStateStore(JOB_STATE_DB)
+        for name in self.job_state.reset_interrupted_cooks(lambda name: self.leases.holder(name) is not None):
+            logging_utils.log(self.logfile, f"RESUMING: the cook of {name} was interrupted, it will be cooked again")
+
+        self.history = cook_history.CookHistory(COOK_HISTORY_DB)
+        self.inventory = scan_utils.ScanInventory(SCAN_INVENTORY_DB)
 
     def pass_one(self) -> None:
-        """Executes Rawcooked over the sequences present in dpx_to_cook_v2
+        """Collects the sequences present in dpx_to_cook_v2
 
         These sequences have large reversibility file and thus needs to be cooked with --output-version 2 flag
-        Runs Rawcooked twice, once without the --framemd5 flag and then with --framemd5 flag
-        The processed sequences are added to the temp_rawcooked_v2_list.txt file
         """
 
         # Run first pass where list generated for large reversibility cases by dpx_post_rawcook.sh
         logging_utils.log(self.logfile, "Checking for files that failed RAWcooked due to large reversibility files")
 
-        # <sequence path, dpx_folder_path> pairs
-        sequence_map = find_utils.find_dpx_folder_from_sequence(DPX_V2_PATH)
+        # <sequence path, list of WorkUnit> pairs
+        sequence_map = find_utils.find_dpx_units(DPX_V2_PATH, self.inventory)
 
         if len(sequence_map) == 0:
             logging_utils.log(self.logfile, "No sequence found to be cooked with RAWCooked V2")
             return
 
-        # Taking only 20 entries from the dictionary
-        dpx_to_cook = dict(itertools.islice(sequence_map.items(), 20))
-
-        # Store the paths in a temporary .txt file
-        # If execution stops, we can see the sequences that were cooked
-        with open(self.temp_rawcooked_v2_file, 'a+') as file:
-            for seq_path in dpx_to_cook.keys():
-                file.write(f"{seq_path}\n")
-                logging_utils.log(self.logfile, f"{seq_path} will be cooked using RAWCooked V2")
-
-                mkv_file_name = os.path.basename(seq_path)
-
-                with concurrent.futures.ProcessPoolExecutor() as executor:
-                    executor.submit(self.rawcooked_command_executor, seq_path, mkv_file_name, False, True)
-
-                # Cooking with --framemd5 flag
-                with concurrent.futures.ProcessPoolExecutor() as executor:
-                    executor.submit(self.rawcooked_command_executor, seq_path, mkv_file_name, True, True)
+        self.add_candidates(sequence_map, True)
 
     def pass_two(self) -> None:
-        """Executes Rawcooked over the sequences present in dpx_to_cook
+        """Collects the sequences present in dpx_to_cook
 
         These sequences do NOT need to be cooked with --output-version 2 flag
-        Runs Rawcooked twice, once without the --framemd5 flag and then with --framemd5 flag
-        The processed sequences are added to the temp_rawcooked_v1_list.txt file
         """
 
         logging_utils.log(self.logfile, "Checking for files to cook using RAWCooked V1")
-        sequence_map = find_utils.find_dpx_folder_from_sequence(DPX_PATH)
+        sequence_map = find_utils.find_dpx_units(DPX_PATH, self.inventory)
 
         if len(sequence_map) == 0:
             logging_utils.log(self.logfile, "No sequence found to be cooked with RAWCooked V1")
             return
 
-        # Taking only 20 entries from the dictionary
-        dpx_to_cook = dict(itertools.islice(sequence_map.items(), 20))
+        self.add_candidates(sequence_map, False)
+
+    def add_candidates(self, sequence_map: dict, v2: bool) -> None:
+        """Measures every work unit of a <sequence path, list of WorkUnit> dictionary and adds it to the candidates
+
+        Each DPX folder of a multi reel delivery is a separate candidate cooked to its own mkv, see scan_utils.units_of()
+        Units the job state records as already cooked are skipped
+        Units in review, e.g. after a failed cook, are skipped until an operator delivers them again through
+        dpx_to_assess, so a failing sequence is not cooked again on every run
+        Units moved into the cook folders by hand are registered as assessed
+        The expected mkv ratio and cooking speed of each candidate come from the past cooks of similar sequences
+        """
+
+        for seq_path, units in sequence_map.items():
+            if self.sequences is not None and seq_path not in self.sequences:
+                continue
+            for unit in units:
+                self.deliveries[unit.path] = (seq_path, units)
+                self.job_state.alias(unit.path, unit.name)
+                state = self.job_state.state_of(unit.path)
+                if state in job_state.COOKED_STATES:
+                    logging_utils.log(self.logfile, f"SKIPPING {unit.path}, it is already {state}")
+                    continue
+                if state == job_state.STATE_COOKING:
+                    lease = self.leases.holder(unit.name)
+                    logging_utils.log(self.logfile, f"SKIPPING {unit.path}, it is being cooked on "
+                                                    f"{lease.node if lease else 'another host'}")
+                    continue
+                if state == job_state.STATE_REVIEW:
+                    logging_utils.log(self.logfile, f"SKIPPING {unit.path}, it is in review")
+                    continue
+                if state in (None, job_state.STATE_DISCOVERED):
+                    self.job_state.discover(unit.path)
+                    self.job_state.transition(unit.path, job_state.STATE_ASSESSED, 'found in cook folder')
+                dpx_folder = unit.info.path
+                profile = cook_history.profile_of(dpx_folder)
+                self.profiles[unit.path] = profile
+                mkv_ratio = self.history.ratio_for(profile, COOK_MKV_RATIO)
+                throughput, _ = self.history.throughput_for(profile, v2, COOK_THROUGHPUT_MBS * 1024 ** 2)
+                candidate = plan_utils.CookCandidate(unit.path, dpx_folder, v2, unit.info.frames,
+                                                     unit.info.bytes_per_frame, mkv_ratio, throughput, unit.name)
+                self.candidates[unit.path] = candidate
+                self.cook_candidates.append(candidate)
+
+    def plan(self) -> None:
+        """Picks the sequences cooked in this run with the size aware batch planner
+
+        The v2 and v1 candidates are interleaved and then ordered with COOK_BATCH_ORDER
+        The batch is limited by COOK_BATCH_MAX_COUNT, COOK_BATCH_MAX_GB, COOK_BATCH_MAX_HOURS and the free space on the
+        MKV volume. Deferred sequences stay in their folder and are picked up by the next run
+        The planned sequences are added to temp_rawcooked_v2_list.txt or temp_rawcooked_v1_list.txt
+        The predicted duration and mkv size of each planned sequence and of the whole batch are logged
+        """
 
-        print(dpx_to_cook)
+        v2_candidates = [c for c in self.cook_candidates if c.v2]
+        v1_candidates = [c for c in self.cook_candidates if not c.v2]
+        candidates = [c for pair in itertools.zip_longest(v2_candidates, v1_candidates) for c in pair if c is not None]
+
+        planned, deferred = plan_utils.plan_batch(
+            candidates,
+            order=COOK_BATCH_ORDER,
+            max_count=COOK_BATCH_MAX_COUNT,
+            max_bytes=COOK_BATCH_MAX_GB * 1024 ** 3 if COOK_BATCH_MAX_GB else None,
+            max_seconds=COOK_BATCH_MAX_HOURS * 3600 if COOK_BATCH_MAX_HOURS else None,
+            throughput=COOK_THROUGHPUT_MBS * 1024 ** 2,
+            workers=COOK_WORKERS,
+            free_bytes=plan_utils.free_space(MKV_DEST),
+            mkv_ratio=COOK_MKV_RATIO
+        )
+
+        for candidate in deferred:
+            logging_utils.log(self.logfile, f"DEFERRED {candidate.seq_path} ({candidate.frames} frames, "
+                                            f"{candidate.total_bytes} bytes) does not fit in this batch")
 
         # Store the paths in a temporary .txt file
         # If execution stops, we can see the sequences that were cooked
-        with open(self.temp_rawcooked_v1_file, 'a+') as file:
-            for seq_path in dpx_to_cook.keys():
-                file.write(f"{seq_path}\n")
-                logging_utils.log(self.logfile, f"{seq_path} will be cooked using RAWCooked V2")
+        for candidate in planned:
+            temp_file = self.temp_rawcooked_v2_file if candidate.v2 else self.temp_rawcooked_v1_file
+            with open(temp_file, 'a+') as file:
+                file.write(f"{candidate.seq_path}\n")
+            seconds = plan_utils.estimate_seconds(candidate, COOK_THROUGHPUT_MBS * 1024 ** 2)
+            mkv_bytes = int(candidate.total_bytes * (candidate.mkv_ratio or COOK_MKV_RATIO))
+            logging_utils.log(self.logfile, f"{candidate.seq_path} ({candidate.frames} frames, "
+                                            f"{candidate.total_bytes} bytes) will be cooked using RAWCooked "
+                                            f"{'V2' if candidate.v2 else 'V1'}, ETA {seconds / 60:.0f} min, "
+                                            f"mkv about {mkv_bytes} bytes")
+            self.cook_jobs.append(candidate)
+
+        if planned:
+            batch_seconds = sum(plan_utils.estimate_seconds(c, COOK_THROUGHPUT_MBS * 1024 ** 2) for c in planned)
+            logging_utils.log(self.logfile, f"Batch of {len(planned)} sequences, ETA "
+                                            f"{batch_seconds / min(COOK_WORKERS, len(planned)) / 60:.0f} min")
+
+    def lease_lost(self, name: str) -> None:
+        """Called by the heartbeat thread when another host took over the lease of a running cook
+
+        The worker cooking it stops on its own, see lease_check(), and its result is discarded by cook()
+        """
+        self.lost_leases.add(name)
+        logging_utils.log(self.logfile, f"WARNING: the lease of {name} was taken over by another host, its cook is "
+                                        f"stopped", name)
 
-                mkv_file_name = os.path.basename(seq_path)
+    def lease_error(self, name: str, error: OSError) -> None:
+        """Called by the heartbeat thread when the lease of a running cook could not be refreshed, the next heartbeat
+        tries again
+        """
+        metrics_utils.inc('rawcook_lease_heartbeat_errors_total', script=METRICS_SCRIPT)
+        logging_utils.log(self.logfile, f"WARNING: the heartbeat of the lease of {name} failed: {error}", name)
+
+    def lease_check(self, name: str):
+        """Returns the should_stop callable of the rawcooked runs of a cook worker
+
+        It returns True once the lease of name is no longer held by the parent process, reading the lease file at most
+        every COOK_LEASE_SECONDS / 3 seconds, as often as the heartbeats refresh it
+        """
+        leases = lease_utils.LeaseManager(COOK_LEASE_FOLDER, COOK_NODE_NAME, COOK_LEASE_SECONDS)
+        state = {'checked': time.monotonic(), 'lost': False}
+
+        def lost():
+            now = time.monotonic()
+            if not state['lost'] and now - state['checked'] >= COOK_LEASE_SECONDS / 3:
+                state['checked'] = now
+                try:
+                    state['lost'] = not leases.held_by(name, self.lease_owner_pid)
+                except OSError:
+                    # The share is unreachable, the heartbeats decide whether the lease survives it
+                    pass
+            return state['lost']
+
+        return lost
+
+    def verify_mkv(self, mkv_file_name: str, should_stop=None) -> bool:
+        """Decodes a cooked .mkv with rawcooked --check to confirm that it can be reverted to the original sequence
+
+        The framemd5 of the decoded frames is written to <mkv_file_name>.mkv.framemd5, dpx_post_rawcook.py compares it
+        with the <sequence>.framemd5 written during the cook
+        The console output is appended to the same <mkv_file_name>.mkv.txt file as the cook so that any error
+        reported here is picked up by the error checks of dpx_post_rawcook.py
+        Returns True if the check exited without error
+        """
+
+        mkv_file_path = f"{MKV_DEST}mkv_cooked/{mkv_file_name}.mkv"
+        output_txt_file = f"{mkv_file_path}.txt"
+        command = ['rawcooked', '--check', '--framemd5', '--framemd5-name', f"{mkv_file_path}.framemd5",
+                   mkv_file_path]
+        print(command)
+        result = shell_utils.run_streaming(command, log_file=output_txt_file, prefix=mkv_file_name,
+                                           stall_timeout=COOK_STALL_MINUTES * 60 or None, should_stop=should_stop)
+        return result.returncode == 0 and not result.killed
+
+    def cook_sequence(self, seq_path: str, v2: bool) -> CookOutcome:
+        """The unit of work executed by each worker of the cooking pool
+
+        Runs Rawcooked once, producing the .mkv, the .framemd5 and the console log in the same pass
+        If COOK_VERIFY is enabled the .mkv is then decoded again as a separate verification stage
+        Both stages are stopped if the lease of the sequence is taken over by another host
+        Returns a CookOutcome, ok if both stages exited without error, with the wall time of the cook stage alone
+        The metrics of the rawcooked runs, e.g. their CPU time and peak memory, and the time of the verification stage
+        are merged by the parent process
+        """
 
-                with concurrent.futures.ProcessPoolExecutor() as executor:
-                    executor.submit(self.rawcooked_command_executor, seq_path, mkv_file_name, False, False)
+        metrics_utils.begin_worker_job(METRICS_SCRIPT)
+        mkv_file_name = self.name_for(seq_path)
+        lease_lost = self.lease_check(mkv_file_name)
+        with logging_utils.correlation(mkv_file_name):
+            start = time.monotonic()
+            ok = self.rawcooked_command_executor(seq_path, mkv_file_name, v2, lease_lost)
+            cook_seconds = time.monotonic() - start
+            if ok and COOK_VERIFY:
+                with metrics_utils.timed('rawcook_sequence_seconds', script=METRICS_SCRIPT, step='verify'):
+                    ok = self.verify_mkv(mkv_file_name, lease_lost)
+        return CookOutcome(ok, lease_lost(), cook_seconds, metrics_utils.REGISTRY.snapshot())
+
+    def estimate_mkv_bytes(self, candidate: plan_utils.CookCandidate) -> int:
+        """Returns the space reserved for the mkv of a candidate, its predicted size plus COOK_SPACE_MARGIN"""
+        return int(candidate.total_bytes * (candidate.mkv_ratio or COOK_MKV_RATIO) * COOK_SPACE_MARGIN)
+
+    def unlist(self, candidate: plan_utils.CookCandidate) -> None:
+        """Removes a sequence that was not cooked from its temporary list so it is not logged as cooked"""
+        temp_file = self.temp_rawcooked_v2_file if candidate.v2 else self.temp_rawcooked_v1_file
+        with open(temp_file, 'r') as file:
+            lines = [line for line in file if line.strip() != candidate.seq_path]
+        with open(temp_file, 'w') as file:
+            file.writelines(lines)
+
+    def finish_cook(self, candidate: plan_utils.CookCandidate, ok: bool, cook_seconds: float) -> None:
+        """Records the outcome of a cook in the job state, the metrics and, if it succeeded, in the cook history
+
+        cook_seconds is the wall time of the rawcooked run alone, the history predicts cook times from it
+        """
+        metrics_utils.observe('rawcook_sequence_seconds', cook_seconds, script=METRICS_SCRIPT, step='cook')
+        metrics_utils.inc('rawcook_sequences_total', script=METRICS_SCRIPT, outcome='cooked' if ok else 'failed')
+        if not ok:
+            self.job_state.transition(candidate.seq_path, job_state.STATE_REVIEW, 'rawcooked failed')
+            return
+        self.job_state.transition(candidate.seq_path, job_state.STATE_COOKED)
+        metrics_utils.inc('rawcook_bytes_read_total', candidate.total_bytes, script=METRICS_SCRIPT)
+        mkv_path = self.mkv_path_for(candidate.seq_path)
+        if os.path.exists(mkv_path):
+            mkv_bytes = os.path.getsize(mkv_path)
+            metrics_utils.inc('rawcook_bytes_written_total', mkv_bytes, script=METRICS_SCRIPT)
+            self.history.record(candidate.mkv_name, self.profiles.get(candidate.seq_path),
+                                candidate.v2, candidate.frames, candidate.total_bytes, mkv_bytes, cook_seconds)
+
+    def cook(self) -> None:
+        """Cooks every queued sequence on a single shared pool of COOK_WORKERS processes
+
+        The jobs are started in the order decided by plan() so that both kinds of sequences share the workers
+        A cook starts only once the space of its predicted mkv is reserved on the MKV volume, a job that does not fit
+        waits and the smaller ones after it may start first. Reservations are released as cooks finish and the free
+        space is checked again every COOK_ADMISSION_POLL_SECONDS. Jobs still waiting after
+        COOK_ADMISSION_MAX_WAIT_MINUTES without any running cook are left for the next run
+        Results are collected as soon as each cook finishes, a failing cook is logged and does not stop the others
+        Each sequence is marked cooking before it is submitted and cooked or review once its result is known, a crash
+        in between leaves it in cooking and the next run cooks it again
+        A sequence is only cooked by the host that claims its lease, the sequences claimed by other hosts meanwhile are
+        skipped, and the lease is released once the result is recorded. A cook whose lease is taken over meanwhile is
+        stopped and left to the other host, without touching its state
+        The number of waiting and running cooks and the throughput of the batch are recorded in the metrics
+        """
+
+        jobs = list(self.cook_jobs)
+        if len(jobs) == 0:
+            return
 
-                # Cooking with --framemd5 flag
-                with concurrent.futures.ProcessPoolExecutor() as executor:
-                    executor.submit(self.rawcooked_command_executor, seq_path, mkv_file_name, True, False)
+        admission = plan_utils.SpaceAdmission(MKV_DEST, int(COOK_SPACE_HEADROOM_GB * 1024 ** 3))
+        logging_utils.log(self.logfile, f"Cooking {len(jobs)} sequences using {COOK_WORKERS} workers")
+        waiting_since = None
+        started = {}
+        batch_start = time.monotonic()
+        cooked_bytes = 0
+        with concurrent.futures.ProcessPoolExecutor(max_workers=COOK_WORKERS) as executor:
+            futures = {}
+            while jobs or futures:
+                metrics_utils.set_gauge('rawcook_queue_depth', len(jobs), script=METRICS_SCRIPT, queue='to_cook')
+                metrics_utils.set_gauge('rawcook_queue_depth', len(futures), script=METRICS_SCRIPT, queue='cooking')
+                for candidate in list(jobs):
+                    if len(futures) >= COOK_WORKERS:
+                        break
+                    if not self.leases.try_acquire(candidate.mkv_name):
+                        jobs.remove(candidate)
+                        logging_utils.log(self.logfile, f"SKIPPING {candidate.seq_path}, claimed by another host",
+                                          candidate.mkv_name)
+                        self.unlist(candidate)
+                        continue
+                    estimate = self.estimate_mkv_bytes(candidate)
+                    if not admission.try_reserve(candidate.seq_path, self.mkv_path_for(candidate.seq_path), estimate):
+                        self.leases.release(candidate.mkv_name)
+                        continue
+                    jobs.remove(candidate)
+                    if not self.job_state.transition(candidate.seq_path, job_state.STATE_COOKING, COOK_NODE_NAME):
+                        # Cooked or sent for review by another host since it was found
+                        logging_utils.log(self.logfile, f"SKIPPING {candidate.seq_path}, it is already "
+                                                        f"{self.job_state.state_of(candidate.seq_path)}",
+                                          candidate.mkv_name)
+                        admission.release(candidate.seq_path)
+                        self.leases.release(candidate.mkv_name)
+                        self.unlist(candidate)
+                        continue
+                    logging_utils.log(self.logfile, f"ADMITTED {candidate.seq_path}, {estimate} bytes reserved",
+                                      candidate.mkv_name)
+                    started[candidate.seq_path] = time.monotonic()
+                    futures[executor.submit(self.cook_sequence, candidate.seq_path, candidate.v2)] = candidate
+
+                if not futures:
+                    # Nothing running will free space, only the operators or dpx_post_rawcook.py can
+                    if waiting_since is None:
+                        waiting_since = time.monotonic()
+                        logging_utils.log(self.logfile, f"WAITING: {len(jobs)} sequences do not fit in the "
+                                                        f"{admission.available()} bytes available on {MKV_DEST}")
+                    elif COOK_ADMISSION_MAX_WAIT_MINUTES and \
+                            time.monotonic() - waiting_since > COOK_ADMISSION_MAX_WAIT_MINUTES * 60:
+                        for candidate in jobs:
+                            logging_utils.log(self.logfile, f"DEFERRED {candidate.seq_path}, not enough space on "
+                                                            f"{MKV_DEST}")
+                            self.unlist(candidate)
+                        break
+                    time.sleep(COOK_ADMISSION_POLL_SECONDS)
+                    continue
+                waiting_since = None
+
+                done, _ = concurrent.futures.wait(futures, timeout=COOK_ADMISSION_POLL_SECONDS,
+                                                  return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    candidate = futures.pop(future)
+                    admission.release(candidate.seq_path)
+                    with logging_utils.correlation(candidate.mkv_name):
+                        try:
+                            outcome = future.result()
+                            metrics_utils.REGISTRY.merge(outcome.metrics)
+                            duration_seconds = time.monotonic() - started.pop(candidate.seq_path)
+                            if outcome.lease_lost or candidate.mkv_name in self.lost_leases:
+                                self.lost_leases.discard(candidate.mkv_name)
+                                metrics_utils.inc('rawcook_sequences_total', script=METRICS_SCRIPT,
+                                                  outcome='lease_lost')
+                                logging_utils.log(self.logfile, f"INTERRUPTED cooking {candidate.seq_path}, it is "
+                                                                f"cooked by the host that took its lease over")
+                                self.unlist(candidate)
+                                self.leases.release(candidate.mkv_name)
+                                continue
+                            self.finish_cook(candidate, outcome.ok, outcome.cook_seconds)
+                            if outcome.ok:
+                                cooked_bytes += candidate.total_bytes
+                            logging_utils.log(self.logfile, f"FINISHED cooking {candidate.seq_path} in "
+                                                            f"{duration_seconds:.1f} s, "
+                                                            f"{outcome.cook_seconds:.1f} s in rawcooked")
+                        except Exception as e:
+                            metrics_utils.inc('rawcook_sequences_total', script=METRICS_SCRIPT, outcome='error')
+                            self.job_state.transition(candidate.seq_path, job_state.STATE_REVIEW, str(e))
+                            logging_utils.log(self.logfile, f"ERROR while cooking {candidate.seq_path}: {e}")
+                    self.leases.release(candidate.mkv_name)
+
+        metrics_utils.set_gauge('rawcook_queue_depth', len(jobs), script=METRICS_SCRIPT, queue='to_cook')
+        metrics_utils.set_gauge('rawcook_queue_depth', 0, script=METRICS_SCRIPT, queue='cooking')
+        metrics_utils.set_gauge('rawcook_batch_throughput_bytes_per_second',
+                                round(cooked_bytes / max(time.monotonic() - batch_start, 1e-6)), script=METRICS_SCRIPT)
 
     def process_temporary_files(self) -> list:
         """Process the data inside temporary files and returns a list of sequences that needs review
@@ -203,37 +629,76 @@ class DpxRawcook:
         """Process the failed sequences that need manual review
 
         Takes a list of sequence paths as input
-        Moves these sequences to dpx_for_review folder
-        Removes the .framemd5 file
-        Removes the cooked .mkv and the respective .txt file from encoded/mkv_cooked folder
+        Moves the deliveries of these sequences and their frame manifest to dpx_for_review folder. A multi reel delivery
+        is moved as a whole when any of its reels fails, the reels left behind would otherwise be taken for a single
+        folder delivery by the next run and cooked again under the name of the delivery
+        The reels of the delivery that are not cooked yet are put in review with it, the cooked ones keep their mkv
+        Removes the .framemd5 file of the failed sequences
+        Removes the cooked .mkv and the respective .txt file of the failed sequences from encoded/mkv_cooked folder
         """
 
+        failed = {}
         for seq in sequences_to_review:
-            # Move the sequence folder to dpx_for_review
-            if not os.path.exists(os.path.join(DPX_FOR_REVIEW_PATH, os.path.basename(seq))):
-                shutil.move(seq, DPX_FOR_REVIEW_PATH)
-                logging_utils.log(self.logfile, f"MOVED {seq} to dpx_for_review folder")
+            delivery, units = self.deliveries.get(seq, (seq, []))
+            failed.setdefault(delivery, (units, []))[1].append(seq)
+
+        for delivery, (units, reels) in failed.items():
+            for seq in reels:
+                self.job_state.transition(seq, job_state.STATE_REVIEW, 'incoherent file names')
+            for unit in units:
+                if unit.path in reels or self.job_state.state_of(unit.path) in job_state.COOKED_STATES:
+                    continue
+                self.job_state.transition(unit.path, job_state.STATE_REVIEW,
+                                          f"{self.name_for(reels[0])} of the delivery failed")
+
+            # Move the delivery folder to dpx_for_review
+            review_path = os.path.join(DPX_FOR_REVIEW_PATH, os.path.basename(delivery))
+            if not os.path.exists(review_path):
+                if delivery not in reels:
+                    logging_utils.log(self.logfile, f"Reels {', '.join(self.name_for(seq) for seq in reels)} of "
+                                                    f"{delivery} failed, the whole delivery is moved for review")
+                move_utils.move_path(delivery, review_path, MOVE_WORKERS, MOVE_VERIFY_HASH)
+                logging_utils.log(self.logfile, f"MOVED {delivery} to dpx_for_review folder")
+                manifest_path = manifest_utils.manifest_path_for(delivery)
+                if os.path.exists(manifest_path):
+                    move_utils.move_path(manifest_path, DPX_FOR_REVIEW_PATH, MOVE_WORKERS, MOVE_VERIFY_HASH)
             else:
-                logging_utils.log(self.logfile, f"CAN NOT MOVE {seq} to dpx_for_review folder. A sequence with same "
-                                                f"name already exists")
-
-            # Remove MD5 file
-            md5_path = f"{seq}.framemd5"
-            if os.path.exists(md5_path):
-                os.remove(md5_path)
-                logging_utils.log(self.logfile, f"DELETED: {md5_path}")
-
-            # Remove the cooked .mkv and respective .txt files
-            mkv_file_name = f"{os.path.basename(seq)}.mkv"
-            txt_file_name = f"{mkv_file_name}.txt"
-            mkv_file_path = os.path.join(self.mkv_cooked_folder, mkv_file_name)
-            txt_file_path = os.path.join(self.mkv_cooked_folder, txt_file_name)
-            if os.path.exists(mkv_file_path):
-                os.remove(mkv_file_path)
-                logging_utils.log(self.logfile, f"DELETED: {mkv_file_path}")
-            if os.path.exists(txt_file_path):
-                os.remove(txt_file_path)
-                logging_utils.log(self.logfile, f"DELETED: {txt_file_path}")
+                logging_utils.log(self.logfile, f"CAN NOT MOVE {delivery} to dpx_for_review folder. A sequence with "
+                                                f"same name already exists")
+
+            for seq in reels:
+                # Remove MD5 file
+                md5_path = self.framemd5_path_for(seq)
+                if os.path.exists(md5_path):
+                    os.remove(md5_path)
+                    logging_utils.log(self.logfile, f"DELETED: {md5_path}")
+
+                # Remove the cooked .mkv and respective .txt files
+                mkv_file_name = f"{self.name_for(seq)}.mkv"
+                txt_file_name = f"{mkv_file_name}.txt"
+                mkv_file_path = os.path.join(self.mkv_cooked_folder, mkv_file_name)
+                txt_file_path = os.path.join(self.mkv_cooked_folder, txt_file_name)
+                if os.path.exists(mkv_file_path):
+                    os.remove(mkv_file_path)
+                    logging_utils.log(self.logfile, f"DELETED: {mkv_file_path}")
+                if os.path.exists(txt_file_path):
+                    os.remove(txt_file_path)
+                    logging_utils.log(self.logfile, f"DELETED: {txt_file_path}")
+
+    def unfinished(self) -> list:
+        """Returns the deliveries found by this run that still have a unit waiting to be cooked
+
+        These are the units deferred by plan(), not admitted for lack of space, claimed by another host or interrupted,
+        dpx_daemon.py queues them again since no new file event will
+        """
+
+        waiting = (job_state.STATE_DISCOVERED, job_state.STATE_ASSESSED, job_state.STATE_COOKING)
+        deliveries = set()
+        for unit_path, (seq_path, _) in self.deliveries.items():
+            if seq_path not in deliveries and os.path.exists(unit_path) and \
+                    self.job_state.state_of(unit_path) in waiting:
+                deliveries.add(seq_path)
+        return sorted(deliveries)
 
     def clean(self):
         """Concludes the workflow
@@ -252,19 +717,37 @@ class DpxRawcook:
                 os.remove(file_name)
                 print(f"Deleted file: {file_name}")
 
+        if self.leases:
+            self.leases.stop_heartbeat()
+            self.leases.release_all()
+        if self.job_state:
+            self.job_state.close()
+        if self.history:
+            self.history.close()
+        if self.inventory:
+            self.inventory.close()
+        metrics_utils.write_textfile(METRICS_TEXTFILE_DIR, METRICS_SCRIPT)
+
         logging_utils.log(self.logfile, "============= DPX RAWcook script END =============")
 
     def execute(self):
         # TODO: Implement Error handling mechanisms
         self.process()
 
-        self.pass_one()
-        self.pass_two()
+        with metrics_utils.stage(METRICS_SCRIPT, 'find'):
+            self.pass_one()
+            self.pass_two()
+        with metrics_utils.stage(METRICS_SCRIPT, 'plan'):
+            self.plan()
+        with metrics_utils.stage(METRICS_SCRIPT, 'cook'):
+            self.cook()
 
-        dpx_review_list = self.process_temporary_files()
-        if len(dpx_review_list) > 0:
-            self.process_review_sequences(dpx_review_list)
+        with metrics_utils.stage(METRICS_SCRIPT, 'review'):
+            dpx_review_list = self.process_temporary_files()
+            if len(dpx_review_list) > 0:
+                self.process_review_sequences(dpx_review_list)
 
+        self.leftovers = self.unfinished()
         self.clean()
 
 
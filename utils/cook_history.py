@@ -0,0 +1,158 @@
+import datetime
+import os
+import sqlite3
+import statistics
+import threading
+from typing import NamedTuple
+
+from utils import dpx_utils
+
+
+class SequenceProfile(NamedTuple):
+    """The properties of a DPX sequence that drive its compression ratio"""
+    width: int
+    height: int
+    bit_depth: int
+
+
+def profile_of(dpx_folder):
+    """Function to read the profile of a sequence from the header of one of its frames
+
+    @param dpx_folder: The folder containing the .dpx files
+    @return: A SequenceProfile, None if no frame could be read
+    """
+
+    with os.scandir(dpx_folder) as entries:
+        frame = next((entry.path for entry in entries if entry.name.lower().endswith('.dpx')), None)
+    if frame is None:
+        return None
+    try:
+        header = dpx_utils.read_dpx_header(frame)
+    except (OSError, ValueError):
+        return None
+    return SequenceProfile(header.width, header.height, header.bit_depth)
+
+
+class Prediction(NamedTuple):
+    """Expected outcome of a cook"""
+    seconds: float
+    mkv_bytes: int
+    # Number of past cooks the throughput was learned from, 0 means the defaults were used
+    samples: int
+
+
+class CookHistory:
+    """Persistent metrics store of the finished cooks, used to predict the size and duration of the next ones
+
+    Every successful cook stores its duration, the size of its source and of its mkv, its frame count and whether it
+    was cooked with --output-version 2, together with the profile of the sequence. The predictions use the median of
+    the most recent window cooks that match the sequence as closely as possible: same profile and version, then same
+    profile, then any cook, and finally a default when there is no history yet.
+    """
+
+    def __init__(self, db_path, window=20):
+        self.db_path = db_path
+        self.window = window
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS cooks (name TEXT NOT NULL, width INTEGER, height INTEGER, "
+                "bit_depth INTEGER, v2 INTEGER NOT NULL, frames INTEGER NOT NULL, source_bytes INTEGER NOT NULL, "
+                "mkv_bytes INTEGER NOT NULL, recorded TEXT NOT NULL)")
+            columns = {row[1] for row in self.connection.execute("PRAGMA table_info(cooks)")}
+            if 'duration_seconds' not in columns:
+                self.connection.execute("ALTER TABLE cooks ADD COLUMN duration_seconds REAL")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS cooks_profile ON cooks (width, height, bit_depth, v2)")
+
+    def record(self, name, profile, v2, frames, source_bytes, mkv_bytes, duration_seconds=None) -> None:
+        """Records a finished cook
+
+        @param name: The sequence name
+        @param profile: The SequenceProfile of the sequence, None if unknown
+        @param v2: True if cooked with --output-version 2
+        @param frames: Number of frames
+        @param source_bytes: Total size of the DPX sequence
+        @param mkv_bytes: Size of the mkv
+        @param duration_seconds: Wall clock time of the cook, None if unknown
+        """
+
+        if source_bytes <= 0:
+            return
+        width, height, bit_depth = profile if profile else (None, None, None)
+        timestamp = datetime.datetime.now().strftime("%Y-%m-%d - %H:%M:%S")
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO cooks (name, width, height, bit_depth, v2, frames, source_bytes, mkv_bytes, recorded, "
+                "duration_seconds) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (name, width, height, bit_depth, int(v2), frames, source_bytes, mkv_bytes, timestamp,
+                 duration_seconds))
+
+    def recent(self, expression, profile, v2=None, condition="1") -> list:
+        """Returns expression for the most recent cooks matching a profile as closely as possible
+
+        Tries the cooks of the same profile and version, then of the same profile, then every cook
+        @param expression: SQL expression evaluated on each row
+        @param profile: A SequenceProfile or None
+        @param v2: The version of the cook or None to ignore it
+        @param condition: Extra SQL condition the rows must satisfy
+        @return: List of values, empty if no cook matches
+        """
+
+        filters = []
+        if profile is not None:
+            if v2 is not None:
+                filters.append(("width = ? AND height = ? AND bit_depth = ? AND v2 = ?", (*profile, int(v2))))
+            filters.append(("width = ? AND height = ? AND bit_depth = ?", tuple(profile)))
+        filters.append(("1", ()))
+
+        with self.lock:
+            for where, parameters in filters:
+                rows = self.connection.execute(
+                    f"SELECT {expression} FROM cooks WHERE {where} AND {condition} ORDER BY rowid DESC LIMIT ?",
+                    (*parameters, self.window)).fetchall()
+                if rows:
+                    return [row[0] for row in rows]
+        return []
+
+    def ratio_for(self, profile, default=1.0) -> float:
+        """Returns the expected mkv size relative to the source size for a sequence profile
+
+        @param profile: A SequenceProfile, None uses the cooks of every profile
+        @param default: Ratio returned when there is no history
+        @return: The median ratio of the last window cooks of the profile
+        """
+
+        ratios = self.recent("mkv_bytes * 1.0 / source_bytes", profile)
+        return statistics.median(ratios) if ratios else default
+
+    def throughput_for(self, profile, v2, default) -> tuple:
+        """Returns the expected cooking speed of one worker for a sequence
+
+        @param profile: A SequenceProfile, None uses the cooks of every profile
+        @param v2: True if the sequence is cooked with --output-version 2
+        @param default: Speed in bytes per second returned when no cook has a recorded duration
+        @return: Tuple of (median source bytes per second, number of cooks it was learned from)
+        """
+
+        speeds = self.recent("source_bytes / duration_seconds", profile, v2, "duration_seconds > 0")
+        return (statistics.median(speeds), len(speeds)) if speeds else (default, 0)
+
+    def predict(self, profile, v2, source_bytes, default_ratio=1.0, default_throughput=100 * 1024 ** 2) -> Prediction:
+        """Predicts the duration and the mkv size of a cook
+
+        @param profile: The SequenceProfile of the sequence, None if unknown
+        @param v2: True if the sequence is cooked with --output-version 2
+        @param source_bytes: Total size of the DPX sequence
+        @param default_ratio: mkv/source ratio used when there is no history
+        @param default_throughput: Bytes per second used when there is no history
+        @return: A Prediction
+        """
+
+        throughput, samples = self.throughput_for(profile, v2, default_throughput)
+        mkv_bytes = int(source_bytes * self.ratio_for(profile, default_ratio))
+        return Prediction(source_bytes / throughput, mkv_bytes, samples)
+
+    def close(self) -> None:
+        self.connection.close()
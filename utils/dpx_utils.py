@@ -0,0 +1,165 @@
+import os
+import struct
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+# Size of the generic and industry headers of a DPX file
+HEADER_SIZE = 2048
+
+MAGIC_BIG_ENDIAN = b'SDPX'
+MAGIC_LITTLE_ENDIAN = b'XPDS'
+
+# Image element descriptors listed in the description of the BFI policy, checked in strict mode only
+DESCRIPTOR_LUMA = 6
+DESCRIPTOR_RGB = 50
+SUPPORTED_DESCRIPTORS = (DESCRIPTOR_LUMA, DESCRIPTOR_RGB)
+SUPPORTED_BIT_DEPTHS = (10, 16)
+MINIMUM_WIDTH = 2048
+# Encoding 0 means the image data is not run length encoded
+ENCODING_RAW = 0
+
+
+class DpxHeader(NamedTuple):
+    """Fields of the DPX generic header and of the first image element"""
+    path: str
+    byte_order: str
+    version: str
+    image_offset: int
+    file_size: int
+    orientation: int
+    elements: int
+    width: int
+    height: int
+    descriptor: int
+    transfer: int
+    colorimetric: int
+    bit_depth: int
+    packing: int
+    encoding: int
+
+    @property
+    def signature(self) -> tuple:
+        """The fields expected to be identical on every frame of a sequence"""
+        return (self.byte_order, self.version, self.file_size, self.elements, self.width, self.height,
+                self.descriptor, self.transfer, self.colorimetric, self.bit_depth, self.packing, self.encoding)
+
+
+class HeaderReport(NamedTuple):
+    """Result of check_sequence_headers()"""
+    path: str
+    frames: int
+    reference: DpxHeader
+    nonconforming: dict
+    heterogeneous: list
+    unreadable: dict
+    # Heterogeneous frames only fail the sequence in strict mode
+    strict: bool = False
+
+    @property
+    def passed(self) -> bool:
+        return self.frames > 0 and not self.nonconforming and not self.unreadable and \
+            not (self.strict and self.heterogeneous)
+
+
+def read_dpx_header(path) -> DpxHeader:
+    """Function to read the header of a DPX file without any external tool
+
+    The magic number tells the byte order of the whole header, both big and little endian files are handled
+    @param path: Path of the .dpx file
+    @return: A DpxHeader
+    @raise ValueError: If the file is too small or is not a DPX file
+    """
+
+    with open(path, 'rb') as file:
+        header = file.read(HEADER_SIZE)
+    if len(header) < 812:
+        raise ValueError(f"{path} is too small to be a DPX file")
+
+    magic = header[0:4]
+    if magic == MAGIC_BIG_ENDIAN:
+        order, byte_order = '>', 'big'
+    elif magic == MAGIC_LITTLE_ENDIAN:
+        order, byte_order = '<', 'little'
+    else:
+        raise ValueError(f"{path} does not start with a DPX magic number")
+
+    image_offset, = struct.unpack_from(f'{order}I', header, 4)
+    version = header[8:16].split(b'\0', 1)[0].decode('ascii', 'replace')
+    file_size, = struct.unpack_from(f'{order}I', header, 16)
+    orientation, elements, width, height = struct.unpack_from(f'{order}HHII', header, 768)
+    descriptor, transfer, colorimetric, bit_depth, packing, encoding = struct.unpack_from(f'{order}BBBBHH', header, 800)
+
+    return DpxHeader(str(path), byte_order, version, image_offset, file_size, orientation, elements, width, height,
+                     descriptor, transfer, colorimetric, bit_depth, packing, encoding)
+
+
+def conformance_errors(header: DpxHeader, strict=False) -> list:
+    """Function to list the reasons why a frame does not conform to the DPX policy
+
+    The rules of policy/rawcooked_dpx_policy.xml only enforce Format=DPX, which read_dpx_header() already checked with
+    the magic number, and FileExtension=dpx. The strict mode also checks what the description of the policy lists:
+    single image element, RGB or Y, 10 or 16 bit, minimum 2K width, raw
+    @param header: The DpxHeader of the frame
+    @param strict: True to also check the rules of the description of the policy
+    @return: List of error messages, empty if the frame conforms
+    """
+
+    errors = []
+    if not header.path.lower().endswith('.dpx'):
+        errors.append("file extension is not dpx")
+    if not strict:
+        return errors
+    if header.elements != 1:
+        errors.append(f"{header.elements} image elements")
+    if header.descriptor not in SUPPORTED_DESCRIPTORS:
+        errors.append(f"descriptor {header.descriptor} is not RGB or Y")
+    if header.bit_depth not in SUPPORTED_BIT_DEPTHS:
+        errors.append(f"{header.bit_depth} bit")
+    if header.width < MINIMUM_WIDTH:
+        errors.append(f"width {header.width} is smaller than {MINIMUM_WIDTH}")
+    if header.encoding != ENCODING_RAW:
+        errors.append(f"encoding {header.encoding} is not raw")
+    return errors
+
+
+def _read_or_error(path):
+    try:
+        return read_dpx_header(path)
+    except (OSError, ValueError, struct.error) as e:
+        return e
+
+
+def check_sequence_headers(dpx_folder, workers=8, strict=False) -> HeaderReport:
+    """Function to read the header of every frame of a folder and flag the frames that stand out
+
+    The headers are read in parallel by a pool of threads. The most common header signature of the sequence is the
+    reference, every frame with another signature is heterogeneous.
+    @param dpx_folder: The folder containing the .dpx files
+    @param workers: Number of threads reading headers
+    @param strict: True to check the rules of the description of the policy too, see conformance_errors(), and to fail
+    heterogeneous frames
+    @return: A HeaderReport
+    """
+
+    with os.scandir(dpx_folder) as entries:
+        frames = sorted(entry.path for entry in entries if entry.name.lower().endswith('.dpx'))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        headers = list(executor.map(_read_or_error, frames))
+
+    unreadable = {frame: str(header) for frame, header in zip(frames, headers) if isinstance(header, Exception)}
+    headers = [header for header in headers if isinstance(header, DpxHeader)]
+    if not headers:
+        return HeaderReport(str(dpx_folder), len(frames), None, {}, [], unreadable, strict)
+
+    reference_signature, _ = Counter(header.signature for header in headers).most_common(1)[0]
+    reference = next(header for header in headers if header.signature == reference_signature)
+    heterogeneous = [header.path for header in headers if header.signature != reference_signature]
+    nonconforming = {}
+    for header in headers:
+        errors = conformance_errors(header, strict)
+        if errors:
+            nonconforming[header.path] = errors
+
+    return HeaderReport(str(dpx_folder), len(frames), reference, nonconforming, heterogeneous, unreadable, strict)
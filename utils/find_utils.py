@@ -1,4 +1,7 @@
 import os
+import random
+
+from utils import move_utils, scan_utils
 
 
 def find_files(directory, depth):
@@ -43,16 +46,22 @@ def find_in_logs(file_path, search_text):
     return False
 
 
-def find_dpx_folder_from_sequence(dpx_folder_path) -> dict:
+def find_dpx_folder_from_sequence(dpx_folder_path, inventory=None) -> dict:
     """Function to find the nested folder containing only dpx_sequences
 
+    Only one folder is kept per sequence, find_dpx_units() returns every folder of the multi reel deliveries
     :param dpx_folder_path: folder to check for dpx
+    :param inventory: optional scan_utils.ScanInventory, only the folders changed since its last scan are listed
     :return: dictionary with root folder and dpx folder path
     """
+    if inventory is not None:
+        return {seq_path: folders[-1].path
+                for seq_path, folders in inventory.dpx_folders(dpx_folder_path).items() if folders}
+
     dpx_sequence = {}
     for seq in os.listdir(dpx_folder_path):
         seq_path = os.path.join(dpx_folder_path, seq)
-        if os.path.isfile(seq_path) and not seq.endswith('.dpx'):
+        if (os.path.isfile(seq_path) and not seq.endswith('.dpx')) or move_utils.is_staging(seq):
             continue
 
         for dir_path, dir_names, file_names in os.walk(seq_path):
@@ -64,3 +73,68 @@ def find_dpx_folder_from_sequence(dpx_folder_path) -> dict:
                     break
 
     return dpx_sequence
+
+
+def find_dpx_units(dpx_folder_path, inventory=None) -> dict:
+    """Function to find every folder containing dpx files below each sequence, each one is a separate work unit
+
+    :param dpx_folder_path: folder to check for dpx
+    :param inventory: optional scan_utils.ScanInventory, only the folders changed since its last scan are listed
+    :return: dictionary with root folder and list of scan_utils.WorkUnit, see scan_utils.units_of()
+    """
+    if inventory is not None:
+        return inventory.work_units(dpx_folder_path)
+
+    dpx_units = {}
+    for seq in sorted(os.listdir(dpx_folder_path)):
+        seq_path = os.path.join(dpx_folder_path, seq)
+        if not os.path.isdir(seq_path) or move_utils.is_staging(seq):
+            continue
+
+        folders = []
+        for dir_path, dir_names, file_names in os.walk(seq_path):
+            dir_names.sort()
+            if any(file_name.lower().endswith('.dpx') for file_name in file_names):
+                folders.append(scan_utils.list_folder(dir_path))
+        if folders:
+            dpx_units[seq_path] = scan_utils.units_of(seq_path, folders)
+
+    return dpx_units
+
+
+def sample_dpx_files(dpx_folder, strategy='first') -> list:
+    """Function to pick the .dpx files of a folder that are checked against the policy
+
+    The strategy is a comma separated list of:
+    - first: the first frame
+    - last: the last frame
+    - stride:N: every Nth frame starting with the first one
+    - random:K: K frames picked at random
+    - all: every frame
+    e.g. 'first,last,random:8'. Frames are ordered by file name.
+
+    :param dpx_folder: folder containing the .dpx files
+    :param strategy: the sampling strategy
+    :return: sorted list of .dpx file paths without duplicates
+    """
+    with os.scandir(dpx_folder) as entries:
+        frames = sorted(entry.path for entry in entries if entry.name.lower().endswith('.dpx'))
+    if len(frames) == 0:
+        return []
+
+    sample = set()
+    for part in strategy.split(','):
+        name, _, value = part.strip().partition(':')
+        if name == 'first':
+            sample.add(frames[0])
+        elif name == 'last':
+            sample.add(frames[-1])
+        elif name == 'stride':
+            sample.update(frames[::max(int(value), 1)])
+        elif name == 'random':
+            sample.update(random.sample(frames, min(int(value), len(frames))))
+        elif name == 'all':
+            sample.update(frames)
+        else:
+            raise ValueError(f"Unknown sampling strategy: {part}")
+    return sorted(sample)
@@ -0,0 +1,60 @@
+import itertools
+from typing import NamedTuple
+
+
+class FrameChecksum(NamedTuple):
+    """One data line of a framemd5 file"""
+    stream: int
+    index: int
+    pts: int
+    size: int
+    hash: str
+
+
+def iter_framemd5(path):
+    """Function to read a framemd5 file one line at a time
+
+    Comment lines starting with # are skipped, every other line is <stream>, <dts>, <pts>, <duration>, <size>, <hash>
+    The index is the position of the frame in its stream, it is used to match frames across files whose time bases
+    may differ
+    @param path: The .framemd5 file
+    @return: Generator of FrameChecksum
+    """
+
+    counters = {}
+    with open(path, 'r') as file:
+        for line in file:
+            if line.startswith('#') or not line.strip():
+                continue
+            fields = [field.strip() for field in line.split(',')]
+            stream = int(fields[0])
+            index = counters.get(stream, 0)
+            counters[stream] = index + 1
+            yield FrameChecksum(stream, index, int(fields[2]), int(fields[4]), fields[5])
+
+
+def compare_framemd5(source_path, target_path, max_mismatches=None) -> list:
+    """Function to compare two framemd5 files frame by frame without loading them in memory
+
+    @param source_path: The framemd5 of the source sequence
+    @param target_path: The framemd5 of the decoded mkv
+    @param max_mismatches: Stop after this many mismatches, None compares the whole files
+    @return: List of (stream, frame index, reason), empty if every frame matches
+    """
+
+    mismatches = []
+    pairs = itertools.zip_longest(iter_framemd5(source_path), iter_framemd5(target_path))
+    for source, target in pairs:
+        if source is None:
+            mismatches.append((target.stream, target.index, 'extra frame in mkv'))
+        elif target is None:
+            mismatches.append((source.stream, source.index, 'frame missing from mkv'))
+        elif (source.stream, source.index) != (target.stream, target.index):
+            mismatches.append((source.stream, source.index, 'frame order differs'))
+        elif source.size != target.size:
+            mismatches.append((source.stream, source.index, f"size {source.size} != {target.size}"))
+        elif source.hash != target.hash:
+            mismatches.append((source.stream, source.index, f"md5 {source.hash} != {target.hash}"))
+        if max_mismatches is not None and len(mismatches) >= max_mismatches:
+            break
+    return mismatches
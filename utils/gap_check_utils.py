@@ -1,29 +1,100 @@
-import re
+import heapq
 import os
+import re
+from array import array
+from typing import NamedTuple
+
+# Frame number at the end of a DPX file name, e.g. scan_0001234.dpx
+FRAME_NUMBER_PATTERN = re.compile(r'(\d+)\.dpx$', re.IGNORECASE)
+# Frame numbers sorted at a time by sorted_frames(), bounds the Python int list built by sorted()
+SORT_CHUNK_FRAMES = 65536
+
+
+class GapReport(NamedTuple):
+    """Result of a gap check over a DPX sequence"""
+    path: str
+    total_frames: int
+    first_frame: int
+    last_frame: int
+    first_dpx: str
+    last_dpx: str
+    missing_ranges: list
+    duplicates: list
+
+    @property
+    def missing_count(self) -> int:
+        return sum(end - start + 1 for start, end in self.missing_ranges)
+
+    @property
+    def has_gaps(self) -> bool:
+        return len(self.missing_ranges) > 0
 
 
 def iterate_folders(path):
     """
-       Iterate supplied path and return list
-       of filenames
+       Iterate supplied path with os.scandir and return the frame numbers
+       as a compact integer array along with the first and last .dpx paths
     """
-    file_nums = []
-    filenames = []
-    for root, _, files in os.walk(path):
-        for file in files:
-            if file.endswith(('.dpx', '.DPX')):
-                file_nums.append((int(re.search(r'\d+\.dpx', file).group().split('.dpx')[0])))
-                filenames.append(os.path.join(root, file))
-    return file_nums, filenames
-
-
-def find_missing(path):
-    gaps = False
-    file_nums, filenames = iterate_folders(path)
-    file_range = [x for x in range(min(file_nums), max(file_nums) + 1)]
-    first_dpx = filenames[file_nums.index(min(file_nums))]
-    last_dpx = filenames[file_nums.index(max(file_nums))]
-    missing = list(set(file_nums) ^ set(file_range))
-    if len(missing) > 0:
-        gaps = True
-    return gaps
+    file_nums = array('q')
+    first = (None, None)
+    last = (None, None)
+    stack = [path]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                    continue
+                match = FRAME_NUMBER_PATTERN.search(entry.name)
+                if match is None:
+                    continue
+                num = int(match.group(1))
+                file_nums.append(num)
+                if first[0] is None or num < first[0]:
+                    first = (num, entry.path)
+                if last[0] is None or num > last[0]:
+                    last = (num, entry.path)
+    return file_nums, first[1], last[1]
+
+
+def sorted_frames(file_nums):
+    """Yields the frame numbers of an array in ascending order
+
+    Chunks of SORT_CHUNK_FRAMES numbers are sorted into compact arrays and merged, so only one chunk at a time is held
+    as a list of Python ints rather than the whole sequence
+    """
+
+    chunks = [array('q', sorted(file_nums[start:start + SORT_CHUNK_FRAMES]))
+              for start in range(0, len(file_nums), SORT_CHUNK_FRAMES)]
+    if len(chunks) == 1:
+        return iter(chunks[0])
+    return heapq.merge(*chunks)
+
+
+def find_missing(path) -> GapReport:
+    """Function to find the missing and duplicated frames of a DPX sequence
+
+    Frame numbers are sorted with sorted_frames() and compared with their neighbour, every difference bigger than one
+    is a missing range and every difference of zero is a duplicated frame number
+    @param path: The folder containing the DPX sequence, sub folders are included
+    @return: A GapReport with the missing ranges, the duplicated frame numbers, the first and last frames
+    """
+
+    file_nums, first_dpx, last_dpx = iterate_folders(path)
+    if len(file_nums) == 0:
+        return GapReport(str(path), 0, -1, -1, None, None, [], [])
+
+    missing_ranges = []
+    duplicates = []
+    frames = sorted_frames(file_nums)
+    first_frame = previous = next(frames)
+    for num in frames:
+        diff = num - previous
+        if diff > 1:
+            missing_ranges.append((previous + 1, num - 1))
+        elif diff == 0 and (not duplicates or duplicates[-1] != num):
+            duplicates.append(num)
+        previous = num
+
+    return GapReport(str(path), len(file_nums), first_frame, previous, first_dpx, last_dpx,
+                     missing_ranges, duplicates)
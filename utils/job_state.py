@@ -0,0 +1,129 @@
+import datetime
+import os
+import sqlite3
+
+# Life cycle of a sequence across dpx_assessment.py, dpx_rawcook.py and dpx_post_rawcook.py
+STATE_DISCOVERED = 'discovered'
+STATE_ASSESSED = 'assessed'
+STATE_COOKING = 'cooking'
+STATE_COOKED = 'cooked'
+STATE_VERIFIED = 'verified'
+STATE_COMPLETED = 'completed'
+STATE_REVIEW = 'review'
+
+# Allowed <from state, to states> transitions, None is a sequence that is not known yet
+TRANSITIONS = {
+    # An mkv found in mkv_cooked without a job, e.g. cooked before the job state existed, is registered as cooked
+    None: {STATE_DISCOVERED, STATE_COOKED},
+    STATE_DISCOVERED: {STATE_ASSESSED, STATE_REVIEW},
+    STATE_ASSESSED: {STATE_COOKING, STATE_REVIEW},
+    # A cook interrupted by a crash goes back to assessed so that it is cooked again
+    STATE_COOKING: {STATE_COOKED, STATE_REVIEW, STATE_ASSESSED},
+    STATE_COOKED: {STATE_VERIFIED, STATE_REVIEW},
+    STATE_VERIFIED: {STATE_COMPLETED, STATE_REVIEW},
+    STATE_COMPLETED: set(),
+    # A sequence fixed by an operator and delivered again starts over
+    STATE_REVIEW: {STATE_DISCOVERED},
+}
+
+# States in which a sequence does not need to be cooked again
+COOKED_STATES = {STATE_COOKED, STATE_VERIFIED, STATE_COMPLETED}
+
+
+class JobStateStore:
+    """Durable per sequence state machine shared by the three scripts
+
+    Sequences are identified by their folder name, which does not change when they move between the workflow folders.
+    The reels of a multi reel delivery are identified by their work unit name, registered with alias().
+    Every transition is checked against TRANSITIONS and applied inside an immediate SQLite transaction, so two scripts
+    updating the same sequence at the same time cannot both succeed and a crash never leaves a half written state.
+    """
+
+    def __init__(self, db_path, timeout=60):
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        # The database sits on the share of the cook hosts, WAL needs shared memory that NFS and SMB do not provide,
+        # the rollback journal only relies on file locks. Setting it also converts a database left in WAL mode
+        self.connection.execute("PRAGMA journal_mode=DELETE")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (name TEXT PRIMARY KEY, path TEXT, state TEXT NOT NULL, "
+            "detail TEXT, updated TEXT NOT NULL)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS transitions (name TEXT NOT NULL, from_state TEXT, to_state TEXT NOT NULL, "
+            "detail TEXT, at TEXT NOT NULL)")
+        # <path, name> of the folders not identified by their own name
+        self.aliases = {}
+
+    def alias(self, path, name) -> None:
+        """Identifies the folder at path by name, used for the reels of a multi reel delivery"""
+        self.aliases[str(path)] = name
+
+    def name_of(self, seq_path) -> str:
+        return self.aliases.get(str(seq_path)) or os.path.basename(str(seq_path).rstrip(os.sep))
+
+    def state_of(self, seq_path):
+        """Returns the current state of a sequence or None if it is not known"""
+        row = self.connection.execute("SELECT state FROM jobs WHERE name = ?", (self.name_of(seq_path),)).fetchone()
+        return row[0] if row else None
+
+    def in_state(self, state) -> list:
+        """Returns the (name, path) of every sequence currently in state"""
+        return self.connection.execute("SELECT name, path FROM jobs WHERE state = ?", (state,)).fetchall()
+
+    def transition(self, seq_path, to_state, detail=None) -> bool:
+        """Moves a sequence to to_state if the transition from its current state is allowed
+
+        @param seq_path: The current path of the sequence folder
+        @param to_state: The new state
+        @param detail: Optional free text stored with the state, e.g. the reason of a review
+        @return: True if the transition was applied, False if it is not allowed from the current state
+        """
+
+        name = self.name_of(seq_path)
+        timestamp = datetime.datetime.now().strftime("%Y-%m-%d - %H:%M:%S")
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.connection.execute("SELECT state FROM jobs WHERE name = ?", (name,)).fetchone()
+            from_state = row[0] if row else None
+            if to_state not in TRANSITIONS.get(from_state, set()):
+                self.connection.execute("ROLLBACK")
+                return False
+            self.connection.execute(
+                "INSERT INTO jobs (name, path, state, detail, updated) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET path = excluded.path, state = excluded.state, "
+                "detail = excluded.detail, updated = excluded.updated",
+                (name, str(seq_path), to_state, detail, timestamp))
+            self.connection.execute(
+                "INSERT INTO transitions (name, from_state, to_state, detail, at) VALUES (?, ?, ?, ?, ?)",
+                (name, from_state, to_state, detail, timestamp))
+            self.connection.execute("COMMIT")
+            return True
+        except Exception:
+            self.connection.execute("ROLLBACK")
+            raise
+
+    def discover(self, seq_path) -> None:
+        """Registers a sequence, a sequence sent for review and delivered again starts over"""
+        if self.state_of(seq_path) in (None, STATE_REVIEW):
+            self.transition(seq_path, STATE_DISCOVERED)
+
+    def reset_interrupted_cooks(self, is_live=None) -> list:
+        """Moves the sequences left in cooking by a crashed run back to assessed
+
+        @param is_live: Optional callable telling from a sequence name if its cook is still running, e.g. on another
+        host holding its lease, such sequences are left in cooking
+        @return: The names of the reset sequences
+        """
+
+        names = []
+        for name, path in self.in_state(STATE_COOKING):
+            if is_live is not None and is_live(name):
+                continue
+            path = path or name
+            self.alias(path, name)
+            if self.transition(path, STATE_ASSESSED, 'cook interrupted'):
+                names.append(name)
+        return names
+
+    def close(self) -> None:
+        self.connection.close()
@@ -0,0 +1,188 @@
+import json
+import os
+import socket
+import threading
+import time
+from typing import NamedTuple
+
+# Extension of the lease files written to the lease folder
+LEASE_EXTENSION = '.lease'
+
+
+class Lease(NamedTuple):
+    """Content of a lease file"""
+    name: str
+    node: str
+    pid: int
+    acquired: float
+    # Time of the last heartbeat, the mtime of the lease file
+    heartbeat: float
+
+
+def default_node_name() -> str:
+    return socket.gethostname()
+
+
+class LeaseManager:
+    """Lease based claims on work units, shared by the hosts mounting the same FILM_OPS tree
+
+    A lease is a file <lease folder>/<name>.lease created with O_CREAT | O_EXCL, which is atomic on local filesystems
+    and on NFS v3 and later, so only one host can hold it. Its holder refreshes the mtime of the file every ttl / 3
+    seconds from a heartbeat thread. A lease whose mtime is older than ttl seconds belongs to a host that crashed or
+    lost the share and can be reclaimed: the stale file is renamed away first, which only one host can do, and a new
+    lease is created. ttl must be well above the clock skew between the hosts.
+    """
+
+    def __init__(self, lease_folder, node=None, ttl_seconds=300):
+        self.lease_folder = lease_folder
+        self.node = node or default_node_name()
+        self.ttl_seconds = ttl_seconds
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        # Names of the leases held by this process
+        self.held = set()
+        self.heartbeat_thread = None
+        self.stopping = threading.Event()
+        os.makedirs(lease_folder, exist_ok=True)
+
+    def path_for(self, name) -> str:
+        return os.path.join(self.lease_folder, f"{name}{LEASE_EXTENSION}")
+
+    def read(self, name, path=None):
+        """Returns the Lease stored for name, or in the lease file at path, None if there is none"""
+        path = path or self.path_for(name)
+        try:
+            with open(path, 'r') as file:
+                try:
+                    content = json.load(file)
+                except ValueError:
+                    # A lease being created by another host, still empty, counts as held
+                    content = {}
+            heartbeat = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return None
+        return Lease(name, content.get('node'), content.get('pid'), content.get('acquired'), heartbeat)
+
+    def is_expired(self, lease) -> bool:
+        return time.time() - lease.heartbeat > self.ttl_seconds
+
+    def holder(self, name):
+        """Returns the live Lease of name, None if nobody holds it or its holder stopped sending heartbeats"""
+        lease = self.read(name)
+        if lease is None or self.is_expired(lease):
+            return None
+        return lease
+
+    def held_by(self, name, pid) -> bool:
+        """Tells if the lease of name is still held by this node for the process pid, e.g. checked by a cook worker
+        on behalf of the process that acquired the lease
+        """
+        lease = self.read(name)
+        return lease is not None and (lease.node, lease.pid) == (self.node, pid)
+
+    def create(self, name) -> bool:
+        try:
+            descriptor = os.open(self.path_for(name), os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(descriptor, 'w') as file:
+            json.dump({'node': self.node, 'pid': self.pid, 'acquired': time.time()}, file)
+        return True
+
+    def try_acquire(self, name) -> bool:
+        """Claims name for this process
+
+        @param name: The name of the work unit
+        @return: True if the lease is held by this process, False if another live holder has it
+        """
+
+        with self.lock:
+            if name in self.held:
+                return True
+            if not self.create(name):
+                lease = self.read(name)
+                if lease is not None and not self.is_expired(lease):
+                    return False
+                # Only the host whose rename succeeds reclaims the expired lease
+                expired_path = f"{self.path_for(name)}.{self.node}.{self.pid}.expired"
+                try:
+                    os.rename(self.path_for(name), expired_path)
+                except FileNotFoundError:
+                    pass
+                else:
+                    renamed = self.read(name, expired_path)
+                    if renamed is not None and not self.is_expired(renamed):
+                        # Another host reclaimed the lease in between, the renamed file is its new lease
+                        try:
+                            os.link(expired_path, self.path_for(name))
+                        except FileExistsError:
+                            pass
+                        os.remove(expired_path)
+                        return False
+                    os.remove(expired_path)
+                if not self.create(name):
+                    return False
+            self.held.add(name)
+            return True
+
+    def release(self, name) -> None:
+        """Gives up a lease held by this process"""
+        with self.lock:
+            if name not in self.held:
+                return
+            self.held.discard(name)
+            lease = self.read(name)
+            if lease is not None and (lease.node, lease.pid) == (self.node, self.pid):
+                os.remove(self.path_for(name))
+
+    def heartbeat(self, on_error=None) -> list:
+        """Refreshes the mtime of every lease held by this process
+
+        A lease that can not be read or refreshed, e.g. ESTALE or EIO from the share, is kept and tried again by the
+        next heartbeat, it is only lost once another host has taken it over
+        @param on_error: Optional callable called with the name of the lease and the OSError of every failed refresh
+        @return: The names of the leases lost to another host, e.g. after the share was unreachable for longer than ttl
+        """
+
+        lost = []
+        with self.lock:
+            for name in list(self.held):
+                try:
+                    lease = self.read(name)
+                    if lease is None or (lease.node, lease.pid) != (self.node, self.pid):
+                        self.held.discard(name)
+                        lost.append(name)
+                        continue
+                    os.utime(self.path_for(name))
+                except OSError as e:
+                    if on_error:
+                        on_error(name, e)
+        return lost
+
+    def start_heartbeat(self, on_lost=None, on_error=None) -> None:
+        """Sends the heartbeats from a daemon thread until stop_heartbeat()
+
+        @param on_lost: Optional callable called with the name of every lease lost to another host
+        @param on_error: Optional callable called with the name of the lease and the OSError of every failed refresh,
+        the heartbeats go on
+        """
+
+        def beat():
+            while not self.stopping.wait(self.ttl_seconds / 3):
+                for name in self.heartbeat(on_error):
+                    if on_lost:
+                        on_lost(name)
+
+        self.stopping.clear()
+        self.heartbeat_thread = threading.Thread(target=beat, name='lease-heartbeat', daemon=True)
+        self.heartbeat_thread.start()
+
+    def stop_heartbeat(self) -> None:
+        self.stopping.set()
+        if self.heartbeat_thread is not None:
+            self.heartbeat_thread.join()
+            self.heartbeat_thread = None
+
+    def release_all(self) -> None:
+        for name in list(self.held):
+            self.release(name)
@@ -0,0 +1,95 @@
+import datetime
+import os
+import sqlite3
+import threading
+
+# States recorded by the DPX assessment, one per legacy text log
+STATE_SUCCESS = 'success'
+STATE_FAILURE = 'failure'
+STATE_REVIEW = 'review'
+STATE_V2 = 'v2'
+
+
+class SequenceLedger:
+    """Persistent record of the sequences that have already been processed
+
+    Backed by a SQLite database with one row per sequence path. The whole table is loaded into memory once when the
+    ledger is opened so that every lookup is a dictionary access instead of a scan of the append-only text logs.
+    The legacy text logs can be imported incrementally, only the bytes appended since the last import are read.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS sequences (path TEXT PRIMARY KEY, state TEXT NOT NULL, updated TEXT)")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS imported_logs (log_path TEXT PRIMARY KEY, offset INTEGER NOT NULL)")
+        self.states = dict(self.connection.execute("SELECT path, state FROM sequences"))
+
+    def state_of(self, path):
+        """Returns the recorded state of a sequence path or None if it has never been processed"""
+        return self.states.get(path)
+
+    def record(self, paths, state) -> None:
+        """Records the state of one or many sequence paths in a single transaction
+
+        @param paths: Iterable of sequence paths
+        @param state: The state to store for all of them
+        """
+
+        timestamp = datetime.datetime.now().strftime("%Y-%m-%d - %H:%M:%S")
+        rows = [(path, state, timestamp) for path in paths if path]
+        if not rows:
+            return
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT INTO sequences (path, state, updated) VALUES (?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET state = excluded.state, updated = excluded.updated", rows)
+            for path, _, _ in rows:
+                self.states[path] = state
+
+    def record_from_file(self, file_path, state) -> None:
+        """Records every path listed in a text file, one path per line
+
+        @param file_path: The text file, usually one of the temporary lists of a script
+        @param state: The state to store for all of them
+        """
+
+        if not os.path.exists(file_path):
+            return
+        with open(file_path, 'r') as file:
+            self.record([line.strip() for line in file], state)
+
+    def import_log(self, log_path, state) -> int:
+        """Imports the sequence paths of a legacy text log
+
+        Only the part of the log written after the previous import is read, a log that shrank is read again entirely
+        @param log_path: The append-only text log with one sequence path per line
+        @param state: The state given to the imported paths
+        @return: The number of imported lines
+        """
+
+        if not os.path.exists(log_path):
+            return 0
+        row = self.connection.execute("SELECT offset FROM imported_logs WHERE log_path = ?", (log_path,)).fetchone()
+        offset = row[0] if row else 0
+        if os.path.getsize(log_path) < offset:
+            offset = 0
+
+        with open(log_path, 'r') as file:
+            file.seek(offset)
+            lines = [line.strip() for line in file]
+            offset = file.tell()
+
+        self.record(lines, state)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO imported_logs (log_path, offset) VALUES (?, ?) "
+                "ON CONFLICT(log_path) DO UPDATE SET offset = excluded.offset", (log_path, offset))
+        return len(lines)
+
+    def close(self) -> None:
+        self.connection.close()
@@ -1,20 +1,222 @@
 # utils/logging_utils.py
 
+import atexit
+import contextlib
+import contextvars
 import datetime
+import json
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import threading
 
+try:
+    import fcntl
+except ImportError:
+    # No file locks on Windows, the log files are rotated without them
+    fcntl = None
 
-def log(logfile, message):
+# Correlation ID attached to every message logged in the current context, usually the name of the sequence
+current_correlation_id = contextvars.ContextVar('correlation_id', default=None)
+
+# Single queue and single writer of the current process tree, created on the first log() call
+_queue = None
+_listener = None
+_logger = None
+_owner_pid = None
+_setup_lock = threading.Lock()
+
+
+class _RotatingSink:
+    """Append-only file rotated to <path>.1 ... <path>.<backups> once it grows past max_bytes
+
+    The same log file is written by several processes, e.g. a cron run next to the daemon or the cook hosts sharing
+    SCRIPT_LOG, so every line is a single unbuffered O_APPEND write that is never split, and the size is read from the
+    file itself. The rotation happens under an exclusive lock of <path>.lock, and a file renamed by another process,
+    or by logrotate, is reopened before the next write.
+    """
+
+    def __init__(self, path, max_bytes, backups):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.fd = None
+        self.open()
+
+    def open(self):
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def reopen_if_moved(self):
+        try:
+            current = os.stat(self.path)
+        except FileNotFoundError:
+            current = None
+        own = os.fstat(self.fd)
+        if current is None or (current.st_dev, current.st_ino) != (own.st_dev, own.st_ino):
+            os.close(self.fd)
+            self.open()
+
+    def rotate(self):
+        with open(f"{self.path}.lock", 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            # Another process may have rotated the file while this one waited for the lock
+            self.reopen_if_moved()
+            if os.fstat(self.fd).st_size <= self.max_bytes:
+                return
+            for index in range(self.backups - 1, 0, -1):
+                if os.path.exists(f"{self.path}.{index}"):
+                    os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+            if self.backups > 0:
+                os.replace(self.path, f"{self.path}.1")
+            else:
+                os.remove(self.path)
+            os.close(self.fd)
+            self.open()
+
+    def write(self, line):
+        data = line.encode('utf-8')
+        self.reopen_if_moved()
+        size = os.fstat(self.fd).st_size
+        if self.max_bytes and size > 0 and size + len(data) > self.max_bytes:
+            self.rotate()
+        os.write(self.fd, data)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _Router(logging.Handler):
+    """The single writer: routes every record to the text and JSON lines sinks of its log file and to the console
+    """
+
+    def __init__(self, max_bytes, backups, json_lines, console):
+        super().__init__()
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.json_lines = json_lines
+        self.console = console
+        self.sinks = {}
+
+    def sinks_for(self, logfile):
+        if logfile not in self.sinks:
+            sinks = [_RotatingSink(logfile, self.max_bytes, self.backups)]
+            if self.json_lines:
+                sinks.append(_RotatingSink(f"{os.path.splitext(logfile)[0]}.jsonl", self.max_bytes, self.backups))
+            self.sinks[logfile] = sinks
+        return self.sinks[logfile]
+
+    def emit(self, record):
+        timestamp = datetime.datetime.fromtimestamp(record.created)
+        text = f"{timestamp.strftime('%Y-%m-%d - %H:%M:%S')} - {record.getMessage()}"
+        sinks = self.sinks_for(record.logfile)
+        sinks[0].write(text + "\n")
+        if self.json_lines:
+            sinks[1].write(json.dumps({
+                'time': timestamp.isoformat(timespec='milliseconds'),
+                'level': record.levelname,
+                'log': os.path.basename(record.logfile),
+                'correlation_id': record.correlation_id,
+                'pid': record.process,
+                'thread': record.threadName,
+                'message': record.getMessage(),
+            }) + "\n")
+        if self.console:
+            print(text)
+
+    def close(self):
+        for sinks in self.sinks.values():
+            for sink in sinks:
+                sink.close()
+        self.sinks = {}
+        super().close()
+
+
+def _level_of(message):
+    if message.startswith('ERROR'):
+        return logging.ERROR
+    if message.startswith(('FAIL', 'WARNING', 'UNKNOWN ENCODING ERROR')):
+        return logging.WARNING
+    return logging.INFO
+
+
+def _setup():
+    """Starts the writer thread on the first log() call of a process tree
+
+    Processes forked after this point inherit the multiprocessing queue, their messages are written by the same
+    thread of the parent process. The settings are read here and not on import so that the .env file loaded by the
+    scripts after their imports is taken into account.
+    """
+
+    global _queue, _listener, _logger, _owner_pid
+    with _setup_lock:
+        if _logger is not None:
+            return
+        max_bytes = int(float(os.environ.get('LOG_MAX_MB') or 50) * 1024 ** 2)
+        backups = int(os.environ.get('LOG_BACKUPS') or 5)
+        json_lines = os.environ.get('LOG_JSON', 'true').lower() in ('1', 'true', 'yes')
+        console = os.environ.get('LOG_CONSOLE', 'true').lower() in ('1', 'true', 'yes')
+
+        _queue = multiprocessing.Queue()
+        _listener = logging.handlers.QueueListener(_queue, _Router(max_bytes, backups, json_lines, console))
+        _listener.start()
+        _owner_pid = os.getpid()
+        atexit.register(shutdown)
+
+        logger = logging.getLogger('rawcooked_usc_dr')
+        logger.propagate = False
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(logging.handlers.QueueHandler(_queue))
+        _logger = logger
+
+
+def shutdown():
+    """Writes the queued messages and stops the writer, called automatically when the process exits"""
+    global _listener, _logger
+    with _setup_lock:
+        # A forked child must not stop the writer of its parent
+        if _listener is None or os.getpid() != _owner_pid:
+            return
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+        _logger = None
+
+
+@contextlib.contextmanager
+def correlation(seq_path):
+    """Context manager tagging every message logged inside it with the name of a sequence
+
+    @param seq_path: The sequence path or name, its last component is the correlation ID
+    """
+
+    token = current_correlation_id.set(os.path.basename(str(seq_path).rstrip(os.sep)))
+    try:
+        yield
+    finally:
+        current_correlation_id.reset(token)
+
+
+def log(logfile, message, correlation_id=None):
     """
     Function to append message to a log file
+    The message is queued and written by a single writer thread, to the human readable log file, to a JSON lines
+    file next to it (<logfile without extension>.jsonl) and to the console. Both files are rotated past LOG_MAX_MB.
     @param logfile: The path of the log file
     @param message: The message that we want to append
+    @param correlation_id: Sequence path or name tagging the message, defaults to the one set by correlation()
     """
 
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d - %H:%M:%S")
-    log_message = f"{timestamp} - {message}"
-    with open(logfile, "a") as file:
-        file.write(log_message + "\n")
-    print(log_message)
+    if _logger is None:
+        _setup()
+    if correlation_id:
+        correlation_id = os.path.basename(str(correlation_id).rstrip(os.sep))
+    _logger.log(_level_of(message), message, extra={
+        'logfile': str(logfile),
+        'correlation_id': correlation_id or current_correlation_id.get(),
+    })
 
 
 def write_permanent_logs(source_temp_file, target_file):
@@ -28,4 +230,4 @@ def write_permanent_logs(source_temp_file, target_file):
 
     with open(target_file, 'a') as target:
         with open(source_temp_file, 'r') as source:
-            target.write(source.read())
\ No newline at end of file
+            target.write(source.read())
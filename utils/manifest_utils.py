@@ -0,0 +1,131 @@
+import hashlib
+import mmap
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# Extension of the manifest written next to each sequence folder
+MANIFEST_EXTENSION = '.manifest'
+
+# Bytes hashed per step, big enough for hashlib to release the GIL and let the threads work in parallel
+CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def manifest_path_for(seq_path) -> str:
+    """Function to return the path of the manifest of a sequence, stored next to the sequence folder
+
+    @param seq_path: The sequence folder
+    @return: <seq_path>.manifest
+    """
+
+    return f"{str(seq_path).rstrip(os.sep)}{MANIFEST_EXTENSION}"
+
+
+def hash_file(path, chunk_size=CHUNK_SIZE) -> tuple:
+    """Function to compute the MD5 and BLAKE2b checksums of a file in a single read
+
+    The file is memory mapped and fed to both hashes chunk by chunk
+    @param path: The file to hash
+    @param chunk_size: Number of bytes hashed per step
+    @return: Tuple of (md5 hex digest, blake2b hex digest, size in bytes)
+    """
+
+    md5 = hashlib.md5()
+    blake2b = hashlib.blake2b()
+    with open(path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if size > 0:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    for offset in range(0, size, chunk_size):
+                        chunk = view[offset:offset + chunk_size]
+                        md5.update(chunk)
+                        blake2b.update(chunk)
+                        chunk.release()
+                finally:
+                    view.release()
+    return md5.hexdigest(), blake2b.hexdigest(), size
+
+
+def list_frames(folder) -> list:
+    """Function to list the .dpx files below a folder, sorted by path"""
+    frames = []
+    for root, _, files in os.walk(folder):
+        frames.extend(os.path.join(root, file) for file in files if file.lower().endswith('.dpx'))
+    return sorted(frames)
+
+
+def hash_frames(base_folder, frames, workers=4) -> dict:
+    """Function to hash many frames on a pool of threads
+
+    @param base_folder: The folder the frame paths are made relative to
+    @param frames: The frame paths
+    @param workers: Number of threads
+    @return: Dictionary with <relative path, (md5, blake2b, size)> pairs
+    """
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        hashes = executor.map(hash_file, frames)
+        return {os.path.relpath(frame, base_folder): digest for frame, digest in zip(frames, hashes)}
+
+
+def build_manifest(seq_path, workers=4) -> str:
+    """Function to write the per frame checksum manifest of a sequence
+
+    One line per frame: <md5> <blake2b> <size> <path relative to the sequence folder>
+    The manifest is written to a temporary file first and renamed, so a partial manifest is never left behind
+    @param seq_path: The sequence folder
+    @param workers: Number of threads hashing frames
+    @return: The path of the manifest
+    """
+
+    manifest_path = manifest_path_for(seq_path)
+    entries = hash_frames(seq_path, list_frames(seq_path), workers)
+    temp_path = f"{manifest_path}.tmp"
+    with open(temp_path, 'w') as file:
+        file.write("# md5 blake2b size path\n")
+        for relative_path in sorted(entries):
+            md5, blake2b, size = entries[relative_path]
+            file.write(f"{md5} {blake2b} {size} {relative_path}\n")
+    os.replace(temp_path, manifest_path)
+    return manifest_path
+
+
+def read_manifest(manifest_path) -> dict:
+    """Function to read a manifest written by build_manifest()
+
+    @param manifest_path: The manifest file
+    @return: Dictionary with <relative path, (md5, blake2b, size)> pairs
+    """
+
+    entries = {}
+    with open(manifest_path, 'r') as file:
+        for line in file:
+            if line.startswith('#') or not line.strip():
+                continue
+            md5, blake2b, size, relative_path = line.rstrip('\n').split(' ', 3)
+            entries[relative_path] = (md5, blake2b, int(size))
+    return entries
+
+
+def verify_folder(folder, manifest_path, workers=4) -> list:
+    """Function to check the frames of a folder, e.g. a decoded MKV, against the manifest of the source
+
+    @param folder: The folder holding the frames under the same relative paths as the source sequence
+    @param manifest_path: The manifest of the source sequence
+    @param workers: Number of threads hashing frames
+    @return: List of (relative path, reason) for every missing, extra or different frame, empty if all match
+    """
+
+    expected = read_manifest(manifest_path)
+    actual = hash_frames(folder, list_frames(folder), workers)
+
+    mismatches = []
+    for relative_path in sorted(expected.keys() | actual.keys()):
+        if relative_path not in actual:
+            mismatches.append((relative_path, 'missing'))
+        elif relative_path not in expected:
+            mismatches.append((relative_path, 'not in manifest'))
+        elif actual[relative_path] != expected[relative_path]:
+            mismatches.append((relative_path, 'checksum mismatch'))
+    return mismatches
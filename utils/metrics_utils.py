@@ -0,0 +1,278 @@
+# utils/metrics_utils.py
+
+import contextlib
+import http.server
+import os
+import resource
+import threading
+import time
+
+from utils import logging_utils
+
+# <name, (type, help)> of every metric, the names follow the Prometheus conventions
+METRICS = {
+    'rawcook_stage_seconds': ('summary', "Wall time of the stages of a script"),
+    'rawcook_sequence_seconds': ('summary', "Wall time spent on one sequence by a step of a script"),
+    'rawcook_sequences_total': ('counter', "Sequences handled by a script, by outcome"),
+    'rawcook_queue_depth': ('gauge', "Sequences or files waiting in a queue of a script"),
+    'rawcook_bytes_read_total': ('counter', "Bytes of DPX sequences read by the cooks"),
+    'rawcook_bytes_written_total': ('counter', "Bytes of mkv files written by the cooks"),
+    'rawcook_batch_throughput_bytes_per_second': ('gauge', "Source bytes cooked per second of the last cook batch"),
+    'rawcook_lease_heartbeat_errors_total': ('counter', "Lease heartbeats that failed, e.g. on an unreachable share"),
+    'rawcook_subprocess_seconds': ('summary', "Wall time of the subprocesses run by shell_utils, by outcome"),
+    'rawcook_subprocess_cpu_seconds_total': ('counter', "User and system CPU time of the subprocesses"),
+    'rawcook_subprocess_max_rss_bytes': ('gauge', "Largest resident set size reached by a subprocess"),
+    'rawcook_process_cpu_seconds': ('gauge', "User and system CPU time of the script process"),
+    'rawcook_process_max_rss_bytes': ('gauge', "Largest resident set size of the script process"),
+    'rawcook_process_read_bytes': ('gauge', "Bytes the script process read from storage"),
+    'rawcook_process_written_bytes': ('gauge', "Bytes the script process wrote to storage"),
+    'rawcook_last_run_timestamp_seconds': ('gauge', "Time the metrics of the script were last written"),
+}
+
+# Script the process runs, the label of the metrics recorded outside of a script, e.g. by shell_utils
+_process_script = None
+_server = None
+_lock = threading.Lock()
+
+
+class Registry:
+    """In memory store of the metrics of the process, rendered in the Prometheus text exposition format
+
+    Counters and gauges hold one value per label set, summaries hold the count and the sum of the observations
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # <(name, sorted label items), value>
+        self.values = {}
+
+    @staticmethod
+    def key(name, labels) -> tuple:
+        if name not in METRICS:
+            raise KeyError(f"Unknown metric {name}")
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name, value=1, **labels) -> None:
+        key = self.key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels) -> None:
+        key = self.key(name, labels)
+        with self.lock:
+            self.values[key] = value
+
+    def set_max(self, name, value, **labels) -> None:
+        key = self.key(name, labels)
+        with self.lock:
+            self.values[key] = max(self.values.get(key, value), value)
+
+    def observe(self, name, value, **labels) -> None:
+        key = self.key(name, labels)
+        with self.lock:
+            count, total = self.values.get(key, (0, 0.0))
+            self.values[key] = (count + 1, total + value)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return dict(self.values)
+
+    def merge(self, values) -> None:
+        """Adds the values recorded by a worker process, see begin_worker_job()
+
+        Counters and summaries are added up, gauges keep the highest value as the workers only record peak values
+        """
+
+        with self.lock:
+            for key, value in values.items():
+                kind = METRICS[key[0]][0]
+                if key not in self.values:
+                    self.values[key] = value
+                elif kind == 'summary':
+                    count, total = self.values[key]
+                    self.values[key] = (count + value[0], total + value[1])
+                elif kind == 'counter':
+                    self.values[key] += value
+                else:
+                    self.values[key] = max(self.values[key], value)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.values.clear()
+
+    def render(self, script=None) -> str:
+        """Returns the metrics in the Prometheus text format
+
+        @param script: Only render the metrics labelled with this script, None renders all of them
+        """
+
+        with self.lock:
+            items = sorted(self.values.items())
+        lines = []
+        described = set()
+        for (name, labels), value in items:
+            if script is not None and ('script', script) not in labels:
+                continue
+            kind, description = METRICS[name]
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} {kind}")
+            label_text = ','.join(f'{key}="{escape(value)}"' for key, value in labels)
+            label_text = f"{{{label_text}}}" if label_text else ''
+            if kind == 'summary':
+                lines.append(f"{name}_count{label_text} {value[0]}")
+                lines.append(f"{name}_sum{label_text} {value[1]:.6f}")
+            else:
+                lines.append(f"{name}{label_text} {value if isinstance(value, int) else f'{value:.6f}'}")
+        return '\n'.join(lines) + '\n'
+
+
+def escape(value) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REGISTRY = Registry()
+
+
+def inc(name, value=1, **labels) -> None:
+    REGISTRY.inc(name, value, **labels)
+
+
+def set_gauge(name, value, **labels) -> None:
+    REGISTRY.set(name, value, **labels)
+
+
+def observe(name, value, **labels) -> None:
+    REGISTRY.observe(name, value, **labels)
+
+
+@contextlib.contextmanager
+def timed(name, **labels):
+    """Context manager observing the wall time of its body in a summary"""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        REGISTRY.observe(name, time.monotonic() - start, **labels)
+
+
+def stage(script, name):
+    """Context manager timing one stage of a script, see timed()"""
+    return timed('rawcook_stage_seconds', script=script, stage=name)
+
+
+def record_subprocess(command, seconds, cpu_seconds, max_rss_bytes, returncode, script=None) -> None:
+    """Records the wall time, CPU time and peak memory of a finished subprocess
+
+    @param command: The program, e.g. rawcooked
+    @param script: The script that ran it, defaults to the script of the process
+    """
+
+    script = script or _process_script or 'unknown'
+    command = os.path.basename(str(command))
+    outcome = 'ok' if returncode == 0 else 'error'
+    REGISTRY.observe('rawcook_subprocess_seconds', seconds, script=script, command=command, outcome=outcome)
+    if cpu_seconds is not None:
+        REGISTRY.inc('rawcook_subprocess_cpu_seconds_total', cpu_seconds, script=script, command=command)
+    if max_rss_bytes is not None:
+        REGISTRY.set_max('rawcook_subprocess_max_rss_bytes', max_rss_bytes, script=script, command=command)
+
+
+def begin_worker_job(script) -> None:
+    """Starts a job in a worker process of a pool, e.g. a cook, from an empty registry
+
+    A forked worker inherits the metrics of its parent and is reused for several jobs, so the registry is cleared first.
+    The job returns REGISTRY.snapshot() with its result and the parent merges it with REGISTRY.merge().
+    """
+
+    global _process_script
+    _process_script = script
+    REGISTRY.clear()
+
+
+def process_io() -> tuple:
+    """Returns the (read, written) bytes of the process, from /proc/self/io on Linux and the block counts elsewhere"""
+    try:
+        with open('/proc/self/io', 'r') as file:
+            fields = dict(line.split(':', 1) for line in file if ':' in line)
+        return int(fields['read_bytes']), int(fields['write_bytes'])
+    except (OSError, KeyError, ValueError):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_inblock * 512, usage.ru_oublock * 512
+
+
+def collect_process(script) -> None:
+    """Records the CPU time, peak memory and storage I/O of the process so far"""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    read_bytes, written_bytes = process_io()
+    REGISTRY.set('rawcook_process_cpu_seconds', round(usage.ru_utime + usage.ru_stime, 3), script=script)
+    # ru_maxrss is in KiB on Linux
+    REGISTRY.set('rawcook_process_max_rss_bytes', usage.ru_maxrss * 1024, script=script)
+    REGISTRY.set('rawcook_process_read_bytes', read_bytes, script=script)
+    REGISTRY.set('rawcook_process_written_bytes', written_bytes, script=script)
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        if _process_script:
+            collect_process(_process_script)
+        body = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start(script, logfile=None) -> None:
+    """Names the script of the process and serves /metrics on METRICS_PORT if it is set
+
+    Only the first call of a process starts the server, e.g. the daemon running the three scripts serves them all.
+    The settings are read here and not on import so that the .env file loaded by the scripts is taken into account.
+    A port already in use, e.g. by another script started by cron at the same time, only disables the endpoint.
+    @param script: The name of the script, the script label of its metrics
+    @param logfile: Log file where the address of the endpoint or the error is written
+    """
+
+    global _process_script, _server
+    with _lock:
+        _process_script = _process_script or script
+        port = int(os.environ.get('METRICS_PORT') or 0)
+        if _server is not None or not port:
+            return
+        address = os.environ.get('METRICS_ADDRESS') or '127.0.0.1'
+        try:
+            _server = http.server.ThreadingHTTPServer((address, port), _MetricsHandler)
+        except OSError as e:
+            if logfile:
+                logging_utils.log(logfile, f"WARNING: metrics endpoint not served on {address}:{port}: {e}")
+            return
+        _server.daemon_threads = True
+        threading.Thread(target=_server.serve_forever, name='metrics-http', daemon=True).start()
+        if logfile:
+            logging_utils.log(logfile, f"Serving metrics on http://{address}:{port}/metrics")
+
+
+def write_textfile(folder, script) -> str:
+    """Writes the metrics of a script to <folder>/<script>.prom for the node_exporter textfile collector
+
+    The file is written under a temporary name and renamed so the collector never reads a partial file
+    @return: The path of the file
+    """
+
+    collect_process(script)
+    REGISTRY.set('rawcook_last_run_timestamp_seconds', round(time.time(), 3), script=script)
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f"{script}.prom")
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as file:
+        file.write(REGISTRY.render(script))
+    os.replace(temp_path, path)
+    return path
@@ -0,0 +1,244 @@
+import hashlib
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+# Extension of the journal written next to the destination of a cross device move
+JOURNAL_EXTENSION = '.move-journal'
+# Extension of a file while it is being copied
+PART_EXTENSION = '.part'
+# A cross device move copies into the hidden .<name>.moving next to its target and renames it once the copy is checked
+STAGING_EXTENSION = '.moving'
+# Last line of the journal of a move whose copy is complete and renamed to its target
+JOURNAL_COMPLETE = 'complete'
+
+# Journal entry of a move whose source is a single file
+SINGLE_FILE = '.'
+
+# Bytes copied per system call
+CHUNK_SIZE = 64 * 1024 * 1024
+
+
+def resolve_destination(source, destination) -> str:
+    """Function to resolve the final path of a move with the same rules as shutil.move
+
+    @param source: The file or folder being moved
+    @param destination: A folder to move into or the new path
+    @return: The final path of the moved file or folder
+    """
+
+    # An interrupted move already created its destination, it is the target and not a folder to move into
+    if os.path.exists(f"{destination}{JOURNAL_EXTENSION}"):
+        return str(destination)
+    if os.path.isdir(destination):
+        return os.path.join(destination, os.path.basename(str(source).rstrip(os.sep)))
+    return str(destination)
+
+
+def staging_path_for(target) -> str:
+    """Function to return the hidden path a cross device move copies into before it is renamed to target"""
+    target = str(target).rstrip(os.sep)
+    return os.path.join(os.path.dirname(target), f".{os.path.basename(target)}{STAGING_EXTENSION}")
+
+
+def is_staging(name) -> bool:
+    """Function to tell if a folder entry is a move still being copied, the scripts must not pick it up"""
+    return name.startswith('.') and name.endswith(STAGING_EXTENSION)
+
+
+def same_device(source, destination) -> bool:
+    """Function to check if a move can be done with a rename
+
+    @param source: The file or folder being moved
+    @param destination: The final path, its parent folder has to exist
+    @return: True if both are on the same filesystem
+    """
+
+    parent = os.path.dirname(os.path.abspath(destination))
+    return os.stat(source).st_dev == os.stat(parent).st_dev
+
+
+def copy_file(source, destination, chunk_size=CHUNK_SIZE) -> None:
+    """Function to copy a file in the kernel when possible
+
+    Uses copy_file_range, then sendfile, then a plain buffered copy depending on what the platform supports
+    @param source: The file to copy
+    @param destination: The new file
+    @param chunk_size: Number of bytes copied per system call
+    """
+
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        src_fd, dst_fd = src.fileno(), dst.fileno()
+        size = os.fstat(src_fd).st_size
+        copied = 0
+        for method in ('copy_file_range', 'sendfile'):
+            if not hasattr(os, method):
+                continue
+            try:
+                while copied < size:
+                    count = min(chunk_size, size - copied)
+                    if method == 'copy_file_range':
+                        sent = os.copy_file_range(src_fd, dst_fd, count, copied, copied)
+                    else:
+                        os.lseek(dst_fd, copied, os.SEEK_SET)
+                        sent = os.sendfile(dst_fd, src_fd, copied, count)
+                    if sent == 0:
+                        break
+                    copied += sent
+            except OSError:
+                pass
+            if copied >= size:
+                break
+        if copied < size:
+            src.seek(copied)
+            dst.seek(copied)
+            shutil.copyfileobj(src, dst, chunk_size)
+    shutil.copystat(source, destination)
+
+
+def hash_file(path, chunk_size=CHUNK_SIZE) -> str:
+    """Function to return the BLAKE2b digest of a file"""
+    digest = hashlib.blake2b()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_journal(journal_path) -> dict:
+    """Function to read the files already copied by an interrupted move
+
+    @param journal_path: The journal of the move
+    @return: Dictionary with <relative path, size> pairs
+    """
+
+    done = {}
+    if os.path.exists(journal_path):
+        with open(journal_path, 'r') as journal:
+            for line in journal:
+                size, _, relative_path = line.rstrip('\n').partition(' ')
+                if relative_path:
+                    done[relative_path] = int(size)
+    return done
+
+
+def journal_complete(journal_path) -> bool:
+    """Function to tell if the journal of a move records that its copy was complete and renamed to its target"""
+    if not os.path.exists(journal_path):
+        return False
+    with open(journal_path, 'r') as journal:
+        return any(line.rstrip('\n') == JOURNAL_COMPLETE for line in journal)
+
+
+def list_sizes(path) -> dict:
+    """Function to list the files of a file or folder
+
+    @return: Dictionary with <relative path, size> pairs, SINGLE_FILE for a file, empty if the path does not exist
+    """
+
+    if not os.path.exists(path):
+        return {}
+    if not os.path.isdir(path):
+        return {SINGLE_FILE: os.path.getsize(path)}
+    sizes = {}
+    for root, dirs, file_names in os.walk(path):
+        relative_root = os.path.relpath(root, path)
+        for file_name in file_names:
+            relative_path = os.path.normpath(os.path.join(relative_root, file_name))
+            sizes[relative_path] = os.path.getsize(os.path.join(root, file_name))
+    return sizes
+
+
+def copy_tree_resumable(source, target, workers=4, verify_hash=False, journal_path=None) -> None:
+    """Function to copy a file or folder to another filesystem so that an interrupted copy can be resumed
+
+    Every file is copied to <name>.part, checked and renamed, then recorded in <target>.move-journal
+    A second call skips the files recorded in the journal whose copy still has the right size
+    @param source: The file or folder to copy
+    @param target: The final path
+    @param workers: Number of files copied in parallel
+    @param verify_hash: Compare the BLAKE2b digest of each copy with its source on top of the size
+    @param journal_path: The journal of the copy, defaults to <target>.move-journal
+    @raise IOError: If a copy does not match its source
+    """
+
+    journal_path = journal_path or f"{target}{JOURNAL_EXTENSION}"
+    done = read_journal(journal_path)
+
+    if os.path.isdir(source):
+        files = []
+        for root, dirs, file_names in os.walk(source):
+            relative_root = os.path.relpath(root, source)
+            os.makedirs(os.path.join(target, relative_root), exist_ok=True)
+            files.extend(os.path.normpath(os.path.join(relative_root, file_name)) for file_name in file_names)
+    else:
+        files = [SINGLE_FILE]
+
+    def copy_one(relative_path):
+        src = source if relative_path == SINGLE_FILE else os.path.join(source, relative_path)
+        dst = target if relative_path == SINGLE_FILE else os.path.join(target, relative_path)
+        size = os.path.getsize(src)
+        if done.get(relative_path) == size and os.path.exists(dst) and os.path.getsize(dst) == size:
+            return None
+        part = f"{dst}{PART_EXTENSION}"
+        copy_file(src, part)
+        if os.path.getsize(part) != size or (verify_hash and hash_file(part) != hash_file(src)):
+            os.remove(part)
+            raise IOError(f"Copy of {src} does not match its source")
+        os.replace(part, dst)
+        return relative_path, size
+
+    with open(journal_path, 'a') as journal, ThreadPoolExecutor(max_workers=workers) as executor:
+        for copied in executor.map(copy_one, files):
+            if copied is not None:
+                journal.write(f"{copied[1]} {copied[0]}\n")
+                journal.flush()
+
+    if os.path.isdir(source):
+        shutil.copystat(source, target)
+
+
+def move_path(source, destination, workers=4, verify_hash=False) -> str:
+    """Function to move a file or folder, used instead of shutil.move for sequence folders
+
+    On the same filesystem the move is a single atomic rename. Across filesystems the content is copied in parallel
+    with copy_tree_resumable() into a hidden staging folder next to the target, see staging_path_for(), which is
+    renamed to the target once every file has been copied and checked. The scripts never see a half copied sequence
+    under its real name. The journal is removed before the source, which is deleted last, so an interrupted move can
+    be started again and only copies what is missing. A complete journal is only trusted while its staging folder
+    exists or its target holds the same files as the source, another source with the same name is never deleted
+    without being copied.
+    @param source: The file or folder to move
+    @param destination: A folder to move into or the new path
+    @param workers: Number of files copied in parallel across filesystems
+    @param verify_hash: Compare the BLAKE2b digest of each copy with its source on top of the size
+    @return: The final path
+    """
+
+    target = resolve_destination(source, destination)
+    journal_path = f"{target}{JOURNAL_EXTENSION}"
+    staging = staging_path_for(target)
+    if os.path.exists(target) and not os.path.exists(journal_path):
+        raise FileExistsError(f"Destination path {target} already exists")
+    if journal_complete(journal_path) and not os.path.exists(staging) and list_sizes(source) != list_sizes(target):
+        raise FileExistsError(f"Destination path {target} already exists, {journal_path} is left by another move")
+
+    if same_device(source, target):
+        os.rename(source, target)
+        return target
+
+    if not journal_complete(journal_path):
+        if os.path.exists(target) and not os.path.exists(staging):
+            # Left by a move interrupted before the copies were staged, it is resumed in the staging folder
+            os.rename(target, staging)
+        copy_tree_resumable(source, staging, workers, verify_hash, journal_path)
+        with open(journal_path, 'a') as journal:
+            journal.write(f"{JOURNAL_COMPLETE}\n")
+    if os.path.exists(staging):
+        os.rename(staging, target)
+    os.remove(journal_path)
+    if os.path.isdir(source):
+        shutil.rmtree(source)
+    else:
+        os.remove(source)
+    return target
@@ -0,0 +1,164 @@
+import os
+import shutil
+from typing import NamedTuple
+
+# Orderings accepted by plan_batch()
+ORDER_LARGEST_FIRST = 'largest'
+ORDER_SHORTEST_FIRST = 'shortest'
+ORDER_FIFO = 'fifo'
+
+
+class CookCandidate(NamedTuple):
+    """A sequence waiting to be cooked along with its measured size"""
+    seq_path: str
+    dpx_folder: str
+    v2: bool
+    frames: int
+    bytes_per_frame: int
+    # Expected mkv size relative to total_bytes learned from past cooks, None uses the default of the planner
+    mkv_ratio: float = None
+    # Cooking speed of one worker in bytes per second learned from past cooks, None uses the default of the planner
+    throughput: float = None
+    # Name of the work unit, see scan_utils.WorkUnit, None uses the name of seq_path
+    name: str = None
+
+    @property
+    def total_bytes(self) -> int:
+        return self.frames * self.bytes_per_frame
+
+    @property
+    def mkv_name(self) -> str:
+        return self.name or os.path.basename(self.seq_path)
+
+
+def estimate_seconds(candidate: CookCandidate, throughput) -> float:
+    """Function to estimate the wall clock time of a cook
+
+    @param candidate: The sequence to estimate
+    @param throughput: Cooking speed of one worker in bytes per second, used when the candidate has none
+    @return: The estimated duration in seconds
+    """
+
+    return candidate.total_bytes / (candidate.throughput or throughput)
+
+
+def order_candidates(candidates: list, order=ORDER_LARGEST_FIRST) -> list:
+    """Function to sort the candidates in the order they should be handed to the workers
+
+    Largest first keeps the huge reels from being started last and leaving the other workers idle at the end of the
+    run, shortest first gets the most sequences done as early as possible. FIFO keeps the discovery order.
+    @param candidates: List of CookCandidate
+    @param order: One of largest, shortest or fifo
+    @return: The sorted list
+    """
+
+    if order == ORDER_LARGEST_FIRST:
+        return sorted(candidates, key=lambda c: c.total_bytes, reverse=True)
+    if order == ORDER_SHORTEST_FIRST:
+        return sorted(candidates, key=lambda c: c.total_bytes)
+    if order == ORDER_FIFO:
+        return list(candidates)
+    raise ValueError(f"Unknown batch order: {order}")
+
+
+def plan_batch(candidates: list, order=ORDER_LARGEST_FIRST, max_count=None, max_bytes=None, max_seconds=None,
+               throughput=None, workers=1, free_bytes=None, mkv_ratio=1.0) -> tuple:
+    """Function to pick the sequences cooked in this run
+
+    Walks through the ordered candidates and keeps every sequence that still fits in all the budgets:
+    - max_count: number of sequences
+    - max_bytes: total source bytes of the batch
+    - max_seconds: estimated wall clock time of the batch spread over the workers, needs throughput
+    - free_bytes: free space on the MKV volume, each sequence is expected to take total_bytes times its own
+      mkv_ratio, or the mkv_ratio given here when the candidate has none
+    A sequence that does not fit is deferred to the next run but smaller ones after it can still be picked.
+    The byte and time budgets always let the first sequence in, so a reel bigger than the budget is not stuck forever.
+    @return: Tuple of (list of planned CookCandidate, list of deferred CookCandidate)
+    """
+
+    planned = []
+    deferred = []
+    batch_bytes = 0
+    batch_seconds = 0.0
+    batch_mkv_bytes = 0
+
+    for candidate in order_candidates(candidates, order):
+        mkv_bytes = candidate.total_bytes * (candidate.mkv_ratio or mkv_ratio)
+        seconds = estimate_seconds(candidate, throughput) / workers if throughput else 0.0
+
+        fits = True
+        if max_count is not None and len(planned) >= max_count:
+            fits = False
+        elif free_bytes is not None and batch_mkv_bytes + mkv_bytes > free_bytes:
+            fits = False
+        elif len(planned) > 0:
+            if max_bytes is not None and batch_bytes + candidate.total_bytes > max_bytes:
+                fits = False
+            elif max_seconds is not None and throughput and batch_seconds + seconds > max_seconds:
+                fits = False
+
+        if not fits:
+            deferred.append(candidate)
+            continue
+
+        planned.append(candidate)
+        batch_bytes += candidate.total_bytes
+        batch_seconds += seconds
+        batch_mkv_bytes += mkv_bytes
+
+    return planned, deferred
+
+
+def free_space(path) -> int:
+    """Function to return the free bytes of the volume holding path
+
+    @param path: Any path on the volume
+    @return: Free space in bytes
+    """
+
+    return shutil.disk_usage(path).free
+
+
+class SpaceAdmission:
+    """Reserves space on the MKV volume for the cooks that are running
+
+    A cook is admitted only if the free space, minus what the running cooks are still expected to write and minus a
+    headroom, is at least its estimated mkv size. The outstanding part of a reservation shrinks as its mkv grows, so
+    the bytes already written are not counted twice.
+    """
+
+    def __init__(self, path, headroom_bytes=0):
+        self.path = path
+        self.headroom_bytes = headroom_bytes
+        # <key, (mkv path, estimated bytes)>
+        self.reservations = {}
+
+    def outstanding(self) -> int:
+        """Returns the bytes the running cooks are still expected to write"""
+        total = 0
+        for mkv_path, estimate in self.reservations.values():
+            written = os.path.getsize(mkv_path) if os.path.exists(mkv_path) else 0
+            total += max(0, estimate - written)
+        return total
+
+    def available(self) -> int:
+        """Returns the bytes that can still be reserved"""
+        return free_space(self.path) - self.outstanding() - self.headroom_bytes
+
+    def try_reserve(self, key, mkv_path, estimate) -> bool:
+        """Reserves estimate bytes for the mkv of a cook if they are available
+
+        @param key: Identifies the cook, usually the sequence path
+        @param mkv_path: The mkv the cook writes
+        @param estimate: The expected size of the mkv in bytes
+        @return: True if the cook can start
+        """
+
+        if estimate > self.available():
+            return False
+        self.reservations[key] = (mkv_path, estimate)
+        return True
+
+    def release(self, key) -> None:
+        """Releases the reservation of a finished cook"""
+        self.reservations.pop(key, None)
@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from utils.shell_utils import MediaconchResult
+
+
+def file_identity(path) -> tuple:
+    """Function to return the identity of a file used as cache key
+
+    @param path: The file path
+    @return: Tuple of (path, size, mtime in nanoseconds, inode)
+    """
+
+    stat = os.stat(path)
+    return str(path), stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+
+def policy_hash(policy_path) -> str:
+    """Function to hash the content of a policy file, any edit of the policy gives a new hash
+
+    @param policy_path: Path to the policy .xml file
+    @return: SHA-256 hex digest of the file
+    """
+
+    with open(policy_path, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+class PolicyCache:
+    """Persistent cache of mediaconch results keyed on (path, size, mtime, inode, policy hash)
+
+    A file that has not changed since it was last checked against the same policy content is not checked again.
+    Editing the policy changes its hash, the entries checked against the old content are deleted as soon as the new
+    hash is seen. Entries older than max_age_days or beyond the max_entries most recent ones are evicted on open.
+    """
+
+    def __init__(self, db_path, max_age_days=30, max_entries=100000):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.policy_hashes = {}
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS results (path TEXT NOT NULL, size INTEGER NOT NULL, "
+                "mtime_ns INTEGER NOT NULL, inode INTEGER NOT NULL, policy_path TEXT NOT NULL, "
+                "policy_hash TEXT NOT NULL, passed INTEGER NOT NULL, outcome TEXT, failed_rules TEXT, "
+                "checked REAL NOT NULL, PRIMARY KEY (path, policy_path))")
+        self.evict(max_age_days, max_entries)
+
+    def hash_of(self, policy_path) -> str:
+        """Returns the hash of a policy, computed again only if the policy file changed"""
+        stat = os.stat(policy_path)
+        key = (policy_path, stat.st_size, stat.st_mtime_ns)
+        if key not in self.policy_hashes:
+            digest = policy_hash(policy_path)
+            self.policy_hashes[key] = digest
+            self.invalidate(policy_path, digest)
+        return self.policy_hashes[key]
+
+    def invalidate(self, policy_path, digest) -> None:
+        """Deletes the entries of a policy that were checked against another content than digest"""
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM results WHERE policy_path = ? AND policy_hash != ?",
+                                    (policy_path, digest))
+
+    def get(self, policy_path, filename):
+        """Returns the cached MediaconchResult of a file or None if it is missing, stale or the policy changed"""
+        try:
+            path, size, mtime_ns, inode = file_identity(filename)
+        except OSError:
+            return None
+        digest = self.hash_of(policy_path)
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT passed, outcome, failed_rules FROM results WHERE path = ? AND policy_path = ? AND size = ? "
+                "AND mtime_ns = ? AND inode = ? AND policy_hash = ?",
+                (path, policy_path, size, mtime_ns, inode, digest)).fetchone()
+        if row is None:
+            return None
+        return MediaconchResult(bool(row[0]), row[1], json.loads(row[2]))
+
+    def put(self, policy_path, results: dict) -> None:
+        """Stores the MediaconchResult of many files, replacing the previous result of each file"""
+        digest = self.hash_of(policy_path)
+        now = time.time()
+        rows = []
+        for filename, result in results.items():
+            # Errors are not cached, the file is checked again on the next run
+            if result.outcome == 'error':
+                continue
+            try:
+                path, size, mtime_ns, inode = file_identity(filename)
+            except OSError:
+                continue
+            rows.append((path, size, mtime_ns, inode, policy_path, digest, int(result.passed), result.outcome,
+                         json.dumps(result.failed_rules), now))
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO results (path, size, mtime_ns, inode, policy_path, policy_hash, passed, "
+                "outcome, failed_rules, checked) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def evict(self, max_age_days=None, max_entries=None) -> None:
+        """Removes the entries older than max_age_days and keeps only the max_entries most recent ones"""
+        with self.lock, self.connection:
+            if max_age_days:
+                self.connection.execute("DELETE FROM results WHERE checked < ?",
+                                        (time.time() - max_age_days * 86400,))
+            if max_entries:
+                self.connection.execute(
+                    "DELETE FROM results WHERE rowid NOT IN "
+                    "(SELECT rowid FROM results ORDER BY checked DESC LIMIT ?)", (max_entries,))
+
+    def close(self) -> None:
+        self.connection.close()
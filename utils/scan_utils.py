@@ -0,0 +1,235 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import NamedTuple
+
+from utils.gap_check_utils import FRAME_NUMBER_PATTERN
+from utils.move_utils import is_staging
+
+# A folder modified less than this many seconds before a scan is listed again by the next scan instead of being stored,
+# NAS mounts round mtimes to one or two seconds so files added right after a listing can leave the mtime unchanged
+SCAN_SETTLE_SECONDS = int(os.environ.get('SCAN_SETTLE_SECONDS') or 5)
+
+
+class DirInfo(NamedTuple):
+    """What the inventory knows about one folder, only the .dpx files directly inside it are counted"""
+    path: str
+    frames: int
+    bytes_per_frame: int
+    # Paths of the lowest and highest numbered frames, None if the folder has no .dpx file
+    first_dpx: str
+    last_dpx: str
+    subdirs: tuple
+
+    @property
+    def total_bytes(self) -> int:
+        return self.frames * self.bytes_per_frame
+
+
+class WorkUnit(NamedTuple):
+    """A DPX folder assessed and cooked on its own, a delivery with several reels gives one unit per reel"""
+    # Unique name of the unit, names its mkv and its job state
+    name: str
+    # The top level delivery folder the unit belongs to
+    seq_path: str
+    # The folder given to rawcooked, the delivery itself when it holds a single DPX folder
+    path: str
+    info: DirInfo
+
+
+def units_of(seq_path, folders) -> list:
+    """Function to turn the DPX folders of a delivery into work units
+
+    A delivery holding a single DPX folder is one unit named after the delivery and cooked from the delivery folder, as
+    before. A delivery holding several DPX folders, e.g. several reels or resolutions, gives one unit per folder named
+    <delivery>_<path of the folder inside the delivery with / replaced by _>.
+    @param seq_path: The top level delivery folder
+    @param folders: The DirInfo of every folder of the delivery holding .dpx files, top down in name order
+    @return: List of WorkUnit
+    """
+
+    seq_name = os.path.basename(str(seq_path).rstrip(os.sep))
+    if len(folders) == 1:
+        return [WorkUnit(seq_name, seq_path, seq_path, folders[0])]
+    units = []
+    for info in folders:
+        relative_path = os.path.relpath(info.path, seq_path)
+        name = seq_name if relative_path == '.' else f"{seq_name}_{relative_path.replace(os.sep, '_')}"
+        units.append(WorkUnit(name, seq_path, info.path, info))
+    return units
+
+
+def list_folder(path) -> DirInfo:
+    """Function to list one folder with a single os.scandir
+
+    Only the lowest numbered .dpx file is stat'ed, DPX frames of a sequence share the same size and the first frame
+    is the one least likely to be still copying
+    @param path: The folder
+    @return: A DirInfo
+    """
+
+    frames = 0
+    bytes_per_frame = 0
+    first = (None, None)
+    last = (None, None)
+    subdirs = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.name)
+                continue
+            if not entry.name.lower().endswith('.dpx'):
+                continue
+            frames += 1
+            match = FRAME_NUMBER_PATTERN.search(entry.name)
+            key = int(match.group(1)) if match else None
+            # Frames are ordered by number, or by name when they have no number
+            key = (key is None, key, entry.name)
+            if first[0] is None or key < first[0]:
+                first = (key, entry.path)
+            if last[0] is None or key > last[0]:
+                last = (key, entry.path)
+    if first[1] is not None:
+        try:
+            bytes_per_frame = os.stat(first[1]).st_size
+        except FileNotFoundError:
+            pass
+    return DirInfo(str(path), frames, bytes_per_frame, first[1], last[1], tuple(sorted(subdirs)))
+
+
+class ScanInventory:
+    """Persistent inventory of the folders below the workflow folders, shared by the scripts
+
+    Every folder is stored with its inode and mtime. A scan stats each folder once and lists again only the folders
+    whose mtime changed, i.e. where files were added, removed or renamed; the content of the others comes from the
+    inventory. A folder moved to another workflow folder on the same filesystem keeps its inode and mtime, so a
+    sequence assessed by dpx_assessment.py is not listed again by dpx_rawcook.py once it reaches dpx_to_cook. A folder
+    modified within SCAN_SETTLE_SECONDS of the scan is listed but not stored, its mtime may not show files still
+    arriving.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        # The scripts run by the daemon share the database, writers wait for each other
+        self.connection = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        with self.connection:
+            # Inventories written before the frame numbers were dropped are rebuilt by the next scans
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(dirs)")]
+            if 'frame_numbers' in columns:
+                self.connection.execute("DROP TABLE dirs")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, dev INTEGER NOT NULL, ino INTEGER NOT NULL, "
+                "mtime_ns INTEGER NOT NULL, frames INTEGER NOT NULL, bytes_per_frame INTEGER NOT NULL, "
+                "first_dpx TEXT, last_dpx TEXT, subdirs TEXT)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS dirs_inode ON dirs (dev, ino)")
+
+    def cached(self, path, stat) -> tuple:
+        """Returns the DirInfo stored for a folder if the folder did not change, looked up by path then by inode
+
+        @return: Tuple of (DirInfo or None, path the folder was stored under)
+        """
+        row = self.connection.execute(
+            "SELECT path, frames, bytes_per_frame, first_dpx, last_dpx, subdirs FROM dirs "
+            "WHERE path = ? AND dev = ? AND ino = ? AND mtime_ns = ?",
+            (path, stat.st_dev, stat.st_ino, stat.st_mtime_ns)).fetchone()
+        if row is None:
+            row = self.connection.execute(
+                "SELECT path, frames, bytes_per_frame, first_dpx, last_dpx, subdirs FROM dirs "
+                "WHERE dev = ? AND ino = ? AND mtime_ns = ?", (stat.st_dev, stat.st_ino, stat.st_mtime_ns)).fetchone()
+        if row is None:
+            return None, None
+        stored_path, frames, bytes_per_frame, first_name, last_name, subdirs = row
+        first_dpx = os.path.join(path, first_name) if first_name else None
+        last_dpx = os.path.join(path, last_name) if last_name else None
+        return DirInfo(path, frames, bytes_per_frame, first_dpx, last_dpx,
+                       tuple(subdirs.split('\n')) if subdirs else ()), stored_path
+
+    def scan(self, root) -> dict:
+        """Scans a folder and everything below it
+
+        @param root: The folder to scan
+        @return: Dictionary with <folder path, DirInfo> pairs for root and every folder below it
+        """
+
+        root = str(root)
+        found = {}
+        changed = []
+        with self.lock:
+            stack = [root]
+            while stack:
+                path = stack.pop()
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                settled = time.time() - stat.st_mtime >= SCAN_SETTLE_SECONDS
+                info, stored_path = self.cached(path, stat) if settled else (None, None)
+                if info is None:
+                    try:
+                        info = list_folder(path)
+                    except FileNotFoundError:
+                        continue
+                if settled and stored_path != path:
+                    changed.append((info, stat))
+                found[path] = info
+                stack.extend(os.path.join(path, name) for name in reversed(info.subdirs))
+
+            prefix = root.rstrip(os.sep) + os.sep
+            known = [row[0] for row in self.connection.execute(
+                "SELECT path FROM dirs WHERE path = ? OR substr(path, 1, ?) = ?", (root, len(prefix), prefix))]
+            with self.connection:
+                self.connection.executemany("DELETE FROM dirs WHERE path = ?",
+                                            [(path,) for path in known if path not in found])
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO dirs (path, dev, ino, mtime_ns, frames, bytes_per_frame, first_dpx, "
+                    "last_dpx, subdirs) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(info.path, stat.st_dev, stat.st_ino, stat.st_mtime_ns, info.frames, info.bytes_per_frame,
+                      os.path.basename(info.first_dpx) if info.first_dpx else None,
+                      os.path.basename(info.last_dpx) if info.last_dpx else None,
+                      '\n'.join(info.subdirs)) for info, stat in changed])
+                # A folder found again under a new path no longer exists under the old one
+                self.connection.executemany(
+                    "DELETE FROM dirs WHERE dev = ? AND ino = ? AND path != ?",
+                    [(stat.st_dev, stat.st_ino, info.path) for info, stat in changed])
+        return found
+
+    def dpx_folders(self, root) -> dict:
+        """Returns the folders holding .dpx files below each top level entry of a workflow folder
+
+        @param root: The workflow folder, e.g. dpx_to_assess
+        @return: Dictionary with <sequence path, list of DirInfo> pairs, folders listed top down in name order
+        """
+
+        found = self.scan(root)
+        sequences = {}
+        for name in found[root].subdirs if root in found else ():
+            # Sequences still being copied by a cross device move
+            if is_staging(name):
+                continue
+            seq_path = os.path.join(root, name)
+            folders = []
+            stack = [seq_path]
+            while stack:
+                info = found.get(stack.pop())
+                if info is None:
+                    continue
+                if info.frames > 0:
+                    folders.append(info)
+                stack.extend(os.path.join(info.path, sub) for sub in reversed(info.subdirs))
+            sequences[seq_path] = folders
+        return sequences
+
+    def work_units(self, root) -> dict:
+        """Returns every DPX folder below each top level entry of a workflow folder as its own work unit, see units_of()
+
+        @param root: The workflow folder, e.g. dpx_to_cook
+        @return: Dictionary with <sequence path, list of WorkUnit> pairs, deliveries without .dpx files are left out
+        """
+
+        return {seq_path: units_of(seq_path, folders)
+                for seq_path, folders in self.dpx_folders(root).items() if folders}
+
+    def close(self) -> None:
+        self.connection.close()
@@ -1,8 +1,175 @@
 import concurrent
+import concurrent.futures
+import queue
+import re
 import subprocess
 import os
+import threading
+import time
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor
-from shutil import move
+from typing import NamedTuple
+from xml.etree import ElementTree
+
+from utils import metrics_utils
+from utils.move_utils import move_path
+
+# Progress information printed by rawcooked and ffmpeg
+PROGRESS_PATTERNS = {
+    'percent': re.compile(r'(\d+(?:\.\d+)?)\s*%'),
+    'fps': re.compile(r'fps\s*=\s*(\d+(?:\.\d+)?)|(\d+(?:\.\d+)?)\s*fps', re.IGNORECASE),
+    'frame': re.compile(r'frame\s*=\s*(\d+)', re.IGNORECASE),
+    'speed': re.compile(r'(\d+(?:\.\d+)?)\s*MiB/s'),
+}
+
+
+class StreamResult:
+    """Outcome of run_streaming()"""
+
+    def __init__(self, command):
+        self.command = command
+        self.returncode = None
+        self.matched = set()
+        self.stopped_on = None
+        self.stalled = False
+        self.timed_out = False
+        self.cancelled = False
+        self.progress = {}
+        self.tail = deque(maxlen=50)
+        # Resource usage of the process, None where os.wait4 is not available
+        self.wall_seconds = None
+        self.cpu_seconds = None
+        self.max_rss_bytes = None
+
+    @property
+    def killed(self) -> bool:
+        return self.stopped_on is not None or self.stalled or self.timed_out or self.cancelled
+
+
+def parse_progress(line, progress: dict) -> bool:
+    """Function to update a progress dictionary with the values found in a line of output
+
+    @param line: A line printed by rawcooked
+    @param progress: Dictionary with the last known percent, fps, frame and speed values
+    @return: True if any value was found in the line
+    """
+
+    found = False
+    for key, pattern in PROGRESS_PATTERNS.items():
+        match = pattern.search(line)
+        if match:
+            value = next(group for group in match.groups() if group is not None)
+            progress[key] = float(value)
+            found = True
+    return found
+
+
+def _reap(process, result) -> int:
+    """Waits for a process with os.wait4 to read its own CPU time and peak memory, falls back to Popen.wait()"""
+    if hasattr(os, 'wait4'):
+        try:
+            _, status, usage = os.wait4(process.pid, 0)
+        except ChildProcessError:
+            return process.wait()
+        # Popen.wait() returns the recorded code from now on instead of waiting for the reaped process
+        process.returncode = os.waitstatus_to_exitcode(status)
+        result.cpu_seconds = usage.ru_utime + usage.ru_stime
+        # ru_maxrss is in KiB on Linux
+        result.max_rss_bytes = usage.ru_maxrss * 1024
+        return process.returncode
+    return process.wait()
+
+
+def _drain(stream, name, lines):
+    """Reads a pipe until it closes and pushes every line into the lines queue, then pushes a None sentinel"""
+    for line in stream:
+        lines.put((name, line))
+    lines.put((name, None))
+
+
+def run_streaming(command, log_file=None, prefix=None, stop_patterns=(), watch_patterns=(), stall_timeout=None,
+                  timeout=None, on_progress=None, should_stop=None) -> StreamResult:
+    """Function to run a command while streaming both of its outputs
+
+    stdout and stderr are drained at the same time by two threads so that neither pipe can fill up and block the child.
+    Every line is written to log_file as soon as it arrives instead of being kept in memory.
+    @param command: The command as a list
+    @param log_file: File where the output lines are appended, if any
+    @param prefix: Prefix of the lines printed to the console, if None the lines are not printed
+    @param stop_patterns: The process is killed as soon as one of these strings shows up
+    @param watch_patterns: Strings whose presence in the output is recorded in StreamResult.matched
+    @param stall_timeout: Seconds without any output after which the process is considered stalled and killed
+    @param timeout: Seconds after which the process is killed whatever it is doing
+    @param on_progress: Called with the progress dictionary every time a progress value is parsed
+    @param should_stop: Called after every line and at least once per second, the process is killed once it returns True
+    @return: A StreamResult, its wall time, CPU time and peak memory are also recorded in the metrics
+    """
+
+    result = StreamResult(command)
+    lines = queue.Queue()
+    log = open(log_file, 'a') if log_file else None
+    try:
+        with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True) as p:
+            readers = [threading.Thread(target=_drain, args=(p.stdout, 'stdout', lines), daemon=True),
+                       threading.Thread(target=_drain, args=(p.stderr, 'stderr', lines), daemon=True)]
+            for reader in readers:
+                reader.start()
+
+            start = last_output = time.monotonic()
+            open_streams = len(readers)
+            while open_streams > 0:
+                try:
+                    name, line = lines.get(timeout=1)
+                except queue.Empty:
+                    name, line = None, None
+                now = time.monotonic()
+
+                if name is not None and line is None:
+                    open_streams -= 1
+                elif line is not None:
+                    last_output = now
+                    result.tail.append(line)
+                    if log:
+                        log.write(line)
+                        log.flush()
+                    if prefix is not None:
+                        print(f"{prefix} : {line}", end='')
+                    for pattern in watch_patterns:
+                        if pattern in line:
+                            result.matched.add(pattern)
+                    if parse_progress(line, result.progress) and on_progress:
+                        on_progress(result.progress)
+                    stop = next((pattern for pattern in stop_patterns if pattern in line), None)
+                    if stop is not None:
+                        result.stopped_on = stop
+                        result.matched.add(stop)
+                        p.kill()
+                        break
+
+                if stall_timeout and now - last_output > stall_timeout:
+                    result.stalled = True
+                    p.kill()
+                    break
+                if timeout and now - start > timeout:
+                    result.timed_out = True
+                    p.kill()
+                    break
+                if should_stop and should_stop():
+                    result.cancelled = True
+                    p.kill()
+                    break
+
+            result.returncode = _reap(p, result)
+            result.wall_seconds = time.monotonic() - start
+            # Let the readers reach the end of the pipes before Popen closes them
+            for reader in readers:
+                reader.join(timeout=5)
+    finally:
+        if log:
+            log.close()
+    metrics_utils.record_subprocess(command[0], result.wall_seconds or 0, result.cpu_seconds, result.max_rss_bytes,
+                                    result.returncode)
+    return result
 
 
 def get_media_info(flags, filename, output_file=None):
@@ -62,6 +229,110 @@ def check_mediaconch_policy(policy_path, filename):
     return check
 
 
+class MediaconchResult(NamedTuple):
+    """Policy outcome of one file checked by mediaconch"""
+    passed: bool
+    outcome: str
+    failed_rules: list
+
+
+def parse_mediaconch_xml(xml_text) -> dict:
+    """Function to read the per file outcomes of a mediaconch -fx report
+
+    @param xml_text: The XML printed by mediaconch
+    @return: Dictionary with <file path, MediaconchResult> pairs
+    """
+
+    results = {}
+    root = ElementTree.fromstring(xml_text)
+    for media in root.iter():
+        if not media.tag.endswith('media'):
+            continue
+        policy = next((child for child in media if child.tag.endswith('policy')), None)
+        if policy is None:
+            results[media.get('ref')] = MediaconchResult(False, 'error', [])
+            continue
+        outcome = policy.get('outcome', 'fail')
+        failed_rules = [rule.get('name') for rule in policy.iter()
+                        if rule.tag.endswith('rule') and rule.get('outcome') == 'fail']
+        results[media.get('ref')] = MediaconchResult(outcome == 'pass', outcome, failed_rules)
+    return results
+
+
+def check_mediaconch_policy_batch(policy_path, filenames) -> dict:
+    """Function to check many files against a policy with a single mediaconch invocation
+
+    @param policy_path: Path to the file containing the policies
+    @param filenames: The files verified against the policies
+    @return: Dictionary with <file path, MediaconchResult> pairs, files missing from the report are failed
+    """
+
+    command = ['mediaconch', '--force', '-p', policy_path, '-fx'] + [str(filename) for filename in filenames]
+    check = subprocess.run(command, capture_output=True)
+    try:
+        reported = parse_mediaconch_xml(check.stdout.decode())
+    except ElementTree.ParseError:
+        reported = {}
+    reported.update({os.path.realpath(ref): result for ref, result in list(reported.items()) if ref})
+
+    results = {}
+    for filename in filenames:
+        result = reported.get(str(filename)) or reported.get(os.path.realpath(filename))
+        if result is None:
+            result = MediaconchResult(False, 'error', [check.stderr.decode().strip()])
+        results[filename] = result
+    return results
+
+
+def check_mediaconch_policies(policy_path, filenames, chunk_size=50, workers=None, cache=None,
+                              stop_on_failure=False) -> dict:
+    """Function to check a large number of files by sharding them over a pool of threads
+
+    Each thread checks chunk_size files with one mediaconch invocation and waits for it, the work is done by the
+    mediaconch processes so threads are enough and no process is forked from the threads of the caller
+    @param policy_path: Path to the file containing the policies
+    @param filenames: The files verified against the policies
+    @param chunk_size: Number of files given to each mediaconch invocation
+    @param workers: Number of mediaconch invocations at the same time, defaults to one per CPU core
+    @param cache: Optional policy_cache.PolicyCache, files with a cached result are not checked again
+    @param stop_on_failure: Stop as soon as a file fails, the chunks not started yet are cancelled
+    @return: Dictionary with <file path, MediaconchResult> pairs of the files that were checked
+    """
+
+    results = {}
+    to_check = []
+    for filename in filenames:
+        cached = cache.get(policy_path, filename) if cache else None
+        if cached is None:
+            to_check.append(filename)
+        else:
+            results[filename] = cached
+
+    if stop_on_failure and any(not result.passed for result in results.values()):
+        return results
+
+    chunks = [to_check[i:i + chunk_size] for i in range(0, len(to_check), chunk_size)]
+    checked = {}
+    if len(chunks) == 1:
+        checked = check_mediaconch_policy_batch(policy_path, chunks[0])
+    elif len(chunks) > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+            futures = [executor.submit(check_mediaconch_policy_batch, policy_path, chunk) for chunk in chunks]
+            for future in concurrent.futures.as_completed(futures):
+                if future.cancelled():
+                    continue
+                checked.update(future.result())
+                if stop_on_failure and any(not result.passed for result in checked.values()):
+                    for pending in futures:
+                        pending.cancel()
+                    break
+
+    if cache and checked:
+        cache.put(policy_path, checked)
+    results.update(checked)
+    return results
+
+
 def run_script(python_version, script_name, argument):
     subprocess.run([python_version, script_name, argument], check=True)
 
@@ -77,7 +348,7 @@ def move_file(filename, source_dir, destination_dir):
     source_path = os.path.join(source_dir, filename)
     destination_path = os.path.join(destination_dir, filename)
     try:
-        move(source_path, destination_path)
+        move_path(source_path, destination_path)
         print(f"Moved: {source_path} to {destination_path}")
     except Exception as e:
         print(f"Error moving {source_path} to {destination_path}: {e}")
@@ -0,0 +1,215 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+# inotify event masks, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# A delivery shows up as a new entry in a watched folder or as a file written in it
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+EVENT_HEADER = struct.Struct('iIII')
+
+WATCHER_AUTO = 'auto'
+WATCHER_INOTIFY = 'inotify'
+WATCHER_POLL = 'poll'
+
+
+class InotifyWatcher:
+    """Watches the top level entries of a few folders with the Linux inotify API through ctypes
+
+    inotify is not recursive, the frames written inside a sequence folder are not reported. The creation or the move of
+    the sequence folder is, and the QuiescenceTracker then follows the content of the folder until it stops changing.
+    """
+
+    def __init__(self, folders):
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise OSError("libc not found")
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError("inotify is not available on this platform")
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.folders = {}
+        for folder in folders:
+            wd = libc.inotify_add_watch(self.fd, os.fsencode(folder), WATCH_MASK)
+            if wd < 0:
+                os.close(self.fd)
+                raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {folder}")
+            self.folders[wd] = folder
+
+    def wait(self, timeout) -> set:
+        """Waits up to timeout seconds for changes
+
+        @param timeout: Seconds to wait for the first event
+        @return: Set of (folder, entry name) that changed, every entry of every folder if the kernel queue overflowed
+        """
+
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+
+        changed = set()
+        while True:
+            try:
+                buffer = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(buffer, offset)
+                name = buffer[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+                offset += EVENT_HEADER.size + length
+                if mask & IN_Q_OVERFLOW:
+                    return scan_folders(self.folders.values())
+                if wd in self.folders and name:
+                    changed.add((self.folders[wd], os.fsdecode(name)))
+        return changed
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """Fallback watcher for platforms or filesystems without inotify, e.g. network shares
+
+    Lists the top level entries of each folder every wait() and reports the new ones and the ones whose size or mtime
+    changed since the previous listing
+    """
+
+    def __init__(self, folders):
+        self.folders = list(folders)
+        self.snapshot = self.listing()
+
+    def listing(self) -> dict:
+        entries = {}
+        for folder in self.folders:
+            with os.scandir(folder) as scan:
+                for entry in scan:
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries[(folder, entry.name)] = (stat.st_size, stat.st_mtime_ns)
+        return entries
+
+    def wait(self, timeout) -> set:
+        time.sleep(timeout)
+        listing = self.listing()
+        changed = {key for key, value in listing.items() if self.snapshot.get(key) != value}
+        self.snapshot = listing
+        return changed
+
+    def close(self) -> None:
+        pass
+
+
+def create_watcher(folders, kind=WATCHER_AUTO):
+    """Function to create the watcher of a list of folders
+
+    @param folders: The folders to watch
+    @param kind: WATCHER_INOTIFY, WATCHER_POLL or WATCHER_AUTO which tries inotify and falls back to polling
+    @return: An InotifyWatcher or a PollingWatcher
+    """
+
+    if kind == WATCHER_POLL:
+        return PollingWatcher(folders)
+    try:
+        return InotifyWatcher(folders)
+    except (OSError, AttributeError):
+        if kind == WATCHER_INOTIFY:
+            raise
+        return PollingWatcher(folders)
+
+
+def scan_folders(folders) -> set:
+    """Function to list the top level entries of folders as (folder, entry name) pairs"""
+    entries = set()
+    for folder in folders:
+        with os.scandir(folder) as scan:
+            entries.update((folder, entry.name) for entry in scan)
+    return entries
+
+
+def tree_signature(path) -> tuple:
+    """Function to summarise the content of a file or folder without a stat per file
+
+    A folder is summarised by its sub folders only: adding, removing or renaming a frame changes the mtime and the
+    entry count of the folder holding it, so the frames themselves are listed but never stat'ed
+    @param path: The file or folder
+    @return: Tuple of (number of entries, number of folders, latest folder mtime in ns) for a folder, (1, size, mtime in
+    ns) for a file, None if the path no longer exists
+    """
+
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    if not os.path.isdir(path):
+        return 1, stat.st_size, stat.st_mtime_ns
+
+    count, dirs, mtime = 0, 0, 0
+    folders = [path]
+    while folders:
+        folder = folders.pop()
+        try:
+            mtime = max(mtime, os.stat(folder).st_mtime_ns)
+            scan = os.scandir(folder)
+        except FileNotFoundError:
+            continue
+        dirs += 1
+        with scan:
+            for entry in scan:
+                count += 1
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        folders.append(entry.path)
+                except FileNotFoundError:
+                    continue
+    return count, dirs, mtime
+
+
+class QuiescenceTracker:
+    """Tells when a delivery is finished
+
+    A path is ready once its tree_signature() has not changed for quiet_seconds. The signature is only computed when
+    check() is called, so the cost is one scandir walk and one stat per folder of each pending delivery per check.
+    """
+
+    def __init__(self, quiet_seconds):
+        self.quiet_seconds = quiet_seconds
+        self.pending = {}
+
+    def touch(self, path) -> None:
+        """Starts or restarts the quiet period of a path"""
+        self.pending[path] = (tree_signature(path), time.monotonic())
+
+    def check(self) -> list:
+        """Returns the paths that have been quiet long enough and stops tracking them, vanished paths are dropped
+        """
+
+        ready = []
+        now = time.monotonic()
+        for path, (signature, since) in list(self.pending.items()):
+            current = tree_signature(path)
+            if current is None:
+                del self.pending[path]
+            elif current != signature:
+                self.pending[path] = (current, now)
+            elif now - since >= self.quiet_seconds:
+                del self.pending[path]
+                ready.append(path)
+        return ready